@@ -2,9 +2,12 @@
 
 # For running on HTcondor
 # ASSUMES THAT THE DIRECTORY WITH SPECTRUM FILES EXISTS ON /hdfs
-# Args: <dir with spectrum files> <process ID for uniqueness>
+# Args: <dir with spectrum files> <process ID for uniqueness> [shards]
+# With "shards" as the 3rd arg, the results<PID>_*.npz shards made by
+# NMSSMScan.py --shards are analysed instead of spectr<PID>.tgz
 SPECTRDIR="$1"
 PID="$2"
+MODE="$3"
 
 # Check if the directory on hdfs exists
 # -----------------------------------------------------------------------------
@@ -14,12 +17,9 @@ if [ ! -d $hdfsdir ]; then
     exit 1
 fi
 
-# Make a dir on the worker node with the same name, extract spectrum files there
+# Spectrum files are read straight from the archive on hdfs, no need to untar
 # -----------------------------------------------------------------------------
-if [ ! -d "$SPECTRDIR" ]; then
-    mkdir "$SPECTRDIR"
-fi
-tar -xzf $hdfsdir/spectr"$PID".tgz -C "$SPECTRDIR"
+SPECTRTGZ=$hdfsdir/spectr"$PID".tgz
 
 # Check if superiso output exists. If so, untar.
 # -----------------------------------------------------------------------------
@@ -54,16 +54,22 @@ tar -xzf $hdfsdir/spectr"$PID".tgz -C "$SPECTRDIR"
 
 ls
 
-# Run analysis script over files
+# Run analysis script over files, adding the point weights if there is a point log
 # -----------------------------------------------------------------------------
-python analyse_scans.py "$SPECTRDIR" --ID "$PID"
+if [[ $MODE == "shards" ]]; then
+    # shards already hold the point weights
+    # quoted so the pattern is expanded by analyse_scans.py, not here
+    python analyse_scans.py "$hdfsdir/results${PID}_*.npz" --shards --ID "$PID"
+else
+    POINTLOGOPT=""
+    if [ -e $hdfsdir/points"$PID".csv ]; then
+        POINTLOGOPT="--pointLog $hdfsdir/points$PID.csv"
+    fi
+    python analyse_scans.py "$SPECTRTGZ" --ID "$PID" $POINTLOGOPT
+fi
 
 # Copy files to hdfs
 # -----------------------------------------------------------------------------
 for f in *.csv; do
     hadoop fs -copyFromLocal -f $f ${hdfsdir#/hdfs}/$(basename $f)
 done
-
-# Cleanup
-# -----------------------------------------------------------------------------
-rm -r $SPECTRDIR
@@ -3,10 +3,11 @@ which gfortran
 # For running on HTCondor
 # TODO: use getopts
 echo "Running with parameters: $@"
-# parameters are: [job dir to put output] [batch number] [number of points]
+# parameters are: [job dir to put output] [batch number] [number of points] [optional points file]
 jobdir=$1
 batchNum=$2
 numPoints=$3
+pointsFile=$4
 
 # choose whether to run with extra programs
 doSuperIso=0
@@ -15,6 +16,23 @@ doHiggsBounds=1
 doHiggsSignals=1
 doSushi=0
 
+# parse spectra as they are made & store the results in npz shards,
+# instead of transferring every spectrum file. The shards are analysed with
+# submit_analysis_condor_new.py as usual, or locally with
+# analyse_scans.py <dir> --shards
+doShards=0
+
+# number of points to run in parallel on this node
+nJobs=1
+
+# finish early once enough points are found, or the time is up, with the
+# number of points as the maximum e.g. "--targetGood 1000 --maxTime 80000"
+targetOpts=""
+
+# how often to copy the scan state to HDFS, in seconds, so an evicted job
+# carries on from there when it is restarted
+stateInterval=1800
+
 # Versions
 NTVER="4.9.3"
 HBVER="4.3.1"
@@ -97,12 +115,73 @@ fi
 
 # Run NMSSMTools over parameter points
 # -----------------------------------------------------------------------------
-python NMSSMScan.py --card inp_*.dat -n $3 --param paramRange*.json --oDir . --NT NMSSMTools_${NTVER} $HBOPT $HSOPT $SUSHIOPT $NCOPT $SUSHIOPT
+# The checkpoint, point log, chain, shards & spectrum files only exist in this
+# job's sandbox, which is lost if the job is evicted. So they are tarred up &
+# copied to HDFS periodically, and restored from there if this job has run before.
+stateFile=state${batchNum}.tgz
+save_state() {
+    # checkpoint & point log first, so every point they list is in the
+    # files after them (any extra points are run again on resume)
+    # (tar exits with 1 if a file changed whilst reading it, which is fine,
+    # and the chain only exists with --mcmc)
+    (
+        shopt -s nullglob
+        tar --ignore-failed-read --warning=no-failed-read --warning=no-file-changed \
+            --exclude='*.tmp*' \
+            -czf $stateFile checkpoint${batchNum}.json points${batchNum}.csv \
+            chain${batchNum}.csv results${batchNum}_*.npz spectr*.dat || [[ $? == 1 ]]
+    ) &&
+    hadoop fs -copyFromLocal -f $stateFile ${jobdir#/hdfs}/$stateFile.tmp &&
+    hadoop fs -rm -f ${jobdir#/hdfs}/$stateFile &&
+    hadoop fs -mv ${jobdir#/hdfs}/$stateFile.tmp ${jobdir#/hdfs}/$stateFile &&
+    echo "Saved scan state to $jobdir/$stateFile"
+}
+if [[ -e $jobdir/$stateFile ]]; then
+    echo "Restoring scan state from $jobdir/$stateFile"
+    tar -xzf $jobdir/$stateFile
+fi
+
+# make the per-point files on a RAM disk if there is one
+SCRATCHOPT=""
+if [[ -d /dev/shm && -w /dev/shm ]]; then
+    SCRATCHOPT="--scratch /dev/shm"
+fi
+SHARDOPT=""
+if [[ $doShards == 1 ]]; then
+    SHARDOPT="--shards"
+fi
+# points are either sampled from the param ranges, or read from a file
+PARAMOPT=""
+for f in paramRange*.json; do
+    if [[ -f $f ]]; then
+        PARAMOPT="--param $f"
+    fi
+done
+if [[ -n $pointsFile ]]; then
+    PARAMOPT="$PARAMOPT --points $pointsFile"
+fi
+# --resume carries on from any checkpoint & point log left by an earlier,
+# interrupted run of this job, otherwise starts from scratch
+python NMSSMScan.py --card inp_*.dat -n $3 $PARAMOPT --oDir . --batch $batchNum --resume $SCRATCHOPT $SHARDOPT $targetOpts -j $nJobs --NT NMSSMTools_${NTVER} $HBOPT $HSOPT $SUSHIOPT $NCOPT $SUSHIOPT &
+scanPID=$!
+lastSave=$SECONDS
+while kill -0 $scanPID 2> /dev/null; do
+    sleep 10
+    if (( SECONDS - lastSave >= stateInterval )) && kill -0 $scanPID 2> /dev/null; then
+        save_state || echo "Could not save the scan state, will try again later"
+        lastSave=$SECONDS
+    fi
+done
+wait $scanPID
 # ls
 
 # Setup SuperIso
 # -----------------------------------------------------------------------------
-if [[ $doSuperIso == 1 ]]; then
+# SuperIso runs over the spectrum files, which aren't kept with shards
+if [[ $doSuperIso == 1 && $doShards == 1 ]]; then
+    echo "Not running SuperIso as the spectrum files aren't kept with shards"
+fi
+if [[ $doSuperIso == 1 && $doShards == 0 ]]; then
     tar -xvzf superiso_v*.tgz
     cd superiso*
     make slha
@@ -120,32 +199,45 @@ fi
 
 # Save space - delete useless files
 # -----------------------------------------------------------------------------
-for f in $(grep -l "M_A1^2<1" spectr*.dat);
-do
-    echo "rm $f"
-    rm $f
-done
+# With shards, NMSSMScan.py has already parsed & deleted the spectrum and
+# omega files, so only the shards need transferring
+if [[ $doShards == 1 ]]; then
+    for f in results${batchNum}_*.npz; do
+        hadoop fs -copyFromLocal $f ${jobdir#/hdfs}
+    done
+else
+    for f in $(grep -l "M_A1^2<1" spectr*.dat);
+    do
+        echo "rm $f"
+        rm $f
+    done
 
-for f in $(grep -l "M_H1^2<1" spectr*.dat);
-do
-    echo "rm $f"
-    rm $f
-done
+    for f in $(grep -l "M_H1^2<1" spectr*.dat);
+    do
+        echo "rm $f"
+        rm $f
+    done
 
-for f in $(grep -l "M_HC^2<1" spectr*.dat);
-do
-    echo "rm $f"
-    rm $f
-done
+    for f in $(grep -l "M_HC^2<1" spectr*.dat);
+    do
+        echo "rm $f"
+        rm $f
+    done
 
-rm omega*
+    rm -f omega*
 
-# Zip up files to transfer to HDFS
-# -----------------------------------------------------------------------------
-nfiles=`ls spectr*.dat | wc -l`
-echo "Zipping up $nfiles files"
-tar -cvzf "spectr${batchNum}.tgz" spectr*.dat
-hadoop fs -copyFromLocal spectr${batchNum}.tgz ${jobdir#/hdfs}
+    # Zip up files to transfer to HDFS
+    # -------------------------------------------------------------------------
+    nfiles=`ls spectr*.dat | wc -l`
+    echo "Zipping up $nfiles files"
+    tar -cvzf "spectr${batchNum}.tgz" spectr*.dat
+    hadoop fs -copyFromLocal spectr${batchNum}.tgz ${jobdir#/hdfs}
+fi
+hadoop fs -copyFromLocal points${batchNum}.csv ${jobdir#/hdfs}
+# timing & failure metrics, merge over all jobs with scan_metrics.py
+hadoop fs -copyFromLocal metrics${batchNum}.json ${jobdir#/hdfs}
+# the job is done, so don't keep its state
+hadoop fs -rm -f ${jobdir#/hdfs}/$stateFile
 
 # tar -cvzf "omega${batchNum}.tgz" omega*.dat
 # cp "omega${batchNum}.tgz" "$jobdir"
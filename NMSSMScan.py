@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 """
-This script runs NMSSMTools over parameter ranges, with optional depenence
-between parameters.
+This script runs NMSSMTools over parameter ranges, with optional dependence
+between parameters (see param_space.py).
 
 This allows for running on a batch system, where each worker node can scan
 randomly over a given range, improving efficiency.
@@ -13,18 +13,48 @@ import os
 import sys
 import argparse
 import logging
-import random
-from subprocess import call
+import copy
+import glob
+import shutil
+import tempfile
+import multiprocessing
+import Queue
 import json
-import re
+import numpy as np
 from time import strftime
 import common_utils as cu
+from card_template import CardTemplate
+from tool_runner import ToolRunner, check_result
+from scan_pipeline import Pipeline, Stage
+from samplers import SAMPLERS, get_sampler, centered_discrepancy
+from mcmc import AdaptiveMetropolis, ChainWriter, log_likelihood
+from surrogate import KNNSurrogate, SurrogateFilter
+from param_space import ParamSpace, load_param_file
+from tree_level import TreeLevelScreen, TREE_PARAMS
+from native_scan import ISCAN, make_scan_card, read_columns, iter_scan_output
+from point_files import load_points
+from card_template import param_pattern
+from scan_log import PointLog, Checkpoint, read_point_log, read_point_log_column
+from result_cache import ResultCache, tool_tag
+from result_shards import ShardWriter, find_shards, iter_shard_records
+from scan_targets import ScanTargets, until_targets
+from scan_metrics import ScanMetrics
+from slha_parser import ParsePlan
+from analyse_scans import parse_spectrum
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
+# reads just BLOCK SPINFO of a spectrum file, for the failure messages
+SPINFO_PLAN = ParsePlan([], spinfo=True)
+
+# how often to check that the workers are still alive whilst waiting on
+# them, in seconds
+WORKER_POLL = 10
+
+
 def NMSSMScan(in_args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("--card",
@@ -33,12 +63,165 @@ def NMSSMScan(in_args=sys.argv[1:]):
     parser.add_argument("--oDir",
                         help="Output directory for spectrum/MicrOMEGAs files")
     parser.add_argument("--param",
-                        help='JSON file with parameter range to run over.',
-                        required=True)
+                        help='JSON file with parameter range to run over. '
+                        'Not needed with --points.')
+    parser.add_argument('--points',
+                        help='CSV or .npy file of points to run, instead of '
+                        'sampling them (see point_files.py). Each job runs '
+                        'rows [batch * n, (batch + 1) * n). The params are the '
+                        'columns matching a card line, or those in --param '
+                        '(whose ranges & constraints are then ignored).')
     parser.add_argument('-n', '--number',
-                        help='Number of points to run over',
+                        help='Number of points to run over. With any --target* '
+                        'or --max* options, this is the maximum number.',
                         type=int,
                         default=1)
+    parser.add_argument('--targetPhysical',
+                        help='Stop once this many physical points are done',
+                        type=int)
+    parser.add_argument('--targetGood',
+                        help='Stop once this many points passing the relaxed '
+                        'constraints (as for analyse_scans output_good) are done',
+                        type=int)
+    parser.add_argument('--targetFilter',
+                        help='Stop once N points pass EXPR, a python expression '
+                        'of the parsed result fields plus physical & good, e.g. '
+                        '"good and ma1 < 11". Can be used more than once. '
+                        'The scan stops once all the --target* counts are reached.',
+                        nargs=2,
+                        metavar=('EXPR', 'N'),
+                        action='append',
+                        default=[])
+    parser.add_argument('--maxTime',
+                        help='Stop starting new points after this wall-clock '
+                        'time, in seconds',
+                        type=float)
+    parser.add_argument('--maxCPU',
+                        help='Stop starting new points after this much CPU '
+                        'time (including all the programs run), in seconds',
+                        type=float)
+    parser.add_argument('--sampler',
+                        help='Method to sample points in the parameter space. '
+                        'Overrides any "_sampler" entry in the param JSON. '
+                        'Default is random.',
+                        choices=sorted(SAMPLERS.keys()))
+    parser.add_argument('--seed',
+                        help='Seed for the sampler. Overrides any "_seed" entry '
+                        'in the param JSON.',
+                        type=int)
+    parser.add_argument('--batch',
+                        help='Batch (job) number. Each batch takes a different '
+                        'block of -n points from the sampler.',
+                        type=int,
+                        default=0)
+    parser.add_argument('--mcmc',
+                        help='Scan using an adaptive Markov chain (Metropolis-'
+                        'Hastings), targeting points that pass the constraints. '
+                        'The chain is written to chain<batch>.csv in oDir, with '
+                        'burnIn = 1 for the rows from the burn-in, which should be '
+                        'dropped. The sampler is only used to find a starting point.',
+                        action='store_true')
+    parser.add_argument('--mcmcAdaptSteps',
+                        help='Number of MCMC steps to adapt the proposal for '
+                        '(the burn-in). The proposal is fixed after that.',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--mcmcWidth',
+                        help='Initial MCMC proposal width, as a fraction of '
+                        'each param range',
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--mcmcPenalty',
+                        help='Penalty to the MCMC log-likelihood for each '
+                        'failed constraint',
+                        type=float,
+                        default=10.)
+    parser.add_argument('--native',
+                        help='Run NMSSMTools once in its own scan mode over '
+                        'the param ranges, instead of once per point. Points '
+                        'are written to results shards, HiggsBounds & '
+                        'HiggsSignals are not run. Needs --nativeColumns.',
+                        choices=sorted(ISCAN))
+    parser.add_argument('--nativeColumns',
+                        help='File listing the names of the columns in the '
+                        'NMSSMTools scan output, as analyse_scans field names '
+                        '(e.g. lambda, mh1), or - to ignore a column. '
+                        'See native_scan.py.')
+    parser.add_argument('--surrogate',
+                        help='Surrogate model (.npz from surrogate.py) used to '
+                        'skip points that are likely to be unphysical/bad, '
+                        'before running NMSSMTools.')
+    parser.add_argument('--surrogateFRR',
+                        help='Target false rejection rate for --surrogate, '
+                        'i.e. the fraction of good points wrongly skipped.',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('--surrogateExplore',
+                        help='Fraction of points rejected by --surrogate to '
+                        'run anyway, so the model can be retrained without bias.',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('--treeScreen',
+                        help='Skip points with a clearly tachyonic tree-level '
+                        'Higgs spectrum, before running NMSSMTools. Needs '
+                        '%s as scan params.' % ', '.join(TREE_PARAMS),
+                        action='store_true')
+    parser.add_argument('--treeMargin',
+                        help='Safety margin for --treeScreen in GeV^2: points '
+                        'are skipped if a tree-level Higgs mass^2 is below '
+                        '-treeMargin, to allow for loop corrections.',
+                        type=float,
+                        default=1E4)
+    parser.add_argument('--pointLog',
+                        help='CSV file to log every point run, and whether it '
+                        'was physical, e.g. to train a surrogate model. Used by '
+                        '--resume to skip points already done. '
+                        'Default is points<batch>.csv in oDir.')
+    parser.add_argument('--resume',
+                        help='Resume a scan from its checkpoint & point log in '
+                        'oDir, e.g. after the job was killed. Starts from '
+                        'scratch if there is no checkpoint.',
+                        action='store_true')
+    parser.add_argument('--checkpointInterval',
+                        help='Minimum time between saving checkpoints, in seconds',
+                        type=float,
+                        default=120)
+    parser.add_argument('--cache',
+                        help='Directory for a cache of results, keyed by input '
+                        'card & program versions. Points already in the cache '
+                        "aren't run again. Can be shared between scans.")
+    parser.add_argument('--cacheSize',
+                        help='Maximum size of --cache in GB. The least recently '
+                        'used entries are removed beyond this.',
+                        type=float,
+                        default=10)
+    parser.add_argument('--cacheTag',
+                        help='Extra tag for --cache keys, e.g. to mark a change '
+                        "to the programs that isn't in their directory names or patches.",
+                        default='')
+    parser.add_argument('--scratch',
+                        help='Directory for the files made whilst running each '
+                        'point, e.g. /dev/shm for a RAM disk. Only spectra that '
+                        'are kept get moved to oDir. Falls back to oDir if it gets '
+                        'too full.')
+    parser.add_argument('--scratchMinFree',
+                        help='Minimum free space (and memory) in MB to use '
+                        '--scratch for a new point, otherwise oDir is used.',
+                        type=float,
+                        default=500)
+    parser.add_argument('--shards',
+                        help='Parse each physical spectrum once all the programs '
+                        'have run, and store the results in binary shards '
+                        'results<batch>[_<worker>]_<N>.npz in oDir. The spectrum '
+                        'files are removed unless --keepSpectra is used.',
+                        action='store_true')
+    parser.add_argument('--shardSize',
+                        help='Number of points per shard for --shards',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--keepSpectra',
+                        help='Keep spectrum files with --shards',
+                        action='store_true')
     parser.add_argument('--NT',
                         help='NMSSMTools directory',
                         required=True,
@@ -55,6 +238,48 @@ def NMSSMScan(in_args=sys.argv[1:]):
                         help="sushi directory (don't include /bin",
                         type=str)
                         # action='store_true')
+    parser.add_argument('--NTtimeout',
+                        help='Timeout for NMSSMTools per point, in seconds. '
+                        '0 means no timeout.',
+                        type=float,
+                        default=600)
+    parser.add_argument('--HBtimeout',
+                        help='Timeout for HiggsBounds per point, in seconds. '
+                        '0 means no timeout.',
+                        type=float,
+                        default=300)
+    parser.add_argument('--HStimeout',
+                        help='Timeout for HiggsSignals per point, in seconds. '
+                        '0 means no timeout.',
+                        type=float,
+                        default=300)
+    parser.add_argument('-j', '--jobs',
+                        help='Number of points to run in parallel. Each worker '
+                        'gets its own scratch copy of the tool directories.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--pipeline',
+                        help='Run the programs as separate pipeline stages, so '
+                        'e.g. NMSSMTools runs on the next point whilst HB/HS run '
+                        'on the current one.',
+                        action='store_true')
+    parser.add_argument('--NTthreads',
+                        help='Number of NMSSMTools threads in --pipeline mode',
+                        type=int,
+                        default=1)
+    parser.add_argument('--HBthreads',
+                        help='Number of HiggsBounds threads in --pipeline mode',
+                        type=int,
+                        default=1)
+    parser.add_argument('--HSthreads',
+                        help='Number of HiggsSignals threads in --pipeline mode',
+                        type=int,
+                        default=1)
+    parser.add_argument('--queueSize',
+                        help='Maximum number of points waiting before each '
+                        'stage in --pipeline mode',
+                        type=int,
+                        default=4)
     parser.add_argument("--dry",
                         help="Dry run, don't run programs.",
                         action='store_true')
@@ -72,141 +297,1175 @@ def NMSSMScan(in_args=sys.argv[1:]):
 
     # do some checks
     cu.check_file_exists(args.card)
-    cu.check_file_exists(args.param)
+    if args.param:
+        cu.check_file_exists(args.param)
+    elif not args.points:
+        parser.error('--param is required, unless using --points')
+    if args.points:
+        cu.check_file_exists(args.points)
     if args.number < 1:
         log.error('-n|--number must have an argument >= 1')
+    if args.jobs < 1:
+        log.error('-j|--jobs must have an argument >= 1')
+    if args.pipeline and args.jobs > 1:
+        parser.error('Cannot use both --pipeline and -j|--jobs')
+    if args.mcmc and (args.pipeline or args.jobs > 1):
+        parser.error('Cannot use --mcmc with --pipeline or -j|--jobs')
+    if args.mcmcAdaptSteps < 0:
+        parser.error('--mcmcAdaptSteps must have an argument >= 0')
+    if args.resume and not args.oDir:
+        parser.error('--resume needs --oDir')
+    if args.native and not args.nativeColumns:
+        parser.error('--native needs --nativeColumns')
+    if args.native and (args.mcmc or args.resume):
+        parser.error('Cannot use --native with --mcmc or --resume')
+    if args.points and (args.mcmc or args.native):
+        parser.error('Cannot use --points with --mcmc or --native')
     if not args.oDir:
         # generate output directory if one not specified
         args.oDir = generate_odir()
     cu.check_create_dir(args.oDir, args.v)
 
-    # read template card
-    with open(args.card) as template_file:
-        template = template_file.readlines()
-
-    # read in JSON file with parameters and bounds
-    with open(args.param) as json_file:
-        param_dict = json.load(json_file)
-        # remove any comments
-        rm_keys = []
-        for k in param_dict.iterkeys():
-            if k.startswith('_'):
-                rm_keys.append(k)
-        for k in rm_keys:
-            log.debug('Removing entry %s' % k)
-            del param_dict[k]
+    param_dict, constraints = {}, []
+    if args.param:
+        # read in JSON file with parameters and bounds
+        param_dict, constraints, options = load_param_file(args.param)
+        # sampler settings can also be set in the JSON
+        args.sampler = args.sampler or options.get('_sampler')
+        if args.seed is None:
+            args.seed = options.get('_seed', None)
+    args.sampler = args.sampler or 'random'
+
+    if args.native:
+        if constraints:
+            raise RuntimeError('Cannot use param constraints with --native')
+        run_native_scan(args, param_dict)
+        return
+
+    # settings that must match to resume a scan
+    checkpoint = Checkpoint(os.path.join(args.oDir, 'checkpoint%d.json' % args.batch),
+                            interval=args.checkpointInterval)
+    resume_state = checkpoint.load() if args.resume else None
+    if args.resume and not resume_state:
+        log.warning('No checkpoint %s - starting from scratch', checkpoint.filename)
+    if resume_state and args.seed is None:
+        args.seed = resume_state['settings']['seed']
+    if args.seed is None:
+        # always use a seed, so the points can be regenerated on resume
+        args.seed = np.random.randint(2 ** 31)
+    settings = {'sampler': args.sampler, 'seed': args.seed, 'batch': args.batch,
+                'number': args.number, 'mcmc': args.mcmc,
+                'params': copy.deepcopy(param_dict)}
+    if constraints:
+        settings['constraints'] = constraints
+    if args.mcmc:
+        settings['mcmc_adapt_steps'] = args.mcmcAdaptSteps
+    if args.points:
+        settings['points'] = args.points
+    if resume_state:
+        # round trip through JSON to compare like with like
+        different = [k for k, v in json.loads(json.dumps(settings)).iteritems()
+                     if resume_state['settings'].get(k) != v]
+        if different:
+            raise RuntimeError('Settings %s do not match checkpoint %s'
+                               % (', '.join(sorted(different)), checkpoint.filename))
+        log.info('Resuming from checkpoint %s', checkpoint.filename)
+    else:
+        checkpoint.save(settings=settings, next_index=0, finished=False)
+
+    param_space = None
+    if param_dict:
+        # generate points in the unit hypercube of the free params, then scale to
+        # param ranges & calculate any derived params
+        param_space = ParamSpace(param_dict, constraints)
+        param_names = param_space.names
+    if args.points:
+        # run the points in the file instead, this job taking its own range of rows
+        points_start = args.batch * args.number
+        param_names, points_columns = load_points(args.points, points_start,
+                                                  points_start + args.number,
+                                                  names=param_names if param_space else None)
+        if not param_space:
+            param_names = card_params(args.card, param_names)
+    free_names = param_space.free_names if param_space else param_names
+
+    # parse template card once into text + parameter slots
+    template = CardTemplate.from_file(args.card, param_dict.keys() or param_names)
+
+    tool_dirs = {'NT': args.NT, 'HB': args.HB, 'HS': args.HS}
+    runner = ToolRunner(timeouts={'NMSSMTools': args.NTtimeout,
+                                  'HiggsBounds': args.HBtimeout,
+                                  'HiggsSignals': args.HStimeout})
+
+    surrogate = None
+    if args.surrogate:
+        model = KNNSurrogate.load(args.surrogate)
+        if sorted(model.param_names) != sorted(free_names):
+            raise RuntimeError('Surrogate model params %s do not match scan params %s'
+                               % (model.param_names, free_names))
+        surrogate = SurrogateFilter(model, false_rejection_rate=args.surrogateFRR,
+                                    explore=args.surrogateExplore, seed=args.seed)
+
+    screen = None
+    if args.treeScreen:
+        missing = [k for k in TREE_PARAMS if k not in param_names]
+        if missing:
+            raise RuntimeError('--treeScreen needs params %s in the param file'
+                               % ', '.join(missing))
+        screen = TreeLevelScreen(margin=args.treeMargin)
+
+    cache = None
+    if args.cache and not args.dry:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        patches = (glob.glob(os.path.join(script_dir, 'patches', '*.patch')) +
+                   glob.glob(os.path.join(script_dir, '*.patch')))
+        tag = tool_tag(tool_dirs, patches, args.cacheTag)
+        log.debug('Cache tag: %s', tag)
+        cache = ResultCache(args.cache, tag, max_size=args.cacheSize * 1E9)
+
+    scratch_dir = None
+    if args.scratch and not args.dry:
+        cu.check_dir_exists(args.scratch)
+        scratch_dir = tempfile.mkdtemp(prefix='NMSSMScan_%d_' % args.batch, dir=args.scratch)
+        log.info('Using scratch directory %s', scratch_dir)
+
+    point_log_name = args.pointLog or os.path.join(args.oDir, 'points%d.csv' % args.batch)
+    done = read_point_log(point_log_name) if resume_state else {}
+    if done:
+        log.info('Skipping %d points already done', len(done))
+    point_log = PointLog(point_log_name, param_names + ['weight'], append=bool(resume_state))
+    evaluator = PointEvaluator(template, args, tool_dirs, runner, surrogate=surrogate,
+                               point_log=point_log, cache=cache, scratch_dir=scratch_dir)
+    metrics_name = os.path.join(args.oDir, 'metrics%d.json' % args.batch)
+    if resume_state and resume_state.get('metrics'):
+        # carry on from the last checkpoint. Points finished after it are
+        # in the point log, but missing from the metrics.
+        evaluator.metrics = ScanMetrics.from_json(resume_state['metrics'])
+    if args.shards and not args.dry:
+        if not resume_state:
+            # start afresh, as for the point log
+            for f in glob.glob(shard_stem(args.oDir, args.batch) + '_*.npz'):
+                os.remove(f)
+        evaluator.shards = ShardWriter(shard_stem(args.oDir, args.batch), args.shardSize)
+        if done:
+            recover_shards(evaluator, done)
+    targets = ScanTargets(physical=args.targetPhysical, good=args.targetGood,
+                          filters=[(expr, int(n)) for expr, n in args.targetFilter],
+                          max_time=args.maxTime, max_cpu=args.maxCPU)
+    if targets:
+        evaluator.targets = targets
+        if done:
+            count_done(evaluator, done)
+
+    if args.points:
+        log.info('Running points from %s, batch %d', args.points, args.batch)
+    else:
+        sampler = get_sampler(args.sampler, param_space.n_dims, seed=args.seed)
+        log.info('Using %s sampler, seed %s, batch %d', args.sampler, args.seed, args.batch)
+    unit_points = None
 
     # loop over number of points requested, making an input card for each
+    try:
+        if args.mcmc:
+            num_physical = run_mcmc(param_space, sampler, args, evaluator, checkpoint,
+                                    screen=screen, done=done)
+            evaluator.finish()
+        else:
+            if args.points:
+                points = replay_points(points_columns, param_names, points_start, screen=screen)
+            else:
+                unit_points = sampler.sample(args.number, start=args.batch * args.number)
+                points = generate_points(param_space, unit_points, screen=screen)
+            points = skip_done(points, done, checkpoint, evaluator.metrics)
+            if targets and args.jobs == 1:
+                points = until_targets(points, targets)
+            if args.pipeline and not args.dry:
+                num_physical = run_pipeline(points, evaluator)
+            elif args.jobs > 1:
+                num_physical = run_parallel(points, evaluator)
+            else:
+                num_physical = 0
+                for ind, values in points:
+                    if evaluator.run_point(ind, values):
+                        num_physical += 1
+                evaluator.finish()
+            num_physical += sum(done.values())
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir)
+    evaluator.metrics.stop()
+    checkpoint.save(next_index=args.number, finished=True, metrics=evaluator.metrics.to_json())
+    point_log.close()
+    if not args.dry:
+        evaluator.metrics.write(metrics_name)
+
+    # print some stats
+    print '*' * 40
+    print '* Num iterations:', args.number
+    print '* Num physical:', num_physical
+    if unit_points is not None:
+        print '* Centered L2 discrepancy of %s points: %.5g' % (args.sampler,
+                                                              centered_discrepancy(unit_points))
+    if screen:
+        screen.print_summary()
+    if surrogate:
+        surrogate.print_summary()
+    if cache:
+        cache.print_summary()
+    if evaluator.shards:
+        print '* Points written to shards:', evaluator.n_sharded
+    if targets:
+        targets.print_summary()
+    if evaluator.n_scratch_fallback:
+        print '* Points run in oDir as scratch was full:', evaluator.n_scratch_fallback
+    runner.print_summary()
+    evaluator.metrics.print_summary()
+    print '*' * 40
+
+
+def run_native_scan(args, param_dict):
+    """Run a whole scan in a single NMSSMTools process, using its own scan
+    mode (see native_scan.py), and write the points to results shards."""
+    if args.HB or args.HS or args.jobs > 1 or args.pipeline:
+        log.warning('HiggsBounds, HiggsSignals, -j & --pipeline are ignored with --native')
+    if args.seed is None:
+        args.seed = np.random.randint(1, 2 ** 31)
+    columns = read_columns(args.nativeColumns)
+
+    card_path = os.path.join(args.oDir, 'inp_native%d.dat' % args.batch)
+    with open(args.card) as template_file:
+        card = make_scan_card(template_file.readlines(), param_dict, args.native,
+                              args.number, args.seed)
+    with open(card_path, 'w') as card_file:
+        card_file.write(card)
+    log.info('Running NMSSMTools %s scan of %d points, seed %d',
+             args.native, args.number, args.seed)
+
+    runner = ToolRunner(timeouts={'NMSSMTools': args.NTtimeout})
+    metrics = ScanMetrics()
+    out_path = os.path.join(args.oDir, 'out_native%d.dat' % args.batch)
+    num_points = 0
+    if not args.dry:
+        with metrics.timed('NMSSMTools', n_points=args.number):
+            result = runner.run('NMSSMTools', ['./run', os.path.relpath(card_path, args.NT)],
+                                cwd=args.NT, n_points=args.number)
+        if not result.ok:
+            log.warning('NMSSMTools scan stopped early (return code %d) - only keeping '
+                        'the points written to %s so far', result.returncode, out_path)
+        os.remove(card_path)
+        cu.check_file_exists(out_path)
+
+        # MCMC points aren't independent, so don't get a weight
+        weight = 1. if args.native == 'random' else ''
+        stem = shard_stem(args.oDir, args.batch)
+        for f in glob.glob(stem + '_*.npz'):
+            os.remove(f)
+        shards = ShardWriter(stem, args.shardSize)
+        with metrics.timed('parse', n_points=args.number):
+            for record in iter_scan_output(out_path, columns):
+                shards.add(dict(record, index=num_points, weight=weight))
+                metrics.add_point(True)
+                num_points += 1
+            shards.close()
+        if not args.keepSpectra:
+            os.remove(out_path)
+        metrics.stop()
+        metrics.write(os.path.join(args.oDir, 'metrics%d.json' % args.batch))
+
+    print '*' * 40
+    print '* Num iterations:', args.number
+    print '* Points written to shards:', num_points
+    runner.print_summary()
+    metrics.print_summary()
+    print '*' * 40
+
+
+def generate_points(param_space, unit_points, chunk_size=10000, screen=None):
+    """Generator of (index, {param name: value}) for each point to scan.
+
+    Points are scaled & checked against the constraints in chunks of
+    chunk_size as numpy arrays, and any failing the constraints are skipped.
+
+    param_space : ParamSpace
+        Params to scan.
+    unit_points : numpy.ndarray
+        (n points, n free params) array of points in the unit hypercube,
+        to be scaled to each param's [min, max] range.
+    screen : TreeLevelScreen
+        If set, also skip points it rejects.
+    """
+    n_rejected = 0
+    for start in xrange(0, len(unit_points), chunk_size):
+        columns = param_space.scale(unit_points[start:start + chunk_size])
+        allowed = param_space.allowed(columns)
+        n_rejected += np.count_nonzero(~allowed)
+        if screen:
+            allowed[allowed] = screen.allowed(dict((k, v[allowed])
+                                                   for k, v in columns.iteritems()))
+        for i in np.flatnonzero(allowed):
+            ind = start + i
+
+            if ind % 200 == 0:
+                log.info('Processing %dth point at %s', ind, strftime("%H%M%S"))
+
+            yield ind, param_space.point(columns, i)
+
+    if param_space.constraints:
+        log.info('%d of %d points failed the param constraints', n_rejected, len(unit_points))
+
+
+def replay_points(columns, param_names, start, screen=None):
+    """Generator of (index, {param name: value}) for each point read from a
+    points file, as for generate_points.
+
+    columns : dict
+        Map of param name (& 'weight') to array of values, from
+        point_files.load_points.
+    start : int
+        Index of the first point, i.e. its row in the file.
+    screen : TreeLevelScreen
+        If set, skip points it rejects.
+    """
+    n = len(columns['weight'])
+    allowed = screen.allowed(columns) if screen else np.ones(n, dtype=bool)
+    for i in np.flatnonzero(allowed):
+        ind = start + i
+
+        if ind % 200 == 0:
+            log.info('Processing %dth point at %s', ind, strftime("%H%M%S"))
+
+        yield ind, dict((k, float(columns[k][i])) for k in param_names + ['weight'])
+
+
+def card_params(card, names):
+    """Get the names that match a (not commented out) line in the card"""
+    with open(card) as f:
+        lines = [l for l in f if not l.lstrip().startswith('#')]
+    matched = [k for k in names if any(param_pattern(k).search(l) for l in lines)]
+    ignored = [k for k in names if k not in matched]
+    if ignored:
+        log.info('Ignoring columns not in the card: %s', ', '.join(ignored))
+    return matched
+
+
+def shard_stem(odir, batch, worker_id=None):
+    """Stem of the filenames for results shards"""
+    stem = os.path.join(odir, 'results%d' % batch)
+    if worker_id is not None:
+        stem += '_%d' % worker_id
+    return stem
+
+
+def recover_shards(evaluator, done):
+    """When resuming, add any physical points that were done but didn't
+    make it into a shard before the scan stopped. Their spectrum files
+    are only removed once in a shard, so they can be parsed again."""
+    weights = read_point_log_column(evaluator.point_log.filename, 'weight')
+    in_shards = set()
+    for f in find_shards(shard_stem(evaluator.args.oDir, evaluator.args.batch) + '_*.npz'):
+        in_shards.update(np.load(f)['index'].tolist())
+    for ind, physical in sorted(done.iteritems()):
+        spectr_name = evaluator.spectr_path(ind)
+        if physical and ind not in in_shards and os.path.isfile(spectr_name):
+            log.info('Adding %s to shards', spectr_name)
+            evaluator.add_to_shards(ind, parse_spectrum(spectr_name), weights.get(ind, ''))
+
+
+def done_results(evaluator, done):
+    """When resuming, get the parsed results of the physical points already
+    done, as a dict of {index: results}. Results are taken from the shards,
+    or parsed from any spectrum files still around."""
+    results = {}
+    stem = shard_stem(evaluator.args.oDir, evaluator.args.batch)
+    for record in iter_shard_records(find_shards(stem + '_*.npz')):
+        results[record.pop('index')] = record
+    for ind, physical in sorted(done.iteritems()):
+        spectr_name = evaluator.spectr_path(ind)
+        if physical and ind not in results and os.path.isfile(spectr_name):
+            results[ind] = parse_spectrum(spectr_name)
+    return results
+
+
+def count_done(evaluator, done):
+    """When resuming, count the points already done towards the targets."""
+    results = done_results(evaluator, done) if evaluator.targets.needs_results else {}
+    for ind, physical in sorted(done.iteritems()):
+        evaluator.targets.add(physical, results.get(ind))
+
+
+def skip_done(points, done, checkpoint, metrics):
+    """Generator to skip any points already done, e.g. when resuming.
+
+    Also saves the index of the next point and the metrics so far to the
+    checkpoint periodically.
+
+    points : iterable
+        (index, values) of each point, e.g. from generate_points
+    done : dict
+        Map of index: physical for the points done, from read_point_log
+    checkpoint : Checkpoint
+        Checkpoint to save to.
+    metrics : ScanMetrics
+        Metrics of the scan.
+    """
+    for ind, values in points:
+        if ind in done:
+            continue
+        if checkpoint.due():
+            checkpoint.save(next_index=ind, metrics=metrics.to_json())
+        yield ind, values
+
+
+def run_mcmc(param_space, sampler, args, evaluator, checkpoint, screen=None, done=None):
+    """Scan using an adaptive Metropolis-Hastings Markov chain.
+
+    The chain moves in the free params of param_space. The likelihood for
+    each point comes from its failed constraints, HiggsBounds result and
+    HiggsSignals chi2 (see mcmc.log_likelihood). Points failing the param
+    constraints or rejected by screen (a TreeLevelScreen) have zero
+    likelihood, and aren't run. Points from the
+    sampler are tried until a physical one is found to start the chain.
+
+    The proposal is adapted for the first args.mcmcAdaptSteps steps (the
+    burn-in), then fixed. The burn-in rows of the chain file are marked.
+
+    The state of the chain is saved to checkpoint periodically, and the
+    chain continues from there if the checkpoint already has a state. Points
+    after the checkpoint that are already done (in done, a dict of index:
+    physical from read_point_log) aren't run again: the chain takes their
+    results from the shards or spectrum files instead, so it follows the
+    same path without adding them to the point log & shards twice.
+
+    Returns the number of physical points.
+    """
+    mh = AdaptiveMetropolis(param_space.n_dims, seed=args.seed, width=args.mcmcWidth,
+                            adapt_steps=args.mcmcAdaptSteps)
+    state = checkpoint.state.get('mcmc')
+    chain = ChainWriter(os.path.join(args.oDir, 'chain%d.csv' % args.batch), param_space.names,
+                        resume_state=state['chain'] if state else None, burn_in=mh.adapting)
+
     num_physical = 0
-    for ind in xrange(args.number):
+    current, log_l_current = None, -np.inf
+    start = 0
+    if state:
+        mh.set_state(state['sampler'])
+        if state['current'] is not None:
+            current, log_l_current = np.array(state['current']), state['log_l_current']
+        num_physical = state['num_physical']
+        start = checkpoint.state['next_index']
+        log.info('Resuming chain from point %d', start)
+
+    done = dict((ind, physical) for ind, physical in (done or {}).iteritems() if ind >= start)
+    previous = done_results(evaluator, done) if done else {}
+    missing = [ind for ind, physical in done.iteritems() if physical and ind not in previous]
+    if missing:
+        log.warning('No results for points %s already done - counting them '
+                    'as unphysical in the chain', missing)
+
+    for ind in xrange(start, args.number):
+
+        if evaluator.targets and evaluator.targets.reached():
+            break
+
+        if checkpoint.due():
+            state = {'sampler': mh.get_state(), 'chain': chain.get_state(),
+                     'current': None if current is None else current.tolist(),
+                     'log_l_current': log_l_current, 'num_physical': num_physical}
+            checkpoint.save(next_index=ind, mcmc=state, metrics=evaluator.metrics.to_json())
 
         if ind % 200 == 0:
             log.info('Processing %dth point at %s', ind, strftime("%H%M%S"))
 
-        # generate a random point within the range
-        for v in param_dict.itervalues():
-            v['value'] = random.uniform(v['min'], v['max'])
-
-        # replace values in the card text
-        # eurgh stupid string in python
-        new_card_text = template[:]
-        for i in range(len(new_card_text)):
-            for k, v in param_dict.iteritems():
-                s_match = r'(\s+\d+\s+)[\w.]+(\s+#\s%s.*)' % k
-                s_repl = r'\g<1>' + str(v['value']) + 'D0\g<2>'
-                new_card_text[i] = re.sub(s_match, s_repl, new_card_text[i])
-
-        # write a new card
-        new_card_path = generate_new_card_path(args.oDir, args.card, ind)
-        log.debug('New card: %s' % new_card_path)
-        with open(new_card_path, 'w') as new_card:
-            for line in new_card_text:
-                new_card.write(line)
-
-        base_dir = os.getcwd()
-
-        if args.dry:
+        if current is None:
+            new = sampler.sample(1, start=args.batch * args.number + ind)[0]
+        else:
+            new = mh.propose(current)
+        columns = param_space.scale(new)
+        values = param_space.point(columns, 0)
+
+        log_l_new = -np.inf
+        spectr_name = evaluator.spectr_path(ind)
+        allowed = param_space.allowed(columns)[0] and (not screen or screen.allowed(columns)[0])
+        if ind in done:
+            if done[ind]:
+                num_physical += 1
+                log_l_new = log_likelihood(previous.get(ind), args.mcmcPenalty)
+        elif allowed and evaluator.run_point(ind, values):
+            num_physical += 1
+            log_l_new = log_likelihood(evaluator.last_results, args.mcmcPenalty)
+
+        if current is None:
+            # still looking for a starting point
+            if log_l_new > -np.inf:
+                current, log_l_current = new, log_l_new
+                chain.add(values, log_l_new, spectr_name)
             continue
 
-        # Run your tools!
-        # --------------------------------------------------------------------
-        # run NMSSMTools with the new card
+        if mh.accept(log_l_current, log_l_new):
+            current, log_l_current = new, log_l_new
+            chain.add(values, log_l_new, spectr_name)
+        else:
+            chain.stay()
+        mh.record(current)
+        if chain.burn_in and not mh.adapting:
+            chain.end_burn_in()
+
+    chain.close()
+    checkpoint.save(mcmc=None)
+    print '* MCMC acceptance rate: %.3f' % mh.acceptance_rate
+    print '* MCMC burn-in steps: %d of %d' % (min(mh.n_steps, mh.adapt_steps), mh.n_steps)
+    return num_physical
+
+
+class PointEvaluator(object):
+    """Make the input card for each point and run the tools over it.
+
+    template : CardTemplate
+        Template to make input cards from.
+    args : argparse.Namespace
+        Program args.
+    tool_dirs : dict
+        Directories to run NMSSMTools, HiggsBounds & HiggsSignals in,
+        with keys 'NT', 'HB', 'HS'.
+    runner : ToolRunner
+        Used to run the programs.
+
+    surrogate : SurrogateFilter
+        If set, used to skip points before running anything.
+    point_log : PointLog
+        If set, every point run is logged to it, once all the programs
+        have finished with it.
+    cache : ResultCache
+        If set, results are taken from here if available, and new results
+        are stored in it.
+    scratch_dir : str
+        If set, cards & spectra are made here (e.g. on a RAM disk), and
+        physical spectra moved to args.oDir once finished. args.oDir is used
+        instead if it has less than args.scratchMinFree MB free.
+
+    The time taken by each step, and the SPINFO failures of each point, are
+    counted in the metrics attribute, a ScanMetrics.
+
+    If the shards attribute is set to a ShardWriter, the results of each
+    physical point are parsed and added to it. With --mcmc, the results are
+    always parsed, to calculate the likelihood. If the targets attribute is
+    set to a ScanTargets, each point finished is counted towards it.
+
+    Call finish() after the last point to write out any results waiting
+    for a shard.
+
+    The individual steps are also available as methods, so they can be
+    run as separate stages in a pipeline.
+    """
+    def __init__(self, template, args, tool_dirs, runner, surrogate=None, point_log=None,
+                 cache=None, scratch_dir=None):
+        self.template = template
+        self.args = args
+        self.tool_dirs = tool_dirs
+        self.runner = runner
+        self.surrogate = surrogate
+        self.point_log = point_log
+        self.cache = cache
+        self.scratch_dir = scratch_dir
+        self.n_scratch_fallback = 0  # points run in oDir as scratch was full
+        self.shards = None
+        self.n_sharded = 0
+        self.last_results = None  # parsed results of the last point finished
+        self.targets = None
+        self.finished = None  # (physical, results) of points finished, for a worker's targets
+        self.parse_results = bool(args.mcmc or args.targetGood or args.targetFilter)
+        self.metrics = ScanMetrics()
+
+    def copy(self, tool_dirs, worker_id):
+        """Make a copy of this evaluator for a worker process, that runs in
+        different tool directories and writes its own shards."""
+        new = copy.copy(self)
+        new.tool_dirs = tool_dirs
+        new.metrics = ScanMetrics()
+        if self.targets:
+            # counted in the main process instead
+            new.targets = None
+            new.finished = []
+        if self.shards:
+            new.shards = ShardWriter(shard_stem(self.args.oDir, self.args.batch, worker_id),
+                                     self.shards.chunk_size)
+        return new
+
+    def run_point(self, ind, values):
+        """Run one point. Returns True if it was physical, False otherwise.
+
+        ind : int
+            Index of point, used to make unique filenames.
+        values : dict
+            Map of param name to value for this point.
+        """
+        decision = self.prefilter(ind, values)
+        if decision == 'reject':
+            return False
+
+        cache_key, cached = self.lookup_cache(ind, values)
+        record = (ind, values, decision == 'explore', cache_key)
+        if cached:
+            self.finish_point(record, cached['physical'], cached=cached)
+            return cached['physical']
+
+        new_card_path = self.make_card(ind, values)
+
+        if self.args.dry:
+            return False
+
+        spectr_name = self.run_nmssmtools(new_card_path)
+        if spectr_name is None:
+            self.finish_point(record, physical=False, failed='NMSSMTools')
+            return False
+        if not self.check_spectrum(spectr_name):
+            self.finish_point(record, physical=False)
+            return False
+
+        # run HiggsBounds and HiggsSignals
+        if self.args.HB and not self.run_higgsbounds(spectr_name):
+            self.finish_point(record, physical=False, spectr_name=spectr_name,
+                              failed='HiggsBounds')
+            return False
+        if self.args.HS and not self.run_higgssignals(spectr_name):
+            self.finish_point(record, physical=False, spectr_name=spectr_name,
+                              failed='HiggsSignals')
+            return False
+
+        self.finish_point(record, physical=True, spectr_name=spectr_name)
+
+        if self.args.sushi:
+            pass
+            # sushi_cmds = ['./sushi', input, output]
+            # self.runner.run('SusHi', sushi_cmds, cwd=os.path.join(args.sushi, 'bin'))
+
+        return True
+
+    def prefilter(self, ind, values):
+        """Ask the surrogate model whether to run this point.
+
+        Returns 'accept', 'explore' or 'reject' (see SurrogateFilter.decide).
+        """
+        if not self.surrogate:
+            return 'accept'
+        return self.surrogate.decide(ind, values)
+
+    def lookup_cache(self, ind, values):
+        """Look up a point in the cache. If found, its spectrum file is
+        put where it would be if the programs had been run.
+
+        Returns the cache key for the point, and the cached record (None if
+        not found). Both are None if there is no cache.
+        """
+        if not self.cache:
+            return None, None
+        with self.metrics.timed('io'):
+            key = self.cache.key(self.template.render(values))
+            return key, self.cache.get(key, self.spectr_path(ind))
+
+    def finish_point(self, record, physical, spectr_name=None, cached=None, failed=None):
+        """Move a physical spectrum from scratch to its final place, add the
+        point to the point log, store its results in the cache, parse its
+        results for the shards, and count it towards the targets.
+
+        record : tuple
+            (index, values, explored, cache key) of the point
+        spectr_name : str
+            Spectrum file of a physical point, if not already in its final place.
+        cached : dict
+            Cache entry, if the point was found in the cache.
+        failed : str
+            Name of the program that failed or timed out on the point, if
+            any. Its files are removed, and it is counted as un-physical,
+            but not logged, cached or sharded, so it is run again if the
+            scan is resumed.
+        """
+        ind, values, explored, cache_key = record
+        if failed:
+            if spectr_name:
+                remove_spectrum(spectr_name)
+            self.metrics.add_failures(['%s failed' % failed])
+            self.last_results = None
+            self.count_point(False, None)
+            return
+
+        final_name = self.spectr_path(ind)
+        if physical and spectr_name and spectr_name != final_name:
+            with self.metrics.timed('io'):
+                shutil.move(spectr_name, final_name)
+                omega_name = spectr_name.replace('spectr', 'omega')
+                if os.path.isfile(omega_name):
+                    shutil.move(omega_name, final_name.replace('spectr', 'omega'))
+
+        results = None
+        if physical and (self.shards or self.parse_results):
+            results = cached.get('results') if cached else None
+            if results is None:
+                with self.metrics.timed('parse'):
+                    results = parse_spectrum(final_name)
+            else:
+                results['file'] = final_name
+        self.last_results = results
+
+        with self.metrics.timed('io'):
+            if self.point_log:
+                self.point_log.write(ind, values, physical, explored)
+            if self.cache and not cached:
+                entry = {'physical': physical}
+                if results is not None:
+                    entry['results'] = results
+                self.cache.put(cache_key, entry, final_name if physical else None)
+            if self.shards and results is not None:
+                self.add_to_shards(ind, results, values.get('weight', ''))
+        self.count_point(physical, results)
+
+    def count_point(self, physical, results):
+        """Count a finished point in the metrics & towards the targets"""
+        self.metrics.add_point(physical)
+        if self.targets:
+            self.targets.add(physical, results)
+        if self.finished is not None:
+            self.finished.append((physical, results if self.parse_results else None))
+
+    def add_to_shards(self, ind, results, weight=''):
+        """Add the parsed results & weight for point ind to the shards. Unless
+        keeping spectra, its files are removed once the shard is written."""
+        if results is None:
+            return
+        files = []
+        if not self.args.keepSpectra:
+            spectr_name = self.spectr_path(ind)
+            files = [spectr_name, spectr_name.replace('spectr', 'omega')]
+        self.shards.add(dict(results, index=ind, weight=weight), files)
+        self.n_sharded += 1
+
+    def spectr_path(self, ind):
+        """Final filepath of the spectrum file for point ind"""
+        return generate_new_card_path(self.args.oDir, self.args.card, ind).replace('inp', 'spectr')
+
+    def work_dir(self):
+        """Directory to make the files for a new point in: the scratch
+        directory if set & it has enough room, otherwise oDir."""
+        if not self.scratch_dir:
+            return self.args.oDir
+        free = cu.free_space(self.scratch_dir)
+        memory = cu.available_memory()
+        if memory is not None:
+            free = min(free, memory)
+        if free < self.args.scratchMinFree * 1E6:
+            if self.n_scratch_fallback == 0:
+                log.warning('Only %.0f MB free in %s, using %s instead',
+                            free / 1E6, self.scratch_dir, self.args.oDir)
+            self.n_scratch_fallback += 1
+            return self.args.oDir
+        return self.scratch_dir
+
+    def make_card(self, ind, values):
+        """Write a new input card, and return its filepath."""
+        with self.metrics.timed('card'):
+            new_card_path = generate_new_card_path(self.work_dir(), self.args.card, ind)
+            log.debug('New card: %s' % new_card_path)
+            self.template.write(new_card_path, values)
+        return new_card_path
+
+    def run_nmssmtools(self, new_card_path, nt_dir=None):
+        """Run NMSSMTools over an input card, then delete the card.
+
+        Returns the filepath of the spectrum file it should have produced,
+        or None if NMSSMTools failed or timed out. nt_dir overrides the NMSSMTools directory to run in.
+        """
+        nt_dir = nt_dir or self.tool_dirs['NT']
         # NMSSMTools requires relpath NOT abspath!
-        os.chdir(args.NT)
-        ntools_cmds = ['./run', os.path.relpath(new_card_path)]
-        log.debug(ntools_cmds)
-        call(ntools_cmds)
-        os.chdir(base_dir)
+        ntools_cmds = ['./run', os.path.relpath(new_card_path, nt_dir)]
+        with self.metrics.timed('NMSSMTools'):
+            result = self.runner.run('NMSSMTools', ntools_cmds, cwd=nt_dir)
 
         # Delete input card - not needed any more
         os.remove(new_card_path)
 
         spectr_name = new_card_path.replace('inp', 'spectr')
-        omega_name = new_card_path.replace('inp', 'omega')
+        if not check_result(result, new_card_path):
+            # may have left a partial spectrum behind
+            remove_spectrum(spectr_name)
+            return None
+        return spectr_name
+
+    def check_spectrum(self, spectr_name):
+        """Check the spectrum file exists and is physical, deleting it if not.
+
+        If OK, adds the DMASS block needed for HB/HS, and returns True.
+        """
+        with self.metrics.timed('check'):
+            return self._check_spectrum(spectr_name)
+
+    def _check_spectrum(self, spectr_name):
+        omega_name = spectr_name.replace('spectr', 'omega')
         if not os.path.isfile(spectr_name):
             print 'File %s not produced - skipping' % spectr_name
-            continue
+            self.metrics.add_failures(['No spectrum file produced'])
+            return False
+
+        # read once for both the SPINFO failures & the physical check
+        with open(spectr_name) as f:
+            contents = f.read()
+        failures = []
+        SPINFO_PLAN.parse(spectr_name, contents.splitlines(True), failures)
+        self.metrics.add_failures(failures)
 
-        if not check_if_physical(spectr_name):
+        if not check_if_physical(spectr_name, contents):
             print 'Removing %s as unphysical' % spectr_name
             os.remove(spectr_name)
             os.remove(omega_name)
-            continue
-
-        num_physical += 1
+            return False
 
-        if args.HB or args.HS:
+        if self.args.HB or self.args.HS:
             # need to add in DMASS block for HB/HS
             # this is somewhat aribitrary
             add_dmass_block(spectr=spectr_name, dmh1=2, dmh2=2)
 
-        # run HiggsBounds and HiggsSignals
-        if args.HB:
-            os.chdir(args.HB)
-            hb_cmds = ['./HiggsBounds', 'LandH', 'SLHA', '5', '1', os.path.relpath(spectr_name)]
-            log.debug(hb_cmds)
-            call(hb_cmds)
-            os.chdir(base_dir)
-
-        if args.HS:
-            os.chdir(args.HS)
-            hs_cmds = ['./HiggsSignals', 'latestresults', 'peak', '2', 'SLHA', '5', '1', os.path.relpath(spectr_name)]
-            log.debug(hs_cmds)
-            call(hs_cmds)
-            os.chdir(base_dir)
-
-        if args.sushi:
-            pass
-            # os.chdir(args.sushi, 'bin'))
-            # sushi_cmds = ['./sushi', input, output]
-            # log.debug(sushi_cmds)
-            # call(sushi_cmds)
-            # os.chidr(base_dir)
+        return True
 
-    # print some stats
-    print '*' * 40
-    print '* Num iterations:', args.number
-    print '* Num physical:', num_physical
-    print '*' * 40
+    def run_higgsbounds(self, spectr_name, hb_dir=None):
+        """Run HiggsBounds over a spectrum file, which has its results appended.
+        Returns False if HiggsBounds failed or timed out.
 
+        hb_dir overrides the HiggsBounds directory to run in.
+        """
+        hb_dir = hb_dir or self.tool_dirs['HB']
+        hb_cmds = ['./HiggsBounds', 'LandH', 'SLHA', '5', '1',
+                   os.path.relpath(spectr_name, hb_dir)]
+        with self.metrics.timed('HiggsBounds'):
+            result = self.runner.run('HiggsBounds', hb_cmds, cwd=hb_dir)
+        return check_result(result, spectr_name)
 
-def check_if_physical(spectr):
-    with open(spectr) as f:
-        contents = f.read()
-        constraints = [
-            'M_A1^2<1',
-            'M_H1^2<1',
-            'M_HC^2<1',
-            'Negative sfermion mass squared',
-            'Disallowed parameters: lambda or tan(beta)=0',
-            'Integration problem in RGES',
-            'Integration problem in RGESOFT',
-            'Convergence Problem']
-        if any((x in contents for x in constraints)):
-            return False
+    def run_higgssignals(self, spectr_name, hs_dir=None):
+        """Run HiggsSignals over a spectrum file, which has its results appended.
+        Returns False if HiggsSignals failed or timed out.
+
+        hs_dir overrides the HiggsSignals directory to run in.
+        """
+        hs_dir = hs_dir or self.tool_dirs['HS']
+        hs_cmds = ['./HiggsSignals', 'latestresults', 'peak', '2', 'SLHA', '5', '1',
+                   os.path.relpath(spectr_name, hs_dir)]
+        with self.metrics.timed('HiggsSignals'):
+            result = self.runner.run('HiggsSignals', hs_cmds, cwd=hs_dir)
+        return check_result(result, spectr_name)
+
+    def finish(self):
+        """Write out any results waiting for a shard."""
+        if self.shards:
+            self.shards.flush()
+
+
+def run_pipeline(points, evaluator):
+    """Run points through a pipeline of stages, so the different programs
+    can run at the same time on different points:
+
+    card -> NMSSMTools -> filter -> HiggsBounds -> HiggsSignals -> log
+
+    Stages with more than one thread get a scratch copy of their tool
+    directory per thread. Returns the number of physical points.
+    """
+    args, tool_dirs = evaluator.args, evaluator.tool_dirs
+    scratch_base = evaluator.scratch_dir or args.oDir
+
+    def thread_dirs(key, n_threads):
+        """Directories for each thread of a stage to run tool key in"""
+        if n_threads == 1:
+            return [tool_dirs[key]]
+        return [make_worker_dirs({key: tool_dirs[key]}, scratch_base, i)[key]
+                for i in xrange(n_threads)]
+
+    nt_dirs = thread_dirs('NT', args.NTthreads)
+
+    # physical points found in the cache, which skip the other stages
+    num_cached_physical = [0]
+
+    # items passed between stages are (record, filename), where record is
+    # (index, values, explored, cache key) as for PointEvaluator.finish_point
+    def card_stage(point, thread_id):
+        ind, values = point
+        decision = evaluator.prefilter(ind, values)
+        if decision == 'reject':
+            return None
+        cache_key, cached = evaluator.lookup_cache(ind, values)
+        record = (ind, values, decision == 'explore', cache_key)
+        if cached:
+            evaluator.finish_point(record, cached['physical'], cached=cached)
+            num_cached_physical[0] += int(cached['physical'])
+            return None
+        return record, evaluator.make_card(ind, values)
+
+    def nt_stage(item, thread_id):
+        record, card = item
+        spectr_name = evaluator.run_nmssmtools(card, nt_dirs[thread_id])
+        if spectr_name is None:
+            evaluator.finish_point(record, physical=False, failed='NMSSMTools')
+            return None
+        return record, spectr_name
+
+    def filter_stage(item, thread_id):
+        record, spectr_name = item
+        if evaluator.check_spectrum(spectr_name):
+            return item
+        evaluator.finish_point(record, physical=False)
+        return None
+
+    stages = [Stage('card', card_stage, 1),
+              Stage('NMSSMTools', nt_stage, args.NTthreads),
+              Stage('filter', filter_stage, 1)]
+
+    if args.HB:
+        hb_dirs = thread_dirs('HB', args.HBthreads)
+
+        def hb_stage(item, thread_id):
+            if evaluator.run_higgsbounds(item[1], hb_dir=hb_dirs[thread_id]):
+                return item
+            evaluator.finish_point(item[0], physical=False, spectr_name=item[1],
+                                   failed='HiggsBounds')
+            return None
+
+        stages.append(Stage('HiggsBounds', hb_stage, args.HBthreads))
+
+    if args.HS:
+        hs_dirs = thread_dirs('HS', args.HSthreads)
+
+        def hs_stage(item, thread_id):
+            if evaluator.run_higgssignals(item[1], hs_dir=hs_dirs[thread_id]):
+                return item
+            evaluator.finish_point(item[0], physical=False, spectr_name=item[1],
+                                   failed='HiggsSignals')
+            return None
+
+        stages.append(Stage('HiggsSignals', hs_stage, args.HSthreads))
+
+    def log_stage(item, thread_id):
+        evaluator.finish_point(item[0], physical=True, spectr_name=item[1])
+        return item
+
+    stages.append(Stage('log', log_stage, 1))
+
+    pipeline = Pipeline(stages, maxsize=args.queueSize)
+    pipeline.run(points)
+    evaluator.finish()
+    pipeline.print_summary()
+
+    for i in xrange(max(args.NTthreads, args.HBthreads, args.HSthreads)):
+        if os.path.isdir(worker_scratch_dir(scratch_base, i)):
+            shutil.rmtree(worker_scratch_dir(scratch_base, i))
+
+    return pipeline.stats[-1].n_out + num_cached_physical[0]
+
+
+def run_parallel(points, evaluator):
+    """Run points over args.jobs worker processes, each with its own
+    scratch copy of the tool directories.
+
+    Workers take points from a shared queue, so a slow point doesn't hold up
+    the others. Each worker's metrics are merged back into evaluator as its
+    points finish, so they are in the checkpoints, and its other stats at
+    the end. Returns the number of physical points.
+
+    If evaluator.targets is set, points finished are counted as they come
+    back, and no more points are handed out once the targets are reached.
+
+    If a worker dies (e.g. killed for using too much memory), its point
+    will never come back, so the other workers are stopped and a
+    RuntimeError raised rather than waiting forever.
+    """
+    args = evaluator.args
+    scratch_base = evaluator.scratch_dir or args.oDir
+    point_queue = multiprocessing.Queue(maxsize=2 * args.jobs)
+    result_queue = multiprocessing.Queue()
+    stats_queue = multiprocessing.Queue()
+
+    workers = []
+    for worker_id in xrange(args.jobs):
+        worker_dirs = make_worker_dirs(evaluator.tool_dirs, scratch_base, worker_id)
+        w = multiprocessing.Process(target=scan_worker,
+                                    args=(point_queue, result_queue, stats_queue,
+                                          evaluator.copy(worker_dirs, worker_id), worker_id))
+        w.start()
+        workers.append(w)
+
+    # CPU time used by each worker so far
+    worker_cpu = [0.] * args.jobs
+    num_physical = 0
+    n_points = 0
+    n_done = 0
+
+    def workers_lost():
+        """Whether a worker has died, or all of them have exited"""
+        return (any(w.exitcode not in (None, 0) for w in workers) or
+                not any(w.is_alive() for w in workers))
+
+    def stop_workers():
+        exitcodes = [w.exitcode for w in workers]
+        for w in workers:
+            w.terminate()
+            w.join()
+        raise RuntimeError('Lost the scan workers with points still to do, '
+                           'exit codes: %s' % exitcodes)
+
+    def get(queue):
+        """Get from a queue filled by the workers, checking they are alive"""
+        while True:
+            # check before waiting, so anything a worker put before it
+            # exited is still read
+            lost = workers_lost()
+            try:
+                return queue.get(timeout=WORKER_POLL)
+            except Queue.Empty:
+                if lost:
+                    stop_workers()
+
+    def put(item):
+        """Put a point on the queue for the workers, checking they are alive"""
+        while True:
+            try:
+                return point_queue.put(item, timeout=WORKER_POLL)
+            except Queue.Full:
+                if workers_lost():
+                    stop_workers()
+
+    def collect(block=True):
+        """Get the result of a point, and count any points finished"""
+        if block:
+            physical, finished, worker_id, cpu, metrics = get(result_queue)
+        else:
+            physical, finished, worker_id, cpu, metrics = result_queue.get(False)
+        worker_cpu[worker_id] = cpu
+        for item in finished or []:
+            evaluator.targets.add(*item)
+        evaluator.metrics.merge(ScanMetrics.from_json(metrics))
+        return physical
+
+    for ind, values in points:
+        # count the points finished so far, for the checkpoint & to see if
+        # we can stop
+        while n_done < n_points:
+            try:
+                num_physical += collect(block=False)
+            except Queue.Empty:
+                break
+            n_done += 1
+        if evaluator.targets and evaluator.targets.reached(sum(worker_cpu)):
+            # take back any points not started yet
+            while True:
+                try:
+                    point_queue.get(timeout=0.1)
+                except Queue.Empty:
+                    break
+                n_points -= 1
+            break
+        put((ind, values))
+        n_points += 1
+    for _ in workers:
+        put(None)  # tell each worker to stop
+
+    num_physical += sum(collect() for _ in xrange(n_points - n_done))
+    for _ in workers:
+        (tool_stats, surrogate_stats, cache_stats,
+         n_scratch_fallback, n_sharded, finished, metrics) = get(stats_queue)
+        for item in finished or []:
+            evaluator.targets.add(*item)
+        evaluator.n_scratch_fallback += n_scratch_fallback
+        evaluator.n_sharded += n_sharded
+        evaluator.runner.merge(tool_stats)
+        evaluator.metrics.merge(ScanMetrics.from_json(metrics))
+        if evaluator.surrogate:
+            evaluator.surrogate.merge(surrogate_stats)
+        if evaluator.cache:
+            evaluator.cache.stats.merge(cache_stats)
+
+    for w in workers:
+        w.join()
+    for worker_id in xrange(args.jobs):
+        shutil.rmtree(worker_scratch_dir(scratch_base, worker_id))
+
+    return num_physical
+
+
+def scan_worker(point_queue, result_queue, stats_queue, evaluator, worker_id):
+    """Worker process for run_parallel: run points from point_queue until
+    it gets None. For each point, puts whether it was physical, the
+    (physical, results) of any points finished since (for the targets), the
+    worker_id, the CPU time used by this worker so far, and the metrics of
+    the point (as JSON) onto result_queue.
+    Finally puts this worker's tool, surrogate & cache stats, the numbers
+    of points that couldn't use the scratch directory & that were written to
+    shards, any points finished since the last result, and its metrics (as
+    JSON), onto stats_queue."""
+    for ind, values in iter(point_queue.get, None):
+        try:
+            physical = evaluator.run_point(ind, values)
+        except Exception:
+            log.exception('Error running point %d', ind)
+            physical = False
+        finished = evaluator.finished
+        if finished is not None:
+            evaluator.finished = []
+        metrics, evaluator.metrics = evaluator.metrics, ScanMetrics()
+        result_queue.put((physical, finished, worker_id, sum(os.times()[:4]),
+                          metrics.to_json()))
+    try:
+        evaluator.finish()
+    except Exception:
+        log.exception('Error writing out the last shard')
+    surrogate_stats = evaluator.surrogate.stats() if evaluator.surrogate else None
+    cache_stats = evaluator.cache.stats if evaluator.cache else None
+    stats_queue.put((evaluator.runner.stats, surrogate_stats, cache_stats,
+                     evaluator.n_scratch_fallback, evaluator.n_sharded, evaluator.finished,
+                     evaluator.metrics.to_json()))
+
+
+def worker_scratch_dir(odir, worker_id):
+    """Scratch directory for a worker's copies of the tool directories."""
+    return os.path.join(odir, 'scratch_worker%d' % worker_id)
+
+
+def make_worker_dirs(tool_dirs, odir, worker_id):
+    """Make scratch copies of the tool directories for one worker.
+
+    Returns a dict like tool_dirs, but pointing to the scratch copies.
+    """
+    scratch = worker_scratch_dir(odir, worker_id)
+    worker_dirs = {}
+    for k, d in tool_dirs.iteritems():
+        if not d:
+            worker_dirs[k] = d
+            continue
+        worker_dirs[k] = os.path.join(scratch, os.path.basename(os.path.normpath(d)))
+        cu.make_scratch_tree(d, worker_dirs[k])
+    return worker_dirs
+
+
+def check_if_physical(spectr, contents=None):
+    """contents is the contents of the spectrum file, if already read"""
+    if contents is None:
+        with open(spectr) as f:
+            contents = f.read()
+    constraints = [
+        'M_A1^2<1',
+        'M_H1^2<1',
+        'M_HC^2<1',
+        'Negative sfermion mass squared',
+        'Disallowed parameters: lambda or tan(beta)=0',
+        'Integration problem in RGES',
+        'Integration problem in RGESOFT',
+        'Convergence Problem']
+    if any((x in contents for x in constraints)):
+        return False
     return True
 
 
+def remove_spectrum(spectr):
+    """Remove a spectrum file & its omega file, if they exist."""
+    for filename in [spectr, spectr.replace('spectr', 'omega')]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
 def add_dmass_block(spectr, dmh1=2, dmh2=2):
     """Add DMASS block to spectrum file so can be used with
     HiggsBounds/HiggsSignals correctly.
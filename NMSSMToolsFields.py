@@ -1,6 +1,10 @@
 """Declare all the fields & associated regexes you want for pulling info from NMSSMTools spectrum file
 
 Use ([E\d\.\-\+]+) to capture a floating-point number group.
+
+Fields can also be declared by block & index instead of a regex, e.g.
+Field(block='EXTPAR', name="lambda", type=float, index=(61,), comment='LAMBDA')
+for the line "61 <value> # LAMBDA" (see slha_parser.py).
 """
 
 
@@ -8,16 +12,20 @@ import re
 
 
 class Field(object):
-    def __init__(self, block, regex, name, type, comment):
+    def __init__(self, block, regex=None, name=None, type=float, comment=None, index=None):
         self.block = block
         self.regex = regex
         self.name = name
         self.type = type
+        # indices of the line, for fields declared by index instead of regex
+        self.index = index
         # comment field is to make parsing MUCH quicker by looking for a
         # key phrase on the line instead of always regex-ing
         # we generate this automatically using the regex pattern if one is
         # not specified
-        if comment == '' or comment is None:
+        if regex is None:
+          self.comment = comment or None
+        elif comment == '' or comment is None:
           self.comment = regex.pattern.split('#')[1].replace('\\', '')
         else:
           self.comment = comment
@@ -2,8 +2,8 @@
 """
 Script to run over output from NMSSMTools, etc, and pull relevant info.
 
-The relevant info from ALL spectrum files in the input directory is put into
-some CSV files:
+The relevant info from ALL spectrum files in the input directory (or .tgz
+archive of spectrum files, read without extracting) is put into some CSV files:
 - all points
 - all points passing all constraints except g-2 (must have +ve contribution)
 and relic density
@@ -17,8 +17,17 @@ import argparse
 import logging
 import glob
 import re
-from collections import defaultdict
+import fnmatch
+import tarfile
+import contextlib
+import numpy as np
+from itertools import islice
+from collections import OrderedDict
+from multiprocessing import Pool
 import NMSSMToolsFields, SuperIsoFields, NMSSMCalcFields, HiggsBoundsSignalsFields
+from slha_parser import ParsePlan, constraint_message
+from result_shards import find_shards, iter_shard_records
+from scan_log import read_point_log_column
 from time import strftime
 
 
@@ -28,6 +37,9 @@ log = logging.getLogger(__name__)
 # fileextension for output files - may need to be used in further processing
 OFMT = 'csv'
 
+# number of spectrum files each worker process parses at a time (--workers)
+CHUNK_SIZE = 200
+
 
 class AnalysisParser(argparse.ArgumentParser):
     """Class to handle arg parsing"""
@@ -37,7 +49,10 @@ class AnalysisParser(argparse.ArgumentParser):
 
     def add_arguments(self):
         self.add_argument('input',
-                          help='Directory with sample names and locations')
+                          help='Directory with sample names and locations, '
+                          'or .tgz archive of spectrum files (and SuperIso/NMSSMCalc '
+                          'output files). With --shards, a directory of shards or a '
+                          'glob pattern for them, e.g. "results3_*.npz" for one job')
         self.add_argument('--oDir',
                           help='Output directory for files. If one is not '
                           'specified, uses $PWD.',
@@ -51,9 +66,21 @@ class AnalysisParser(argparse.ArgumentParser):
         self.add_argument('--nmssmcalc',
                           help='Include NMSSMCalc output files',
                           action='store_true')
+        self.add_argument('--shards',
+                          help='Read results from the shards made by NMSSMScan.py '
+                          '--shards (results*.npz) instead of spectrum files',
+                          action='store_true')
+        self.add_argument('--pointLog',
+                          help='Point log from NMSSMScan.py (points<batch>.csv), '
+                          'to add the weight of each point to the output. '
+                          'Shards already include the weights.')
         self.add_argument('-n',
                           help='Number of files to run over (default is all)',
                           type=int)
+        self.add_argument('--workers',
+                          help='Number of processes to parse spectrum files with. '
+                          'The output is the same as with 1.',
+                          type=int, default=1)
         # Some generic script options
         self.add_argument("-v",
                           help="Display debug messages.",
@@ -74,18 +101,34 @@ def analyse_scans(in_args=sys.argv[1:]):
     # ------------------------------------------------------------------------
     check_create_dir(args.oDir)
 
-    num_spectr_files = len(glob.glob(os.path.join(args.input, 'spectr_*')))
+    if args.shards:
+        if args.superiso or args.nmssmcalc:
+            log.warning('Cannot include SuperIso/NMSSMCalc output with shards - will not analyse.')
+            args.superiso = args.nmssmcalc = False
+        if os.path.isdir(args.input):
+            shards = find_shards(os.path.join(args.input, 'results*.npz'))
+        else:
+            shards = find_shards(args.input)
+        if not shards:
+            raise IOError('No shards found for %s' % args.input)
+        num_spectr_files = sum(shard_length(s) for s in shards)
+    elif is_archive(args.input):
+        # counted as the archive is read, rather than decompressing it twice.
+        # Points without their SuperIso/NMSSMCalc output are skipped then.
+        num_spectr_files = None
+    else:
+        num_spectr_files = len(glob.glob(os.path.join(args.input, 'spectr_*')))
     if not args.n:
         args.n = num_spectr_files
 
     # Figure out if we are also including SuperIso output
-    if args.superiso:
+    if args.superiso and num_spectr_files is not None:
         if len(glob.glob(os.path.join(args.input, 'superiso_*'))) != num_spectr_files:
             args.superiso = False
             log.warning('Not enough SuperIso output files - will not analyse.')
 
     # Figure out if we are also including NMSSMCalc output
-    if args.nmssmcalc:
+    if args.nmssmcalc and num_spectr_files is not None:
         if len(glob.glob(os.path.join(args.input, 'nmssmcalc_*'))) != num_spectr_files:
             args.nmssmcalc = False
             log.warning('Not enough NMSSMCalc output files - will not analyse.')
@@ -113,46 +156,14 @@ def analyse_scans(in_args=sys.argv[1:]):
 
         columns = []  # to hold column order - important as dict not sorted
 
-        # Loop through each spectrum file
-        for i, spectr in enumerate(glob.iglob(os.path.join(args.input, 'spectr_*.dat'))):
-
-            if i % 100 == 0:
-                log.info('Parsing %dth file at %s', i, strftime("%H%M%S"))
-
-            if i == args.n:
-                break
-
-            log.debug('Parsing %s', spectr)
-
-            # Look for failing constraints.
-            # If un-physical point (M_H^2 < 1 or M_A^2 < 1), skips file.
-            nmssmtools_constraints = get_nmssmtools_constraints(spectr)
-            if isinstance(nmssmtools_constraints, type(None)):
-                continue
+        if args.shards:
+            all_results = shard_results(shards, args)
+        else:
+            n_read = [0]
+            all_results = spectrum_results(args, n_read)
 
-            dict_fields = (NMSSMToolsFields.nmssmtools_fields +
-                           HiggsBoundsSignalsFields.higgsbounds_fields +
-                           HiggsBoundsSignalsFields.higgssignals_fields)
-            results_dict = get_slha_dict(spectr, dict_fields)
-            # need joiner as CSV file
-            results_dict['constraints'] = '|'.join(nmssmtools_constraints)
-            # log.debug(results_dict)
-
-            if args.superiso:
-                # Get matching SuperIso output file and parse
-                superiso = os.path.basename(spectr.replace("spectr", "superiso"))
-                superiso = os.path.join(os.path.dirname(spectr), superiso)
-                superiso_dict = get_slha_dict(superiso, SuperIsoFields.superiso_fields)
-                results_dict.update(superiso_dict)
-                log.debug(superiso_dict)
-
-            if args.nmssmcalc:
-                # Get matching NMSSMCalc output file and parse
-                nmssmcalc = os.path.basename(spectr.replace("spectr", "nmssmcalc"))
-                nmssmcalc = os.path.join(os.path.dirname(spectr), nmssmcalc)
-                nmssmcalc_dict = get_slha_dict(nmssmcalc, NMSSMCalcFields.nmssmcalc_fields)
-                results_dict.update(nmssmcalc_dict)
-                log.debug(nmssmcalc_dict)
+        # Loop through the results for each point
+        for results_dict in all_results:
 
             # First time, write out column headers
             if not done_cols:
@@ -182,6 +193,9 @@ def analyse_scans(in_args=sys.argv[1:]):
                     f_ma1Lt11.write(results_str + '\n')
                     n_ma1Lt11 += 1
 
+    if num_spectr_files is None:
+        num_spectr_files = n_read[0]
+
     # Finish by printing some stats
     log.info('#' * 60)
     log.info('# N. input points: %d' % num_spectr_files)
@@ -193,6 +207,233 @@ def analyse_scans(in_args=sys.argv[1:]):
     log.info('#' * 60)
 
 
+def spectrum_results(args, n_read=None):
+    """Generator of results dicts from each spectrum file in args.input,
+    skipping un-physical points.
+
+    With args.workers > 1, the files are parsed in chunks by a pool of
+    processes, and the results come out in the same order as in serial.
+
+    If n_read is given (a list of 1 int), its element is set to the number
+    of spectrum files read so far.
+    """
+    weights = read_point_log_column(args.pointLog, 'weight') if args.pointLog else None
+
+    # (spectrum filename, contents of the point's files if from an archive)
+    if is_archive(args.input):
+        points = iter_archive_points(args.input, args.superiso, args.nmssmcalc)
+    else:
+        points = ((spectr, None) for spectr in
+                  glob.iglob(os.path.join(args.input, 'spectr_*.dat')))
+    points = islice(points, args.n)
+
+    if args.workers > 1:
+        log.info('Parsing with %d worker processes', args.workers)
+        all_results = parse_parallel(points, args.workers, args.superiso, args.nmssmcalc)
+    else:
+        # work out how to parse each type of file once, for all files
+        plans = make_plans(args.superiso, args.nmssmcalc)
+        all_results = ((spectr, parse_point(spectr, *plans, contents=contents))
+                       for spectr, contents in points)
+
+    # Loop through each spectrum file
+    for i, (spectr, results_dict) in enumerate(all_results):
+
+        if i % 100 == 0:
+            log.info('Parsed %dth file at %s', i, strftime("%H%M%S"))
+        if n_read is not None:
+            n_read[0] = i + 1
+
+        # If un-physical point (M_H^2 < 1 or M_A^2 < 1), skips file.
+        if results_dict is None:
+            continue
+
+        if weights is not None:
+            results_dict['weight'] = weights.get(spectrum_index(spectr), '')
+
+        yield results_dict
+
+
+def make_plans(superiso=False, nmssmcalc=False):
+    """Make the ParsePlans for the files of each point: the spectrum file,
+    and the SuperIso & NMSSMCalc output files (None if not wanted)"""
+    return (spectrum_plan(),
+            ParsePlan(SuperIsoFields.superiso_fields) if superiso else None,
+            ParsePlan(NMSSMCalcFields.nmssmcalc_fields) if nmssmcalc else None)
+
+
+def parse_point(spectr, plan, superiso_plan=None, nmssmcalc_plan=None, contents=None):
+    """Get the results dict for a point from its spectrum file, plus its
+    SuperIso & NMSSMCalc output files if their plans are given.
+
+    contents : dict
+        Contents of the point's files by filename, if read from an archive
+        (see iter_archive_points). Otherwise the files are opened.
+
+    Returns None for un-physical points.
+    """
+    log.debug('Parsing %s', spectr)
+
+    def lines(filename):
+        return contents[filename].splitlines(True) if contents is not None else None
+
+    results_dict = parse_spectrum(spectr, plan, lines(spectr))
+    if results_dict is None:
+        return None
+
+    if superiso_plan:
+        # Get matching SuperIso output file and parse
+        superiso = os.path.basename(spectr.replace("spectr", "superiso"))
+        superiso = os.path.join(os.path.dirname(spectr), superiso)
+        superiso_dict = superiso_plan.parse(superiso, lines(superiso))
+        results_dict.update(superiso_dict)
+        log.debug(superiso_dict)
+
+    if nmssmcalc_plan:
+        # Get matching NMSSMCalc output file and parse
+        nmssmcalc = os.path.basename(spectr.replace("spectr", "nmssmcalc"))
+        nmssmcalc = os.path.join(os.path.dirname(spectr), nmssmcalc)
+        nmssmcalc_dict = nmssmcalc_plan.parse(nmssmcalc, lines(nmssmcalc))
+        results_dict.update(nmssmcalc_dict)
+        log.debug(nmssmcalc_dict)
+
+    return results_dict
+
+
+# ParsePlans of a worker process, made once by init_worker
+_worker_plans = None
+
+
+def init_worker(superiso, nmssmcalc):
+    global _worker_plans
+    _worker_plans = make_plans(superiso, nmssmcalc)
+
+
+def parse_chunk(points):
+    """Parse a chunk of points in a worker process, returning a list of
+    (spectrum filename, results dict or None)"""
+    return [(spectr, parse_point(spectr, *_worker_plans, contents=contents))
+            for spectr, contents in points]
+
+
+def parse_parallel(points, workers, superiso=False, nmssmcalc=False):
+    """Generator of (spectrum filename, results dict or None) for points,
+    given as (spectrum filename, contents or None) as for parse_point. They
+    are parsed in chunks of CHUNK_SIZE points by a pool of worker processes.
+    Chunks are put back together in order, so the results are in the same
+    order as points."""
+    chunks = iter(lambda: list(islice(points, CHUNK_SIZE)), [])
+    with contextlib.closing(Pool(processes=workers, initializer=init_worker,
+                                 initargs=(superiso, nmssmcalc))) as pool:
+        for chunk_results in pool.imap(parse_chunk, chunks):
+            for result in chunk_results:
+                yield result
+
+
+def is_archive(path):
+    return path.endswith('.tgz') or path.endswith('.tar.gz')
+
+
+def iter_archive_points(archive, superiso=False, nmssmcalc=False):
+    """Generator of the points in a .tgz archive of spectrum files, read
+    straight from the archive in one pass without extracting, as
+    (spectrum filename, {filename: contents} for the point's files).
+
+    Filenames are <archive>/<member name>, as if the archive was a
+    directory. SuperIso & NMSSMCalc output files (if wanted) are paired with
+    spectrum files by name (superiso_X.dat with spectr_X.dat), and points are
+    yielded in the order of their spectrum files, once all their files have
+    been read.
+    """
+    prefixes = ['spectr'] + (['superiso'] if superiso else []) + (['nmssmcalc'] if nmssmcalc else [])
+    pending = OrderedDict()  # spectrum filename: {filename: contents}, in order
+    early = {}  # as pending, for other files read before their spectrum file
+    with tarfile.open(archive, 'r|gz') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            prefix = name.split('_')[0]
+            if not member.isfile() or prefix not in prefixes:
+                continue
+            if prefix == 'spectr' and not fnmatch.fnmatch(name, 'spectr_*.dat'):
+                continue
+            filename = os.path.join(archive, member.name)
+            spectr = os.path.join(os.path.dirname(filename), name.replace(prefix, 'spectr', 1))
+            if prefix == 'spectr':
+                pending[spectr] = early.pop(spectr, {})
+            contents = pending[spectr] if spectr in pending else early.setdefault(spectr, {})
+            contents[filename] = tar.extractfile(member).read()
+            # yield the points at the front that have all their files
+            while pending:
+                spectr, contents = next(pending.iteritems())
+                if len(contents) < len(prefixes):
+                    break
+                del pending[spectr]
+                yield spectr, contents
+
+    for spectr, contents in pending.iteritems():
+        if len(contents) < len(prefixes):
+            log.warning('Missing SuperIso/NMSSMCalc output for %s - skipping', spectr)
+        else:
+            yield spectr, contents
+
+
+def spectrum_index(spectr):
+    """Get the point index from a spectrum filename, e.g. spectr_PROTO_12.dat"""
+    return int(re.search(r'_(\d+)\.dat$', spectr).group(1))
+
+
+def shard_results(shards, args):
+    """Generator of results dicts from shard files, as for spectrum_results"""
+    for i, results_dict in enumerate(iter_shard_records(shards)):
+        if i == args.n:
+            break
+        # point index isn't in the spectrum file output
+        del results_dict['index']
+        yield results_dict
+
+
+def shard_length(filename):
+    """Number of points in a shard file"""
+    return len(np.load(filename)['index'])
+
+
+# ParsePlan for spectrum files, made on first use
+_spectrum_plan = None
+
+
+def spectrum_plan():
+    """Get the ParsePlan for the NMSSMTools, HiggsBounds & HiggsSignals
+    fields of spectrum files, made once and shared by all parse_spectrum
+    calls"""
+    global _spectrum_plan
+    if _spectrum_plan is None:
+        _spectrum_plan = ParsePlan(NMSSMToolsFields.nmssmtools_fields +
+                                   HiggsBoundsSignalsFields.higgsbounds_fields +
+                                   HiggsBoundsSignalsFields.higgssignals_fields,
+                                   spinfo=True)
+    return _spectrum_plan
+
+
+def parse_spectrum(spectr, plan=None, lines=None):
+    """Get the NMSSMTools, HiggsBounds & HiggsSignals results from a
+    spectrum file, as a dict of field name: value, plus the failed
+    constraints joined by '|' under 'constraints'.
+
+    plan : slha_parser.ParsePlan
+        Plan for the fields to get, made with spinfo=True. Defaults to
+        spectrum_plan().
+    lines : iterable of str
+        Lines of the file if already read, otherwise it is opened.
+
+    Returns None for un-physical points.
+    """
+    # The constraints in SPINFO are read in the same pass as the fields,
+    # stopping early for un-physical points
+    results_dict = (plan or spectrum_plan()).parse(spectr, lines)
+    # log.debug(results_dict)
+    return results_dict
+
+
 def get_slha_dict(filename, fields):
     """Pull information from SLHA file and store in a dict.
 
@@ -204,86 +445,19 @@ def get_slha_dict(filename, fields):
           This is case-sensitive.
         - a name e.g. 'mh1', to be used as the dict key.
         - a type e.g. float, to convert from a string.
-        - a regex pattern, to be used when trying to match lines.
+        - an index e.g. (3,), the indices of the line in the block, or a
+          regex pattern, to be used when trying to match lines.
           This is case-sensitive.
 
         A Field looks like:
 
         Field(block='MINPAR', name="tgbeta", type=float,
               regex=re.compile(r' +3 +([E\d\.\-\+]+) +\# TANBETA\(MZ\)'))
+
+        Lines are looked up by block & indices, see slha_parser.py. To parse
+        many files with the same fields, make a ParsePlan once instead.
     """
-    # For each BLOCK, we assign a list of pairs of field name + compiled regex pattern
-    # Means we can only go through the patterns pertinent to that block
-    scan_dict = defaultdict(list)
-    for f in fields:
-        if isinstance(f.regex, re._pattern_type):
-            scan_dict[f.block].append(f)
-        else:
-            new_field = NMSSMToolsFields.Field(name=f.name,
-                                               block=f.block,
-                                               type=f.type,
-                                               regex=re.compile(f.regex),
-                                               comment=f.regex.pattern.split('#')[1].replace('\\', ''))
-            scan_dict[f.block].append(new_field)
-
-    results = defaultdict(str)
-    # ensures all dicts have the same keys
-    for f in fields:
-        results[f.name] = ''
-
-    results['file'] = filename
-
-    p_block = re.compile(r'BLOCK +(\w+)', re.I)
-
-    # Now go through the file, line by line. If we encounter a BLOCK line,
-    # then we loop through the block contents, checking each line against all
-    # of the user's regexes. If there is a match, it is stored in the results
-    # dict.
-    # Note that we cannot use 'for line in f' as it skips alternate 'BLOCK' lines
-    with open(filename) as f:
-        try:
-            line = f.next()
-            while True:
-                if line.startswith('#'):
-                    line = f.next()
-                    continue
-
-                if is_block_line(line):
-                    # block = p_block.search(line).group(1).strip()
-                    block = line.split('#')[0].replace('BLOCK ', '').replace("Block ", '').strip().split(' ')[0]
-                    # log.debug(block)
-
-                    line = f.next()
-                    if block in scan_dict.keys():
-                        # Now loop over contents of this block and try matching
-                        # against the regexes
-                        while not is_block_line(line):
-                            # tmp_list = scan_dict[block]
-                            found_field = None
-                            for ind, field in enumerate(scan_dict[block]):
-                                if field.comment in line:
-                                    result = field.regex.search(line)
-                                    if result:
-                                        results[field.name] = field.type(result.group(1))
-                                        found_field = ind
-                                        log.debug('%s: %s', field.name, result.group(1))
-                                        break
-                            if found_field:
-                                del scan_dict[block][found_field]
-                            line = f.next()
-                    else:
-                        line = f.next()
-                else:
-                    line = f.next()
-        except StopIteration:
-            pass
-
-    return results
-
-
-# put these outside to get ocmpiled once, then used lots of times
-p_id = re.compile(r' *3 *# *')  # needed to remove identifier
-p_space = re.compile(r'\s{2,}')  # needed to remove surplus spaces
+    return ParsePlan(fields).parse(filename)
 
 
 def get_nmssmtools_constraints(filename):
@@ -295,6 +469,9 @@ def get_nmssmtools_constraints(filename):
     use the output in a bool, since both un-physical points and perfect points
     will both give the same result. Instead, use isinstance(result, list)
     to distinguish.
+
+    parse_spectrum reads these in the same pass as the other fields, this is
+    for when only the constraints are needed.
     """
     with open(filename) as f:
         for line in f:
@@ -308,9 +485,7 @@ def get_nmssmtools_constraints(filename):
                     if line.startswith('3'):
                         # store failed experimantal/theory constraints
                         log.debug(line)
-                        line = p_id.sub('', line)
-                        line = line.replace(',', '')  # important as CSV file
-                        line = p_space.sub(' ', line)
+                        line = constraint_message(line)
                         constraints.append(line)
                     if line.startswith('4'):
                         # see if there was any show-stoppers in the constraints
@@ -357,9 +532,5 @@ def check_create_dir(directory):
         log.debug("Making dir %s" % directory)
 
 
-def is_block_line(line):
-    return line.startswith('BLOCK') or line.startswith('Block')
-
-
 if __name__ == "__main__":
     analyse_scans()
@@ -0,0 +1,99 @@
+"""
+Precompiled input card template for NMSSMTools.
+
+The template card is parsed once into a list of fixed text segments and
+parameter slots. Each slot is keyed by the parameter name given in the
+"# NAME" comment at the end of the line, e.g.
+
+    61	SED_LAMBDAD0	# LAMBDA
+
+becomes a slot for LAMBDA. Rendering a new card is then just a string join,
+rather than running a regex for every line against every parameter.
+"""
+
+
+import re
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def param_pattern(name):
+    """Regex that matches a card line whose value is set by parameter `name`.
+
+    Group 1 is everything up to the value, group 2 is everything after it.
+    """
+    return re.compile(r'(\s+\d+\s+)[\w.]+(\s+#\s%s.*)' % name)
+
+
+def format_value(value):
+    """Format a parameter value in the Fortran double style used by the cards."""
+    return str(value) + 'D0'
+
+
+class CardTemplate(object):
+    """Input card template, split into text segments and parameter slots.
+
+    template_lines : list[str]
+        Lines of the template card, as returned by readlines()
+    param_names : list[str]
+        Names of parameters to make slots for. These must match the comment
+        in the card file.
+
+    If more than one parameter matches the same line, the last one in
+    `param_names` wins, as with repeatedly applying re.sub.
+    """
+    def __init__(self, template_lines, param_names):
+        self.param_names = list(param_names)
+        patterns = [(name, param_pattern(name)) for name in self.param_names]
+
+        # segments alternate between fixed text and parameter names:
+        # [text, name, text, name, ..., text]
+        self.segments = []
+        self.slot_names = []
+        text = ''
+        for line in template_lines:
+            match_name, match = None, None
+            for name, pattern in patterns:
+                m = pattern.search(line)
+                if m:
+                    if match_name:
+                        log.warning('Card line matches both %s and %s, using %s: %s',
+                                    match_name, name, name, line.strip())
+                    match_name, match = name, m
+            if not match:
+                text += line
+                continue
+            text += line[:match.end(1)]
+            self.segments.append(text)
+            self.slot_names.append(match_name)
+            text = line[match.start(2):]
+        self.segments.append(text)
+
+        self.unmatched = [n for n in self.param_names if n not in self.slot_names]
+        for name in self.unmatched:
+            log.warning('Parameter %s does not match any line in the card template', name)
+
+    @classmethod
+    def from_file(cls, filename, param_names):
+        """Make a CardTemplate from a template card file."""
+        with open(filename) as template_file:
+            return cls(template_file.readlines(), param_names)
+
+    def render(self, values):
+        """Return the text of a new card.
+
+        values : dict
+            Map of parameter name to value. Must have an entry for every slot.
+        """
+        parts = [self.segments[0]]
+        for name, text in zip(self.slot_names, self.segments[1:]):
+            parts.append(format_value(values[name]))
+            parts.append(text)
+        return ''.join(parts)
+
+    def write(self, filename, values):
+        """Render a new card and write it to filename."""
+        with open(filename, 'w') as new_card:
+            new_card.write(self.render(values))
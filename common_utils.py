@@ -24,3 +24,43 @@ def check_create_dir(directory, info=False):
         os.makedirs(directory)
         if info:
             print "Making dir %s" % directory
+
+
+def make_scratch_tree(src, dest):
+    """Make a scratch working copy of directory src at dest.
+
+    Directories are created for real, but files (and symlinked directories)
+    are symlinked back to the originals. This means any new files written
+    by programs run inside dest don't clash with other copies, without
+    copying all the read-only binaries & data.
+    """
+    src = os.path.abspath(src)
+    for root, dirs, files in os.walk(src):
+        new_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        check_create_dir(new_root)
+        for d in dirs[:]:
+            if os.path.islink(os.path.join(root, d)):
+                os.symlink(os.path.join(root, d), os.path.join(new_root, d))
+                dirs.remove(d)
+        for f in files:
+            os.symlink(os.path.join(root, f), os.path.join(new_root, f))
+
+
+def free_space(path):
+    """Return the free space (in bytes) on the filesystem containing path,
+    available to a normal user."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def available_memory():
+    """Return the memory available for new programs/files in bytes
+    (MemAvailable in /proc/meminfo), or None if not known."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
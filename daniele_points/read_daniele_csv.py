@@ -1,6 +1,9 @@
 """
 Remake the input cards from Daniele's scan points, so can rerun with newer
 version of NMSSMTools and check more things.
+
+NB NMSSMScan.py --points can now run points from a CSV directly, if its
+columns are named as in the card (e.g. TANB, LAMBDA).
 """
 
 
@@ -126,7 +126,7 @@ def set_major_tick_interval(which, interval):
 
 def plot_histogram(ax=None, array=None, var=None, df=None,
                    label="", xlabel="", ylabel="N", title="",
-                   errorbars=True, normed=False, **kwargs):
+                   errorbars=True, normed=False, weight_var=None, **kwargs):
     """
     Generic histogram plotter. Can either plot variable var in DataFrame df,
     or plot a numpy array.
@@ -135,27 +135,44 @@ def plot_histogram(ax=None, array=None, var=None, df=None,
     errorbars: can optionally show error bars
     normed: can optionally normalise so sum of bin contents = 1
     (irrespective of bin width)
+    weight_var: column in df to weight entries by, e.g. 'weight' for scans
+    with non-uniform param distributions, to get back a uniform prior
     kwargs: other keyword args to pass to pyplot.histogram()
     """
     if not ax:
         ax = generate_axes()
 
+    point_weights = None
     if array is not None:
         vals = array
     elif var is not None and df is not None:
-        vals = df[var].dropna().values
+        if weight_var:
+            not_null = df[var].notnull()
+            vals = df[var][not_null].values
+            point_weights = df[weight_var][not_null].values
+        else:
+            vals = df[var].dropna().values
     else:
         raise Exception("plot_histogram needs a numpy array or variable name + dataframe")
 
-    weights = None
+    weights = point_weights
     if normed:
-        weights = np.ones_like(vals) / len(vals)
+        if point_weights is None:
+            weights = np.ones_like(vals) / len(vals)
+        else:
+            weights = point_weights / point_weights.sum()
     y, bins, patches = ax.hist(vals, weights=weights, label=label, **kwargs)
     if errorbars:
         # put error bars on
         bincenters = 0.5 * (bins[1:] + bins[:-1])
         menStd = np.sqrt(y)
-        if normed:
+        if point_weights is not None:
+            # sqrt(sum of weights^2) in each bin
+            sumw2, _ = np.histogram(vals, bins=bins, weights=point_weights ** 2)
+            menStd = np.sqrt(sumw2)
+            if normed:
+                menStd = menStd / point_weights.sum()
+        elif normed:
             # need to do this otherwise it does errors incorrectly as
             # sqrt(normalised bin), not sqrt(bin)/sum of all bins
             menStd = menStd / np.sqrt(len(vals))
@@ -0,0 +1,250 @@
+"""
+Adaptive Metropolis-Hastings sampling of the parameter space, so that regions
+passing the constraints get sampled much more densely than with a uniform
+random scan.
+
+The chain lives in the unit hypercube (each param scaled by its [min, max]
+range), with a flat prior inside it. Proposals are Gaussian, with widths that
+start as a fixed fraction of each param's range, and are then adapted to the
+spread of the chain so far, with an overall scale tuned to reach the target
+acceptance rate.
+
+The proposal is only adapted during a burn-in of the first adapt_steps steps.
+It is fixed after that, so the rest of the chain is a proper Metropolis-Hastings
+chain with the likelihood as its stationary distribution. The burn-in rows of
+the chain file are marked, and should be dropped when using the chain.
+"""
+
+
+import logging
+import numpy as np
+from scan_log import rng_state_to_json, rng_state_from_json
+
+
+log = logging.getLogger(__name__)
+
+
+# Failed NMSSMTools constraints that we don't penalise (as in analyse_scans.pass_constraints)
+ALLOWED_CONSTRAINTS = ["Relic density too small (Planck)",
+                       "Muon magn. mom. more than 2 sigma away"]
+
+
+def log_likelihood(results, penalty=10.):
+    """Calculate a (pseudo) log-likelihood for a point from its parsed
+    results (from analyse_scans.parse_spectrum), built from:
+
+    - each failed NMSSMTools constraint in BLOCK SPINFO, except those in
+      ALLOWED_CONSTRAINTS, costs `penalty`
+    - being excluded by HiggsBounds (HBresult = 0) costs `penalty`
+    - -chi^2/2 from HiggsSignals
+
+    Returns -inf for unphysical points (results is None).
+    """
+    if results is None:
+        return -np.inf
+
+    constraints = results['constraints'].split('|') if results['constraints'] else []
+    log_l = -penalty * len([c for c in constraints if c not in ALLOWED_CONSTRAINTS])
+
+    if results['HBresult'] == 0:
+        log_l -= penalty
+    if results['HSchi2'] != '':
+        log_l -= 0.5 * results['HSchi2']
+    return log_l
+
+
+class AdaptiveMetropolis(object):
+    """Metropolis-Hastings sampler in the unit hypercube, with adaptive
+    Gaussian proposal widths.
+
+    n_dims : int
+        Number of dimensions
+    seed : int
+        Seed for random number generator
+    width : float
+        Initial proposal width, as a fraction of each param's range.
+    target_acceptance : float
+        Acceptance rate to tune the proposal scale towards.
+    adapt_interval : int
+        Number of steps between adapting the proposal widths.
+    adapt_steps : int
+        Number of steps to adapt the proposal for (the burn-in). The proposal
+        is fixed after that.
+    """
+    def __init__(self, n_dims, seed=None, width=0.1, target_acceptance=0.234, adapt_interval=50,
+                 adapt_steps=1000):
+        self.n_dims = n_dims
+        self.rng = np.random.RandomState(seed)
+        self.widths = np.full(n_dims, width)
+        self.scale = 1.
+        self.target_acceptance = target_acceptance
+        self.adapt_interval = adapt_interval
+        self.adapt_steps = adapt_steps
+        self.n_steps = 0
+        self.n_accepted = 0
+        self._n_accepted_interval = 0
+        # running mean & sum of squared deviations of the states visited, for
+        # adapting the widths (Welford's algorithm), so the whole history
+        # isn't kept (or saved in every checkpoint)
+        self._n_recorded = 0
+        self._mean = np.zeros(n_dims)
+        self._m2 = np.zeros(n_dims)
+
+    def propose(self, current):
+        """Propose a new point from the current one.
+
+        Points outside the unit hypercube are reflected back inside, which
+        keeps the proposal symmetric.
+        """
+        new = current + self.scale * self.widths * self.rng.normal(size=self.n_dims)
+        new = np.abs(new)  # reflect at 0
+        new = 1. - np.abs(1. - np.mod(new, 2.))  # reflect at 1
+        return np.clip(new, 0., np.nextafter(1., 0.))
+
+    def accept(self, log_l_current, log_l_new):
+        """Decide whether to accept the new point, and adapt the proposal."""
+        if log_l_new == -np.inf:
+            accepted = False
+        elif log_l_new >= log_l_current:
+            accepted = True
+        else:
+            accepted = np.log(self.rng.uniform()) < log_l_new - log_l_current
+        self.n_steps += 1
+        self.n_accepted += int(accepted)
+        self._n_accepted_interval += int(accepted)
+        return accepted
+
+    @property
+    def adapting(self):
+        """Whether the next step is still part of the burn-in"""
+        return self.n_steps < self.adapt_steps
+
+    def record(self, state):
+        """Record the current state of the chain, and adapt if it's time.
+        Does nothing after the burn-in."""
+        if self.n_steps > self.adapt_steps:
+            return
+        self._n_recorded += 1
+        delta = state - self._mean
+        self._mean += delta / self._n_recorded
+        self._m2 += delta * (state - self._mean)
+        if self.n_steps and self.n_steps % self.adapt_interval == 0:
+            self.adapt()
+
+    def adapt(self):
+        """Adapt the proposal widths to the spread of the chain, and the
+        overall scale towards the target acceptance rate."""
+        rate = self._n_accepted_interval / float(self.adapt_interval)
+        self.scale *= np.exp(rate - self.target_acceptance)
+        self._n_accepted_interval = 0
+
+        if self._n_recorded > 2 * self.n_dims:
+            # optimal scaling for a Gaussian target, Gelman et al. 1996
+            std = np.sqrt(self._m2 / self._n_recorded)
+            spread = 2.38 / np.sqrt(self.n_dims) * std
+            self.widths = np.clip(spread, 1E-3, 0.5)
+        log.debug('Acceptance rate %.3f, scale %.3g, widths %s', rate, self.scale, self.widths)
+
+    @property
+    def acceptance_rate(self):
+        return self.n_accepted / float(max(self.n_steps, 1))
+
+    def get_state(self):
+        """Get the full state of the sampler, as a JSON-friendly dict"""
+        return {'rng': rng_state_to_json(self.rng),
+                'widths': self.widths.tolist(),
+                'scale': self.scale,
+                'n_steps': self.n_steps,
+                'n_accepted': self.n_accepted,
+                'n_accepted_interval': self._n_accepted_interval,
+                'n_recorded': self._n_recorded,
+                'mean': self._mean.tolist(),
+                'm2': self._m2.tolist()}
+
+    def set_state(self, state):
+        """Restore the state from get_state()"""
+        rng_state_from_json(self.rng, state['rng'])
+        self.widths = np.array(state['widths'])
+        self.scale = state['scale']
+        self.n_steps = state['n_steps']
+        self.n_accepted = state['n_accepted']
+        self._n_accepted_interval = state['n_accepted_interval']
+        self._n_recorded = state['n_recorded']
+        self._mean = np.array(state['mean'])
+        self._m2 = np.array(state['m2'])
+
+
+class ChainWriter(object):
+    """Write the chain to a CSV file, one row per distinct state, with a
+    weight column for the number of steps spent in that state.
+
+    The burnIn column is 1 for the rows from the burn-in (see end_burn_in),
+    and 0 after it.
+
+    filename : str
+        Output filename
+    param_names : list[str]
+        Names of params, to use as column headers.
+    resume_state : dict
+        State from get_state(), to carry on writing an existing file from
+        that point.
+    burn_in : bool
+        Whether the chain starts in the burn-in.
+    """
+    def __init__(self, filename, param_names, resume_state=None, burn_in=True):
+        self.param_names = param_names
+        self.state = None
+        self.weight = 0
+        self.burn_in = burn_in
+        if resume_state:
+            # drop any rows written after the state was saved
+            self.f = open(filename, 'r+')
+            self.f.truncate(resume_state['offset'])
+            self.f.seek(resume_state['offset'])
+            self.state = resume_state['state']
+            self.weight = resume_state['weight']
+            self.burn_in = resume_state['burn_in']
+        else:
+            self.f = open(filename, 'w')
+            self.f.write(','.join(['weight', 'logL'] + param_names + ['file', 'burnIn']) + '\n')
+
+    def add(self, values, log_l, filename):
+        """Move the chain to a new state."""
+        self.flush()
+        self.state = (values, log_l, filename)
+        self.weight = 1
+
+    def stay(self):
+        """Chain stays in the current state for another step."""
+        self.weight += 1
+
+    def end_burn_in(self):
+        """Mark the end of the burn-in. The steps in the current state so far
+        are written as a burn-in row, and any more go in a new row."""
+        state = self.state
+        self.flush()
+        self.state = state
+        self.weight = 0
+        self.burn_in = False
+
+    def flush(self):
+        """Write out the current state"""
+        if self.state is None:
+            return
+        if self.weight:
+            values, log_l, filename = self.state
+            row = ([str(self.weight), repr(log_l)] + [repr(values[k]) for k in self.param_names] +
+                   [filename, str(int(self.burn_in))])
+            self.f.write(','.join(row) + '\n')
+        self.state = None
+
+    def get_state(self):
+        """Get the position in the file and the current state, as a
+        JSON-friendly dict"""
+        self.f.flush()
+        return {'offset': self.f.tell(), 'state': self.state, 'weight': self.weight,
+                'burn_in': self.burn_in}
+
+    def close(self):
+        self.flush()
+        self.f.close()
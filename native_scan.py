@@ -0,0 +1,164 @@
+"""
+Use NMSSMTools' own scan modes (ISCAN = 2: random scan, 3: MCMC), which run
+a whole batch of points in one NMSSMTools process, instead of one process,
+input card and spectrum file per point.
+
+A single scan card is made from the template card & param JSON: each
+scanned param gets its min on its usual line in the card, plus a line for
+its max (see max_index), and BLOCK STEPS sets the number of points & seed.
+
+In scan modes NMSSMTools writes one line per point to its out file
+(out<X> for a card inp<X>), instead of spectrum files. The columns written
+depend on the NMSSMTools version (see the output routine of the scan program,
+e.g. main/nmhdecay_rand.f), so they are given as a list of names, one per
+column. Names should be the field names used by analyse_scans (e.g. lambda,
+mh1, ma1) for columns to analyse, or '-' for columns to ignore. The out file
+is read line by line into records like those from
+analyse_scans.parse_spectrum, so they can be stored in result shards and
+analysed with analyse_scans.py --shards.
+"""
+
+
+import re
+import logging
+import NMSSMToolsFields
+import HiggsBoundsSignalsFields
+from card_template import param_pattern, format_value
+
+
+log = logging.getLogger(__name__)
+
+
+# values of ISCAN in BLOCK MODSEL
+ISCAN = {'random': 2, 'mcmc': 3}
+
+# index of the max value of scanned params, where it doesn't follow the
+# rule in max_index
+SCAN_MAX_INDEX = {('MINPAR', 3): 37}  # TANB
+
+IGNORE_COLUMN = '-'
+
+
+def max_index(block, index):
+    """Get the index of the line for the max of a scanned param, from the
+    block & index of its usual line, e.g. EXTPAR 61 (LAMBDA) -> 611.
+
+    Raises ValueError if not known.
+    """
+    if (block, index) in SCAN_MAX_INDEX:
+        return SCAN_MAX_INDEX[(block, index)]
+    if block == 'EXTPAR' and index >= 10:
+        return int('%d1' % index)
+    raise ValueError('No known index for max of BLOCK %s entry %d, '
+                     'set it with "maxIndex" in the param JSON' % (block, index))
+
+
+def make_scan_card(template_lines, param_dict, mode, n_points, seed):
+    """Make the text of an NMSSMTools scan card.
+
+    template_lines : list[str]
+        Lines of the template card, as returned by readlines()
+    param_dict : dict
+        Params to scan, as in the param JSON file. Only free params with a
+        uniform distribution can be scanned, and each can set "maxIndex",
+        the index of the line for its max (see max_index).
+    mode : str
+        Scan mode, a key of ISCAN.
+    n_points : int
+        Number of points to scan (NTOT).
+    seed : int
+        Seed for NMSSMTools' random numbers (ISEED).
+    """
+    for name, spec in param_dict.iteritems():
+        if 'expr' in spec or spec.get('dist', 'uniform') != 'uniform':
+            raise ValueError('NMSSMTools scans can only use free params with '
+                             'a uniform distribution, not %s' % name)
+    patterns = [(name, param_pattern(name)) for name in sorted(param_dict)]
+
+    lines = []
+    block = None
+    found = set()
+    for line in template_lines:
+        if line.upper().startswith('BLOCK'):
+            block = line.split('#')[0].split()[1].upper()
+        if block == 'MODSEL' and '# ISCAN' in line:
+            line = re.sub(r'^(\s*\d+\s+)\d+', r'\g<1>%d' % ISCAN[mode], line)
+        for name, pattern in patterns:
+            if line.lstrip().startswith('#'):
+                break
+            m = pattern.search(line)
+            if not m:
+                continue
+            spec = param_dict[name]
+            index = int(m.group(1))
+            line = line[:m.end(1)] + format_value(spec['min']) + line[m.start(2):]
+            lines.append(line)
+            index = spec['maxIndex'] if 'maxIndex' in spec else max_index(block, index)
+            line = '\t%d\t%s\t# %s_max\n' % (index, format_value(spec['max']), name)
+            found.add(name)
+            break
+        lines.append(line)
+
+    missing = sorted(set(param_dict) - found)
+    if missing:
+        raise ValueError('Params %s do not match any line in the card template'
+                         % ', '.join(missing))
+
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append('\nBLOCK STEPS\n'
+                 '\t0\t%d\t\t# NTOT\n'
+                 '\t1\t%d\t\t# ISEED\n' % (n_points, seed))
+    return ''.join(lines)
+
+
+def read_columns(filename):
+    """Read the column names of the NMSSMTools scan output from a file,
+    separated by whitespace. Anything after # is a comment."""
+    columns = []
+    with open(filename) as f:
+        for line in f:
+            columns.extend(line.split('#')[0].split())
+    return columns
+
+
+def iter_scan_output(filename, columns):
+    """Generator of records (dicts of field name: value) for each point in an
+    NMSSMTools scan out file, read one line at a time.
+
+    filename : str
+        Out file from an NMSSMTools scan.
+    columns : list[str]
+        Field name of each column, or IGNORE_COLUMN.
+
+    Each record has every NMSSMTools, HiggsBounds & HiggsSignals field, as
+    from analyse_scans.parse_spectrum, with '' for fields not in columns.
+    'file' is the out file & line number of the point. The scan output has
+    no SPINFO block (NMSSMTools only writes points passing its constraints),
+    so 'constraints' is ''.
+    """
+    fields = (NMSSMToolsFields.nmssmtools_fields +
+              HiggsBoundsSignalsFields.higgsbounds_fields +
+              HiggsBoundsSignalsFields.higgssignals_fields)
+    types = dict((f.name, f.type) for f in fields)
+    empty = dict((f.name, '') for f in fields)
+    used = [(i, name, types.get(name, float)) for i, name in enumerate(columns)
+            if name != IGNORE_COLUMN]
+
+    with open(filename) as f:
+        for line_num, line in enumerate(f, 1):
+            values = line.split()
+            if not values or values[0].startswith('#'):
+                continue
+            if len(values) != len(columns):
+                log.warning('Skipping %s line %d: %d columns instead of %d',
+                            filename, line_num, len(values), len(columns))
+                continue
+            record = dict(empty)
+            for i, name, convert in used:
+                # Fortran doubles, e.g. 0.12D+03
+                value = float(values[i].replace('D', 'E').replace('d', 'e'))
+                record[name] = convert(value)
+            record['file'] = '%s:%d' % (filename, line_num)
+            record['constraints'] = ''
+            yield record
@@ -0,0 +1,310 @@
+"""
+Parameter space to scan, as set in the param JSON file.
+
+Each param is either:
+
+- free: sampled over its range, e.g. "LAMBDA": {"min": 0, "max": 0.5}.
+  By default it is sampled uniformly, otherwise set "dist" (see DISTRIBUTIONS):
+    - "log": log-uniform between min & max, e.g.
+      "TANB": {"dist": "log", "min": 2, "max": 50}
+    - "gauss": Gaussian truncated to [min, max], e.g. around a benchmark point
+      "MUEFF": {"dist": "gauss", "mean": 200, "sigma": 20, "min": 100, "max": 300}
+    - "piecewise": uniform within each bin of "edges", with relative "weights"
+      for each bin, e.g.
+      "M3": {"dist": "piecewise", "edges": [500, 1000, 3000], "weights": [3, 1]}
+- derived: calculated from other params, e.g. "KAPPA": {"expr": "LAMBDA * x"}.
+  A derived param can also have a "min" and/or "max", which points must
+  satisfy.
+
+Free params don't have to appear in the input card, so they can be used as
+helper variables for derived params (like x above).
+
+A "constraints" entry gives a list of expressions that every point must
+satisfy, e.g. "constraints": ["KAPPA**2 + LAMBDA**2 < 0.5"].
+
+Expressions are python, and can use numpy functions (sqrt, exp, log, ...).
+They are evaluated on whole arrays of points at once, so points failing the
+constraints are thrown away in large batches before any input card is made.
+This also means they must use &, | and ~ (with brackets) instead of
+and, or & not.
+
+Each point also gets a weight: the ratio of the uniform density over the free
+param ranges to the density it was sampled with. Weighting points by it
+recovers a uniform prior, e.g. to compare with a uniform scan. It is 1 for
+points from a scan with only uniform params.
+"""
+
+
+import math
+import json
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+# functions & constants that can be used in expressions
+EXPR_NAMESPACE = dict((name, getattr(np, name)) for name in
+                      ['sqrt', 'exp', 'log', 'log10', 'abs', 'sin', 'cos', 'tan',
+                       'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh',
+                       'minimum', 'maximum', 'where', 'pi'])
+EXPR_NAMESPACE['__builtins__'] = {}
+
+
+def compile_expr(expr, where):
+    """Compile an expression, and return it with the names it uses"""
+    code = compile(expr, '<%s>' % where, 'eval')
+    return code, [n for n in code.co_names if n not in EXPR_NAMESPACE]
+
+
+def eval_expr(code, columns, n):
+    """Evaluate an expression over columns (dict of name: array), returning
+    an array of length n (e.g. if the expression is a constant)"""
+    return np.zeros(n) + eval(code, EXPR_NAMESPACE, columns)
+
+
+def norm_cdf(x):
+    """Cumulative distribution function of the standard normal distribution"""
+    return 0.5 * (1. + math.erf(x / math.sqrt(2.)))
+
+
+def norm_ppf(p):
+    """Inverse of norm_cdf for an array of probabilities, using the rational
+    approximation of P. J. Acklam (relative error < 1.2E-9)."""
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00]
+    p = np.clip(np.asarray(p, dtype=float), 1E-300, 1. - 1E-16)
+    x = np.empty_like(p)
+
+    def tail(q):
+        return (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / \
+            ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1.)
+
+    low = p < 0.02425
+    high = p > 1. - 0.02425
+    mid = ~low & ~high
+    x[low] = tail(np.sqrt(-2. * np.log(p[low])))
+    x[high] = -tail(np.sqrt(-2. * np.log(1. - p[high])))
+    q = p[mid] - 0.5
+    r = q * q
+    x[mid] = ((((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q /
+              (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1.))
+    return x
+
+
+class Distribution(object):
+    """Base class for the distribution of a free param.
+
+    spec : dict
+        Entry for the param in the param JSON file.
+    """
+    def __init__(self, spec):
+        self.min = float(spec['min'])
+        self.max = float(spec['max'])
+
+    def ppf(self, u):
+        """Map an array of points in [0, 1) to param values
+        (the inverse of the cumulative distribution function)"""
+        raise NotImplementedError
+
+    def weight(self, x):
+        """Ratio of the uniform density over [min, max] to the density of
+        this distribution, for an array of param values"""
+        raise NotImplementedError
+
+
+class Uniform(Distribution):
+    """Uniform between min & max"""
+    def ppf(self, u):
+        return self.min + (self.max - self.min) * u
+
+    def weight(self, x):
+        return np.ones_like(x)
+
+
+class LogUniform(Distribution):
+    """Uniform in log(param) between min & max"""
+    def __init__(self, spec):
+        super(LogUniform, self).__init__(spec)
+        if self.min <= 0:
+            raise ValueError('Log-uniform param must have min > 0')
+        self.log_ratio = math.log(self.max / self.min)
+
+    def ppf(self, u):
+        return self.min * np.exp(self.log_ratio * u)
+
+    def weight(self, x):
+        return x * self.log_ratio / (self.max - self.min)
+
+
+class TruncatedGaussian(Distribution):
+    """Gaussian with a given mean & sigma, truncated to [min, max]"""
+    def __init__(self, spec):
+        super(TruncatedGaussian, self).__init__(spec)
+        self.mean = float(spec['mean'])
+        self.sigma = float(spec['sigma'])
+        self.cdf_min = norm_cdf((self.min - self.mean) / self.sigma)
+        self.cdf_max = norm_cdf((self.max - self.mean) / self.sigma)
+
+    def ppf(self, u):
+        p = self.cdf_min + (self.cdf_max - self.cdf_min) * u
+        return np.clip(self.mean + self.sigma * norm_ppf(p), self.min, self.max)
+
+    def weight(self, x):
+        z = (x - self.mean) / self.sigma
+        density = np.exp(-0.5 * z ** 2) / (math.sqrt(2. * math.pi) * self.sigma)
+        return (self.cdf_max - self.cdf_min) / (density * (self.max - self.min))
+
+
+class Piecewise(Distribution):
+    """Uniform within each bin of edges, with relative weights for each bin"""
+    def __init__(self, spec):
+        self.edges = np.asarray(spec['edges'], dtype=float)
+        self.weights = np.asarray(spec['weights'], dtype=float)
+        if len(self.weights) != len(self.edges) - 1:
+            raise ValueError('Piecewise param needs one more edge than weights')
+        if np.any(np.diff(self.edges) <= 0) or np.any(self.weights < 0):
+            raise ValueError('Piecewise param needs increasing edges & weights >= 0')
+        self.min, self.max = self.edges[0], self.edges[-1]
+        self.cum = np.concatenate([[0.], np.cumsum(self.weights)]) / self.weights.sum()
+
+    def _bin(self, bounds, x):
+        return np.clip(np.searchsorted(bounds, x, side='right') - 1, 0, len(self.weights) - 1)
+
+    def ppf(self, u):
+        k = self._bin(self.cum, u)
+        frac = (u - self.cum[k]) / (self.cum[k + 1] - self.cum[k])
+        return self.edges[k] + frac * (self.edges[k + 1] - self.edges[k])
+
+    def weight(self, x):
+        k = self._bin(self.edges, x)
+        density = (self.cum[k + 1] - self.cum[k]) / (self.edges[k + 1] - self.edges[k])
+        return 1. / (density * (self.max - self.min))
+
+
+DISTRIBUTIONS = {
+    'uniform': Uniform,
+    'log': LogUniform,
+    'gauss': TruncatedGaussian,
+    'piecewise': Piecewise,
+}
+
+
+def make_distribution(name, spec):
+    """Make the Distribution for free param name from its entry in the param JSON"""
+    dist = spec.get('dist', 'uniform')
+    if dist not in DISTRIBUTIONS:
+        raise ValueError('Unknown dist "%s" for param %s, options are: %s'
+                         % (dist, name, ', '.join(sorted(DISTRIBUTIONS))))
+    return DISTRIBUTIONS[dist](spec)
+
+
+def load_param_file(filename):
+    """Read a param JSON file.
+
+    Returns the dict of params, the list of constraints, and a dict of the
+    entries starting with _ (comments & settings, e.g. _sampler, _seed).
+    """
+    with open(filename) as json_file:
+        param_dict = json.load(json_file)
+    constraints = param_dict.pop('constraints', [])
+    options = {}
+    for k in param_dict.keys():
+        if k.startswith('_'):
+            log.debug('Removing entry %s' % k)
+            options[k] = param_dict.pop(k)
+    return param_dict, constraints, options
+
+
+class ParamSpace(object):
+    """Free & derived params, and constraints on them.
+
+    param_dict : dict
+        Map of param name to dict with either its 'min' & 'max' and optional
+        'dist' (free param), or an 'expr' (derived param), as in the param
+        JSON file.
+    constraints : list[str]
+        Expressions that must be true for every point.
+    """
+    def __init__(self, param_dict, constraints=()):
+        if 'weight' in param_dict:
+            raise ValueError('"weight" is reserved for the point weights')
+        self.names = sorted(param_dict.keys())
+        self.free_names = [k for k in self.names if 'expr' not in param_dict[k]]
+        self.dists = [make_distribution(k, param_dict[k]) for k in self.free_names]
+        self.mins = np.array([d.min for d in self.dists], dtype=float)
+        self.maxs = np.array([d.max for d in self.dists], dtype=float)
+
+        # order derived params so each only depends on ones before it
+        self.derived = []  # (name, code)
+        todo = dict((k, compile_expr(v['expr'], k)) for k, v in param_dict.iteritems()
+                    if 'expr' in v)
+        known = set(self.free_names)
+        while todo:
+            ready = sorted(k for k, (_, deps) in todo.iteritems() if known.issuperset(deps))
+            if not ready:
+                raise ValueError('Cannot calculate params %s: unknown names or '
+                                 'circular dependency' % ', '.join(sorted(todo)))
+            for k in ready:
+                self.derived.append((k, todo.pop(k)[0]))
+                known.add(k)
+
+        self.constraints = []  # (expression, code)
+        for expr in constraints:
+            code, deps = compile_expr(expr, 'constraint')
+            unknown = [d for d in deps if d not in known]
+            if unknown:
+                raise ValueError('Unknown names %s in constraint "%s"' % (', '.join(unknown), expr))
+            self.constraints.append((expr, code))
+        # ranges of derived params are constraints too
+        for k, _ in self.derived:
+            for bound, op in [('min', '>='), ('max', '<=')]:
+                if bound in param_dict[k]:
+                    expr = '%s %s %r' % (k, op, param_dict[k][bound])
+                    self.constraints.append((expr, compile(expr, '<constraint>', 'eval')))
+
+    @property
+    def n_dims(self):
+        """Number of free params, i.e. dimensions to sample"""
+        return len(self.free_names)
+
+    def scale(self, unit_points):
+        """Map points in the unit hypercube of the free params to their
+        distributions, and calculate the derived params & the point weights.
+
+        unit_points : numpy.ndarray
+            (n points, n free params) array, columns in order of free_names.
+
+        Returns a dict of {param name: array of values}, plus 'weight'.
+        """
+        unit_points = np.atleast_2d(unit_points)
+        n = len(unit_points)
+        columns = {}
+        weight = np.ones(n)
+        for i, (k, dist) in enumerate(zip(self.free_names, self.dists)):
+            columns[k] = dist.ppf(unit_points[:, i])
+            weight *= dist.weight(columns[k])
+        for k, code in self.derived:
+            columns[k] = eval_expr(code, columns, n)
+        columns['weight'] = weight
+        return columns
+
+    def allowed(self, columns):
+        """Return a boolean array of which points pass all the constraints"""
+        n = len(columns[self.names[0]])
+        mask = np.ones(n, dtype=bool)
+        for _, code in self.constraints:
+            mask &= eval_expr(code, columns, n).astype(bool)
+        return mask
+
+    def point(self, columns, i):
+        """Get point i from columns, as a dict of {param name: value}
+        plus its 'weight'"""
+        return dict((k, float(columns[k][i])) for k in self.names + ['weight'])
@@ -51,7 +51,16 @@ def convert_json_to_tex(param_dict, only_contents):
     for key, prange in param_dict.iteritems():
         key_tex = texify_key(key)
         # key_tex = key
-        tex += r"""        $%s$ & %g - %g \\""" % (key_tex, prange['min'], prange['max'])
+        if 'expr' in prange:
+            # derived param
+            tex += r"""        $%s$ & \texttt{%s} \\""" % (key_tex, prange['expr'])
+        else:
+            lo, hi = prange.get('min'), prange.get('max')
+            if 'edges' in prange:
+                # piecewise distribution
+                lo, hi = prange['edges'][0], prange['edges'][-1]
+            dist = '' if prange.get('dist', 'uniform') == 'uniform' else ' (%s)' % prange['dist']
+            tex += r"""        $%s$ & %g - %g%s \\""" % (key_tex, lo, hi, dist)
         tex += "\n"
     tex += r"""        \hline"""
 
@@ -76,6 +85,7 @@ def main(in_args=sys.argv[1:]):
     # read in JSON file with parameters and bounds
     with open(args.param) as json_file:
         param_dict = json.load(json_file)
+        param_dict.pop('constraints', None)
         # remove any comments
         rm_keys = []
         for k in param_dict.iterkeys():
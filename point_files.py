@@ -0,0 +1,158 @@
+"""
+Read explicit lists of points to run, e.g. benchmark points to re-evaluate
+with new versions of NMSSMTools/HiggsBounds/HiggsSignals.
+
+Points can be in:
+
+- a CSV file: a header row of param names (as in the card comments, e.g.
+  LAMBDA), then one row per point. Columns can be separated by commas or
+  whitespace.
+- a .npy file: either a structured array with a field per param, or a 2D
+  array with one column per param, in an order given by the caller. It is
+  memory-mapped, so only the rows needed are read from disk.
+
+An optional "weight" column gives the weight of each point.
+
+A whole scan can also be sampled up front into a "design" .npy file (see
+sample_design), with each job running its own rows of it, so that no point
+is run twice and the row number identifies each point.
+"""
+
+
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+def split_row(line, delimiter):
+    return [v.strip().strip('"') for v in line.split(delimiter)]
+
+
+def to_float(value):
+    """Convert a string to float, allowing Fortran doubles e.g. 1.5D0"""
+    return float(value.replace('D', 'E').replace('d', 'e'))
+
+
+def load_points(filename, start=0, stop=None, names=None):
+    """Read rows [start, stop) of a points file.
+
+    filename : str
+        CSV or .npy file.
+    start, stop : int
+        Range of rows to read, counting from 0 (after the CSV header).
+    names : list[str]
+        Names of the params to read. Required for .npy files without field
+        names, to name the columns. If None, all columns are read.
+
+    Returns the list of param names, and a dict of {name: array of values}
+    including 'weight' (1 if not in the file).
+    """
+    if filename.endswith('.npy'):
+        names, columns = _load_npy(filename, start, stop, names)
+    else:
+        names, columns = _load_csv(filename, start, stop, names)
+    n = len(columns[names[0]]) if names else 0
+    if 'weight' not in columns:
+        columns['weight'] = np.ones(n)
+    log.info('Read %d points from %s', n, filename)
+    return names, columns
+
+
+def _load_csv(filename, start, stop, names):
+    with open(filename) as f:
+        header_line = f.readline()
+        delimiter = ',' if ',' in header_line else None
+        header = split_row(header_line, delimiter)
+        if names is None:
+            names = [h for h in header if h != 'weight']
+        missing = [k for k in names if k not in header]
+        if missing:
+            raise ValueError('Params %s not in %s' % (', '.join(missing), filename))
+        wanted = [(k, header.index(k)) for k in names + ['weight'] if k in header]
+
+        values = dict((k, []) for k, _ in wanted)
+        row = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if stop is not None and row >= stop:
+                break
+            if row >= start:
+                parts = split_row(line, delimiter)
+                for k, i in wanted:
+                    values[k].append(to_float(parts[i]))
+            row += 1
+    return names, dict((k, np.array(v, dtype=float)) for k, v in values.iteritems())
+
+
+def _load_npy(filename, start, stop, names):
+    points = np.load(filename, mmap_mode='r')
+    rows = points[start:stop]
+    if points.dtype.names:
+        fields = list(points.dtype.names)
+        if names is None:
+            names = [k for k in fields if k != 'weight']
+        missing = [k for k in names if k not in fields]
+        if missing:
+            raise ValueError('Params %s not in %s' % (', '.join(missing), filename))
+        return names, dict((k, np.array(rows[k], dtype=float))
+                           for k in names + ['weight'] if k in fields)
+    if names is None:
+        raise ValueError('Need param names for the columns of %s' % filename)
+    if points.ndim != 2 or points.shape[1] != len(names):
+        raise ValueError('%s should have %d columns, one per param: %s'
+                         % (filename, len(names), ', '.join(names)))
+    return names, dict((k, np.array(rows[:, i], dtype=float)) for i, k in enumerate(names))
+
+
+def count_points(filename):
+    """Number of points (rows) in a points file"""
+    if filename.endswith('.npy'):
+        return len(np.load(filename, mmap_mode='r'))
+    with open(filename) as f:
+        f.readline()
+        return sum(1 for line in f if line.strip())
+
+
+def sample_design(param_space, sampler, n, chunk_size=10000):
+    """Sample n points passing the constraints of param_space.
+
+    param_space : ParamSpace
+        Params to sample.
+    sampler : samplers.Sampler
+        Sampler for points in the unit hypercube of the free params. Points
+        are taken in order from the start of its sequence, so the design
+        can be remade from the sampler & seed.
+
+    Returns a dict of {param name: array of values}, plus 'weight'.
+    """
+    chunks = []
+    n_found, n_sampled = 0, 0
+    while n_found < n:
+        if n_sampled > 100 * n + chunk_size:
+            raise RuntimeError('Only %d of %d points sampled pass the constraints'
+                               % (n_found, n_sampled))
+        columns = param_space.scale(sampler.sample(chunk_size, start=n_sampled))
+        allowed = param_space.allowed(columns)
+        chunks.append(dict((k, v[allowed]) for k, v in columns.iteritems()))
+        n_found += np.count_nonzero(allowed)
+        n_sampled += chunk_size
+    if param_space.constraints:
+        log.info('%d of %d points sampled pass the constraints', n_found, n_sampled)
+    return dict((k, np.concatenate([c[k] for c in chunks])[:n]) for k in chunks[0])
+
+
+def save_points(filename, columns, names):
+    """Save points to a .npy file as a structured array, with a field for
+    each of names, plus 'weight' if in columns.
+
+    columns : dict
+        Map of name to array of values.
+    """
+    fields = names + (['weight'] if 'weight' in columns else [])
+    points = np.empty(len(columns[fields[0]]), dtype=[(str(k), np.float64) for k in fields])
+    for k in fields:
+        points[k] = columns[k]
+    np.save(filename, points)
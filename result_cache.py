@@ -0,0 +1,185 @@
+"""
+On-disk cache of results for parameter points, so re-running a point that
+has been done before (e.g. replaying a list of points, or repeating a scan)
+doesn't need NMSSMTools/HiggsBounds/HiggsSignals to be run again.
+
+Entries are keyed by a hash of the rendered input card, plus a tag that
+identifies the programs used (tool directory names, which include their
+versions, and the contents of the patches applied to them). Each entry
+is a small JSON record (e.g. whether the point was physical), plus the
+gzipped spectrum file for physical points.
+
+The cache is bounded in size: once it grows beyond its maximum size, the
+least recently used entries are removed. Entries are written atomically,
+so several processes can share the same cache directory.
+"""
+
+
+import os
+import glob
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def tool_tag(tool_dirs, patch_files=(), extra=''):
+    """Make a string to identify the programs used to make results.
+
+    tool_dirs : dict
+        Map of tool name to directory, None if the tool isn't used.
+        The directory names are used, since they include the version.
+    patch_files : list[str]
+        Patch files applied to the programs. Their contents are hashed.
+    extra : str
+        Anything else that changes the output, e.g. a user-defined tag.
+    """
+    parts = ['%s=%s' % (k, os.path.basename(os.path.normpath(d)) if d else None)
+             for k, d in sorted(tool_dirs.iteritems())]
+    for patch in sorted(patch_files):
+        with open(patch) as f:
+            parts.append('%s:%s' % (os.path.basename(patch), hashlib.sha1(f.read()).hexdigest()))
+    parts.append(extra)
+    return ';'.join(parts)
+
+
+class CacheStats(object):
+    """Counters for cache use."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def merge(self, other):
+        """Add in another CacheStats, e.g. from a different worker."""
+        self.hits += other.hits
+        self.misses += other.misses
+        self.stored += other.stored
+        self.evicted += other.evicted
+
+
+class ResultCache(object):
+    """Content-addressed cache of results, stored in a directory.
+
+    cache_dir : str
+        Directory to store entries in. Created if it doesn't exist.
+    tag : str
+        Identifies the programs used, see tool_tag(). Part of every key.
+    max_size : float
+        Maximum total size of the cache, in bytes.
+    """
+    def __init__(self, cache_dir, tag, max_size=10E9):
+        self.cache_dir = cache_dir
+        self.tag = tag
+        self.max_size = max_size
+        self.stats = CacheStats()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._size = sum(os.path.getsize(f) for f in self._entry_files())
+
+    def key(self, card_text):
+        """Key for the results of running a given input card"""
+        return hashlib.sha1(self.tag + '\n' + card_text).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def _entry_files(self):
+        return glob.glob(os.path.join(self.cache_dir, '*', '*'))
+
+    def get(self, key, spectr_name=None):
+        """Look up an entry.
+
+        If found, returns its record (a dict), and copies any spectrum
+        stored with it to spectr_name. Returns None if not found.
+        """
+        record_name = self._path(key, '.json')
+        try:
+            with open(record_name) as f:
+                record = json.load(f)
+            if record.get('spectrum') and spectr_name:
+                with gzip.open(self._path(key, '.spectr.gz')) as f_in:
+                    with open(spectr_name, 'w') as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+        except (IOError, ValueError):
+            # missing, or removed whilst reading by another process
+            self.stats.misses += 1
+            return None
+        os.utime(record_name, None)  # mark as recently used
+        self.stats.hits += 1
+        return record
+
+    def put(self, key, record, spectr_name=None):
+        """Store an entry.
+
+        record : dict
+            Record to store, must be JSON-friendly.
+        spectr_name : str
+            Spectrum file to store with it, if any.
+        """
+        record = dict(record, spectrum=bool(spectr_name))
+        entry_dir = os.path.dirname(self._path(key, ''))
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass  # made by another process
+        # write the spectrum first, so a record is never without its spectrum
+        if spectr_name:
+            gz_name = self._path(key, '.spectr.gz')
+            with open(spectr_name) as f_in:
+                f_out = gzip.open(gz_name + '.tmp', 'w')
+                shutil.copyfileobj(f_in, f_out)
+                f_out.close()
+            os.rename(gz_name + '.tmp', gz_name)
+            self._size += os.path.getsize(gz_name)
+        record_name = self._path(key, '.json')
+        with open(record_name + '.tmp', 'w') as f:
+            json.dump(record, f)
+        os.rename(record_name + '.tmp', record_name)
+        self._size += os.path.getsize(record_name)
+        self.stats.stored += 1
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self, fraction=0.9):
+        """Remove least recently used entries, until the cache is below
+        fraction of its maximum size."""
+        entries = {}
+        for f in self._entry_files():
+            if f.endswith('.tmp'):
+                continue
+            key = os.path.basename(f).split('.')[0]
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            last_used, size = entries.get(key, (0, 0))
+            if f.endswith('.json'):
+                last_used = stat.st_mtime
+            entries[key] = (last_used, size + stat.st_size)
+
+        self._size = sum(size for _, size in entries.itervalues())
+        for key, (_, size) in sorted(entries.iteritems(), key=lambda x: x[1][0]):
+            if self._size <= fraction * self.max_size:
+                break
+            for suffix in ['.json', '.spectr.gz']:
+                try:
+                    os.remove(self._path(key, suffix))
+                except OSError:
+                    pass
+            self._size -= size
+            self.stats.evicted += 1
+        log.debug('Cache size now %.1f MB', self._size / 1E6)
+
+    def print_summary(self):
+        # other processes may have added to the cache, so recount its size
+        self._size = sum(os.path.getsize(f) for f in self._entry_files())
+        s = self.stats
+        print '* Cache: %d hits, %d misses, %d stored, %d evicted, %.1f MB in %s' % (
+            s.hits, s.misses, s.stored, s.evicted, self._size / 1E6, self.cache_dir)
@@ -0,0 +1,149 @@
+"""
+Store parsed results (one dict per point, e.g. from
+analyse_scans.parse_spectrum) in columnar binary "shards", so that only these
+need to be kept & transferred instead of every spectrum file.
+
+Each shard is a compressed numpy .npz file with one array per column, holding
+a chunk of points. Numerical columns are stored as int64 or float64 arrays,
+and everything else as string arrays. Missing values are NaN in float
+columns; integer columns with missing values get an extra boolean array
+<column>__missing, so they keep their type. Shards
+are written atomically, so a shard on disk is always complete.
+"""
+
+
+import os
+import glob
+import logging
+import zipfile
+import threading
+import numpy as np
+from cStringIO import StringIO
+
+
+log = logging.getLogger(__name__)
+
+
+MISSING_SUFFIX = '__missing'
+
+
+def column_arrays(name, values):
+    """Convert a list of values for one column to a dict of numpy arrays:
+    the column itself, plus a mask of missing values for integer columns.
+
+    Missing values should be ''.
+    """
+    present = [v for v in values if v != '']
+    if present and all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in present):
+        missing = np.array([v == '' for v in values])
+        arrays = {name: np.array([0 if v == '' else v for v in values], dtype=np.int64)}
+        if missing.any():
+            arrays[name + MISSING_SUFFIX] = missing
+        return arrays
+    if all(isinstance(v, (int, long, float)) for v in present):
+        return {name: np.array([np.nan if v == '' else v for v in values], dtype=np.float64)}
+    return {name: np.array([str(v) for v in values])}
+
+
+class ShardWriter(object):
+    """Collect records and write them out in shards of chunk_size records.
+
+    stem : str
+        Shards are named <stem>_<N>.npz, where N counts up from 0, carrying on
+        from any existing shards.
+    chunk_size : int
+        Number of records per shard.
+    """
+    def __init__(self, stem, chunk_size=1000):
+        self.stem = stem
+        self.chunk_size = chunk_size
+        self.records = []
+        self.files_to_remove = []
+        self.n_shards = len(shard_files(stem))
+        self.n_written = 0
+        self._lock = threading.Lock()  # for adding from several threads
+
+    def add(self, record, files_to_remove=()):
+        """Add a record (a dict of column: value).
+
+        files_to_remove : list[str]
+            Files to delete once the record has been written to a shard,
+            e.g. the spectrum file it came from. This means the information
+            is always on disk somewhere, in case of a crash.
+        """
+        with self._lock:
+            self.records.append(record)
+            self.files_to_remove.extend(files_to_remove)
+            if len(self.records) >= self.chunk_size:
+                self._flush()
+
+    def flush(self):
+        """Write any records collected so far to a new shard"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.records:
+            return
+        columns = sorted(set(k for r in self.records for k in r))
+        arrays = {}
+        for c in columns:
+            arrays.update(column_arrays(c, [r.get(c, '') for r in self.records]))
+        filename = '%s_%d.npz' % (self.stem, self.n_shards)
+        tmp_filename = '%s_%d.tmp.npz' % (self.stem, self.n_shards)
+        write_npz(tmp_filename, arrays)
+        os.rename(tmp_filename, filename)
+        log.debug('Written %d records to %s', len(self.records), filename)
+        self.n_shards += 1
+        self.n_written += len(self.records)
+        self.records = []
+        for f in self.files_to_remove:
+            if os.path.isfile(f):
+                os.remove(f)
+        self.files_to_remove = []
+
+    def close(self):
+        self.flush()
+
+
+def write_npz(filename, arrays):
+    """Write a dict of arrays to a compressed .npz file, as
+    numpy.savez_compressed, but allowing any column names (e.g. 'file')."""
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, arr in arrays.iteritems():
+            buf = StringIO()
+            np.lib.format.write_array(buf, np.asanyarray(arr), allow_pickle=False)
+            zf.writestr(name + '.npy', buf.getvalue())
+
+
+def shard_files(stem):
+    """Get the existing shard files for a stem, in order"""
+    files = glob.glob(stem + '_*.npz')
+    files = [f for f in files if f[len(stem) + 1:-4].isdigit()]
+    return sorted(files, key=lambda f: int(f[len(stem) + 1:-4]))
+
+
+def find_shards(pattern):
+    """Get all complete shard files matching a glob pattern, sorted by name"""
+    return sorted(f for f in glob.glob(pattern) if not f.endswith('.tmp.npz'))
+
+
+def iter_shard_records(filenames):
+    """Generator of records (dicts of column: value) from shard files.
+
+    Missing values are turned back into ''.
+    """
+    for filename in filenames:
+        data = np.load(filename)
+        columns = sorted(c for c in data.files if not c.endswith(MISSING_SUFFIX))
+        arrays = [data[c] for c in columns]
+        masks = [data[c + MISSING_SUFFIX] if c + MISSING_SUFFIX in data.files else None
+                 for c in columns]
+        for i in xrange(len(arrays[0]) if arrays else 0):
+            record = {}
+            for c, a, m in zip(columns, arrays, masks):
+                v = a[i].item()
+                if (m is not None and m[i]) or (isinstance(v, float) and np.isnan(v)):
+                    v = ''
+                record[c] = v
+            yield record
@@ -9,8 +9,7 @@ Does it in multiprocessing mode as it's an embaressing parallel task.
 from analyse_scans import analyse_scans
 import os
 import sys
-from glob import glob, iglob
-from subprocess import check_call
+from glob import glob
 from multiprocessing import Pool
 import contextlib
 from functools import partial
@@ -26,17 +25,12 @@ def do_one_dir(tar_file, job_dir):
 
     pid = os.path.basename(tar_file).replace('spectr', '').split('.')[0]
 
-    tmp_dir = os.path.join(job_dir, 'scratch%s' % pid)
-    if not os.path.isdir(tmp_dir):
-        print 'Making dir', tmp_dir
-        os.makedirs(tmp_dir)
-
-    check_call(['tar', 'xzf', tar_file, '-C', tmp_dir])
-
-    analyse_scans([tmp_dir, '--oDir', job_dir, '--ID', pid])
-
-    for f in iglob(os.path.join(tmp_dir, '*')):
-        os.remove(f)
+    # spectrum files are read straight from the archive
+    analysis_args = [tar_file, '--oDir', job_dir, '--ID', pid]
+    point_log = os.path.join(os.path.dirname(tar_file), 'points%s.csv' % pid)
+    if os.path.isfile(point_log):
+        analysis_args += ['--pointLog', point_log]
+    analyse_scans(analysis_args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,331 @@
+"""
+Samplers to generate points in the unit hypercube [0, 1)^d, which are then
+scaled to the parameter ranges.
+
+Available samplers (see SAMPLERS):
+
+- random: independent uniform random numbers (the original method)
+- sobol: scrambled Sobol sequence
+- halton: scrambled Halton sequence
+- lhs: Latin hypercube
+
+The Sobol and Halton samplers are sequences, so sample(n, start) returns
+points [start, start + n) of the sequence. This means different jobs can take
+disjoint blocks of the same sequence by using different start values.
+The random and lhs samplers instead reseed using start, so different blocks
+are statistically independent.
+
+All samplers are seedable: the same seed gives the same points (and the same
+scrambling).
+"""
+
+
+import random
+import numpy as np
+
+
+class Sampler(object):
+    """Base class for samplers.
+
+    n_dims : int
+        Number of dimensions
+    seed : int
+        Seed for random number generator. None means use system randomness.
+    """
+    def __init__(self, n_dims, seed=None):
+        self.n_dims = n_dims
+        self.seed = seed
+
+    def sample(self, n, start=0):
+        """Return a (n, n_dims) array of points in [0, 1)^n_dims
+
+        n : int
+            Number of points
+        start : int
+            Index of first point. Use this to get a different block of points.
+        """
+        raise NotImplementedError
+
+    def block_seed(self, start):
+        """Seed to use for the block starting at start"""
+        if self.seed is None:
+            return None
+        return (self.seed * 1000003 + start) % (2 ** 32)
+
+
+class RandomSampler(Sampler):
+    """Independent uniform random numbers, using python's random module."""
+    def sample(self, n, start=0):
+        if self.seed is not None:
+            random.seed(self.block_seed(start))
+        return np.array([[random.random() for _ in xrange(self.n_dims)]
+                         for _ in xrange(n)]).reshape(n, self.n_dims)
+
+
+class LatinHypercubeSampler(Sampler):
+    """Latin hypercube: each dimension is split into n equal strata, and each
+    stratum is sampled exactly once, at a random position within it."""
+    def sample(self, n, start=0):
+        rng = np.random.RandomState(self.block_seed(start))
+        points = np.empty((n, self.n_dims))
+        for d in xrange(self.n_dims):
+            points[:, d] = (rng.permutation(n) + rng.uniform(size=n)) / n
+        return points
+
+
+# Initial direction numbers m_k for dimensions 2, 3, ... of the Sobol sequence,
+# from S. Joe and F. Y. Kuo, "Constructing Sobol sequences with better
+# two-dimensional projections", SIAM J. Sci. Comput. 30, 2635 (2008).
+# The corresponding primitive polynomials are generated by
+# primitive_polynomials() in the same order.
+SOBOL_M = [
+    [1],
+    [1, 3],
+    [1, 3, 1],
+    [1, 1, 1],
+    [1, 1, 3, 3],
+    [1, 3, 5, 13],
+    [1, 1, 5, 5, 17],
+    [1, 1, 5, 5, 5],
+    [1, 1, 7, 11, 19],
+    [1, 1, 5, 1, 1],
+    [1, 1, 1, 3, 11],
+    [1, 3, 5, 5, 31],
+    [1, 3, 3, 9, 7, 49],
+    [1, 1, 1, 15, 21, 21],
+    [1, 3, 1, 13, 27, 49],
+    [1, 1, 1, 15, 7, 5],
+    [1, 3, 1, 15, 13, 25],
+    [1, 1, 5, 5, 19, 61],
+    [1, 3, 7, 11, 23, 15, 103],
+    [1, 3, 7, 13, 13, 15, 69],
+    [1, 1, 3, 13, 7, 35, 63],
+    [1, 3, 5, 9, 1, 25, 53],
+    [1, 3, 1, 13, 9, 35, 107],
+    [1, 3, 1, 5, 27, 61, 31],
+    [1, 1, 5, 11, 19, 41, 61],
+    [1, 3, 5, 3, 3, 13, 69],
+    [1, 1, 7, 13, 1, 19, 1],
+    [1, 3, 7, 5, 13, 19, 59],
+]
+
+
+def primitive_polynomials():
+    """Generator of primitive polynomials over GF(2), in order of degree then
+    value. Each is returned as (degree, a), where a holds the coefficients
+    of the middle terms as in Joe & Kuo (the leading and constant terms are
+    always 1)."""
+    degree = 1
+    while True:
+        for a in xrange(2 ** (degree - 1)):
+            poly = (1 << degree) | (a << 1) | 1
+            if _is_primitive(poly, degree):
+                yield degree, a
+        degree += 1
+
+
+def _is_primitive(poly, degree):
+    """Check if a polynomial over GF(2) (stored as bits) of given degree is
+    primitive, i.e. x has order 2^degree - 1 modulo poly."""
+    order = 2 ** degree - 1
+    # prime factors of the order
+    factors, n, p = [], order, 2
+    while p * p <= n:
+        if n % p == 0:
+            factors.append(p)
+            while n % p == 0:
+                n //= p
+        p += 1
+    if n > 1:
+        factors.append(n)
+
+    def x_pow(e):
+        """x^e mod poly"""
+        result, base = 1, 2
+        while e:
+            if e & 1:
+                result = _mulmod(result, base, poly, degree)
+            base = _mulmod(base, base, poly, degree)
+            e >>= 1
+        return result
+
+    if x_pow(order) != 1:
+        return False
+    return all(x_pow(order // f) != 1 for f in factors)
+
+
+def _mulmod(a, b, poly, degree):
+    """Multiply two polynomials over GF(2) modulo poly"""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a >> degree & 1:
+            a ^= poly
+    return result
+
+
+class SobolSampler(Sampler):
+    """Sobol sequence, with random linear matrix scrambling and a digital
+    shift (as in e.g. Owen, "Scrambling Sobol' and Niederreiter-Xing points",
+    J. Complexity 14, 466 (1998)).
+
+    Dimensions beyond the Joe & Kuo table get random (valid, but not
+    optimised) initial direction numbers.
+
+    scramble : bool
+        If False, gives the plain Sobol sequence.
+    """
+    n_bits = 32
+
+    def __init__(self, n_dims, seed=None, scramble=True):
+        super(SobolSampler, self).__init__(n_dims, seed)
+        rng = np.random.RandomState(seed)
+        directions = self.direction_numbers(n_dims)
+        self.shift = np.zeros(n_dims, dtype=np.uint64)
+        if scramble:
+            for d in xrange(n_dims):
+                directions[d] = self._scramble_matrix(directions[d], rng)
+            self.shift = rng.randint(0, 2 ** 16, size=(n_dims, 2)).astype(np.uint64)
+            self.shift = (self.shift[:, 0] << np.uint64(16)) | self.shift[:, 1]
+        self.directions = np.array(directions, dtype=np.uint64)  # (n_dims, n_bits)
+
+    @classmethod
+    def direction_numbers(cls, n_dims):
+        """Direction numbers v_k (as n_bits-bit integers) for each dimension"""
+        n_bits = cls.n_bits
+        rng = np.random.RandomState(1)
+        # first dimension is the van der Corput sequence
+        directions = [[1 << (n_bits - 1 - k) for k in xrange(n_bits)]]
+        polys = primitive_polynomials()
+        for d in xrange(1, n_dims):
+            s, a = next(polys)
+            if d - 1 < len(SOBOL_M):
+                m = list(SOBOL_M[d - 1])
+            else:
+                m = [2 * rng.randint(0, 2 ** k) + 1 for k in xrange(s)]
+            for k in xrange(s, n_bits):
+                new_m = m[k - s] ^ (m[k - s] << s)
+                for j in xrange(1, s):
+                    if a >> (s - 1 - j) & 1:
+                        new_m ^= m[k - j] << j
+                m.append(new_m)
+            directions.append([m[k] << (n_bits - 1 - k) for k in xrange(n_bits)])
+        return directions
+
+    def _scramble_matrix(self, directions, rng):
+        """Multiply each direction number by a random lower-triangular
+        binary matrix with unit diagonal."""
+        n_bits = self.n_bits
+        lower = np.tril(rng.randint(0, 2, size=(n_bits, n_bits)), -1) + np.eye(n_bits, dtype=int)
+        scrambled = []
+        for v in directions:
+            # bit j of the fraction is bit (n_bits - 1 - j) of the integer
+            bits = np.array([(v >> (n_bits - 1 - j)) & 1 for j in xrange(n_bits)])
+            new_bits = lower.dot(bits) % 2
+            scrambled.append(sum(int(b) << (n_bits - 1 - j) for j, b in enumerate(new_bits)))
+        return scrambled
+
+    def sample(self, n, start=0):
+        index = np.arange(start, start + n, dtype=np.uint64)
+        ints = np.zeros((n, self.n_dims), dtype=np.uint64)
+        for k in xrange(self.n_bits):
+            bit = ((index >> np.uint64(k)) & np.uint64(1)).astype(bool)
+            ints[bit] ^= self.directions[:, k]
+        ints ^= self.shift
+        return ints.astype(np.float64) / 2. ** self.n_bits
+
+
+def first_primes(n):
+    """Return the first n prime numbers"""
+    primes = []
+    candidate = 2
+    while len(primes) < n:
+        if all(candidate % p for p in primes if p * p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+class HaltonSampler(Sampler):
+    """Halton sequence, using the first n_dims primes as bases, with each
+    digit scrambled by a random permutation (different for each digit
+    position and dimension).
+
+    Point 0 of the unscrambled sequence is the origin, so the sequence
+    starts from index 1.
+
+    scramble : bool
+        If False, gives the plain Halton sequence.
+    """
+    def __init__(self, n_dims, seed=None, scramble=True):
+        super(HaltonSampler, self).__init__(n_dims, seed)
+        rng = np.random.RandomState(seed)
+        self.bases = first_primes(n_dims)
+        # enough digits to reach double precision
+        self.n_digits = [int(np.ceil(53 * np.log(2) / np.log(b))) for b in self.bases]
+        self.perms = []
+        for b, n_digits in zip(self.bases, self.n_digits):
+            if scramble:
+                self.perms.append([rng.permutation(b) for _ in xrange(n_digits)])
+            else:
+                self.perms.append([np.arange(b)] * n_digits)
+
+    def sample(self, n, start=0):
+        index = np.arange(start + 1, start + n + 1, dtype=np.int64)
+        points = np.zeros((n, self.n_dims))
+        for d, b in enumerate(self.bases):
+            remaining = index.copy()
+            scale = 1.
+            for perm in self.perms[d]:
+                scale /= b
+                points[:, d] += perm[remaining % b] * scale
+                remaining //= b
+        return points
+
+
+SAMPLERS = {
+    'random': RandomSampler,
+    'lhs': LatinHypercubeSampler,
+    'sobol': SobolSampler,
+    'halton': HaltonSampler,
+}
+
+
+def get_sampler(name, n_dims, seed=None):
+    """Make a sampler by name, one of SAMPLERS."""
+    if name not in SAMPLERS:
+        raise KeyError('Unknown sampler %s, must be one of %s' % (name, ', '.join(sorted(SAMPLERS))))
+    return SAMPLERS[name](n_dims, seed=seed)
+
+
+def centered_discrepancy(points, max_elements=10 ** 7):
+    """Centered L2 discrepancy of points in [0, 1)^d (Hickernell 1998).
+
+    Smaller is more uniform. Useful for comparing samplers with the same
+    number of points & dimensions.
+
+    points : numpy.ndarray
+        (n, d) array of points
+    max_elements : int
+        Maximum size of temporary arrays in the O(n^2) term, to limit memory.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n, d = points.shape
+    if n == 0:
+        return 0.
+    dist = np.abs(points - 0.5)
+    term1 = (13. / 12.) ** d
+    term2 = np.sum(np.prod(1. + 0.5 * dist - 0.5 * dist ** 2, axis=1)) * 2. / n
+    term3 = 0.
+    chunk_size = max(1, max_elements // (n * d))
+    for i in xrange(0, n, chunk_size):
+        di = dist[i:i + chunk_size, np.newaxis, :]
+        xi = points[i:i + chunk_size, np.newaxis, :]
+        prod = np.prod(1. + 0.5 * di + 0.5 * dist[np.newaxis, :, :]
+                       - 0.5 * np.abs(xi - points[np.newaxis, :, :]), axis=2)
+        term3 += np.sum(prod)
+    term3 /= n ** 2
+    return np.sqrt(max(term1 - term2 + term3, 0.))
@@ -0,0 +1,171 @@
+"""
+Logs & checkpoints for scans, so an interrupted scan can be resumed.
+
+PointLog is an append-only CSV file with one row per finished point,
+including unphysical points (whose spectrum files get deleted). Each row is
+flushed & synced to disk as soon as the point is done, so at most the
+points in flight are lost if the job is killed. It is also useful to train
+a surrogate model to predict which points are worth running.
+
+Checkpoint is a small JSON file with the scan settings and the state that
+can't be recovered from the point log (e.g. the state of an MCMC chain).
+It is rewritten atomically, so there is always a complete copy on disk.
+"""
+
+
+import os
+import json
+import logging
+import threading
+import numpy as np
+from timeit import default_timer as timer
+
+
+log = logging.getLogger(__name__)
+
+
+class PointLog(object):
+    """Append one CSV row per point: its index, param values, whether it was
+    physical, and whether it was only run for surrogate exploration.
+
+    filename : str
+        CSV file to write to. The header is written if the file is new.
+    param_names : list[str]
+        Names of params (and e.g. the point weight), in column order.
+    append : bool
+        If True, add to any existing file, otherwise start a new one.
+
+    The file is opened lazily in append mode, so one PointLog can be shared
+    by several worker processes.
+    """
+    def __init__(self, filename, param_names, append=False):
+        self.filename = filename
+        self.param_names = list(param_names)
+        self._f = None
+        self._lock = threading.Lock()  # for writing from several threads
+        if not append or not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            with open(filename, 'w') as f:
+                f.write(','.join(['index'] + self.param_names + ['physical', 'explored']) + '\n')
+
+    def write(self, ind, values, physical, explored=False):
+        """Add a row for a point"""
+        row = [str(ind)] + [repr(values[k]) for k in self.param_names]
+        row += [str(int(physical)), str(int(explored))]
+        with self._lock:
+            if self._f is None:
+                self._f = open(self.filename, 'a')
+            self._f.write(','.join(row) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+
+def read_point_log(filename):
+    """Read the points already done from a PointLog file.
+
+    Any incomplete last line (e.g. from the job being killed mid-write)
+    is removed from the file.
+
+    Returns a dict of {index: physical}. If a point appears more than once,
+    the last row wins.
+    """
+    done = {}
+    if not os.path.isfile(filename):
+        return done
+    truncate_partial_line(filename)
+    with open(filename) as f:
+        header = f.readline().strip().split(',')
+        i_physical = header.index('physical')
+        for line in f:
+            row = line.strip().split(',')
+            done[int(row[0])] = bool(int(row[i_physical]))
+    return done
+
+
+def read_point_log_column(filename, column, convert=float):
+    """Read one column from a PointLog file, e.g. the point weights.
+
+    Returns a dict of {index: value}, empty if the file or column is missing.
+    """
+    values = {}
+    if not os.path.isfile(filename):
+        return values
+    with open(filename) as f:
+        header = f.readline().strip().split(',')
+        if column not in header:
+            return values
+        i_col = header.index(column)
+        for line in f:
+            row = line.strip().split(',')
+            if len(row) == len(header):
+                values[int(row[0])] = convert(row[i_col])
+    return values
+
+
+def truncate_partial_line(filename):
+    """Remove anything after the last newline in a file"""
+    with open(filename, 'rb+') as f:
+        contents = f.read()
+        end = contents.rfind('\n') + 1
+        if end != len(contents):
+            log.warning('Removing incomplete line from %s', filename)
+            f.truncate(end)
+
+
+class Checkpoint(object):
+    """Periodically save the state of a scan to a JSON file.
+
+    filename : str
+        JSON file to write to.
+    interval : float
+        Minimum time between saves in seconds, for due().
+    """
+    def __init__(self, filename, interval=120):
+        self.filename = filename
+        self.interval = interval
+        self.state = {}
+        self._last_save = timer()
+
+    def load(self):
+        """Load the state from file. Returns None if there is no file."""
+        if not os.path.isfile(self.filename):
+            return None
+        with open(self.filename) as f:
+            self.state = json.load(f)
+        return self.state
+
+    def save(self, **state):
+        """Update the state with any keyword args, and write it to file.
+
+        The file is written to a temporary file first then renamed, so a
+        crash can't leave a half-written checkpoint.
+        """
+        self.state.update(state)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+        self._last_save = timer()
+        log.debug('Saved checkpoint to %s', self.filename)
+
+    def due(self):
+        """Return True if at least interval seconds have passed since the last save"""
+        return timer() - self._last_save >= self.interval
+
+
+def rng_state_to_json(rng):
+    """Get the state of a numpy RandomState as a JSON-friendly list"""
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+
+def rng_state_from_json(rng, state):
+    """Set the state of a numpy RandomState from rng_state_to_json()"""
+    name, keys, pos, has_gauss, cached_gaussian = state
+    rng.set_state((str(name), np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+Metrics for where the time goes in a scan: wall time per point for each stage
+(as histograms), points per second, and how often each NMSSMTools SPINFO
+failure comes up.
+
+NMSSMScan.py writes these as a JSON sidecar, metrics<batch>.json, next to its
+other outputs. Run this script over a jobs_* directory to merge the sidecars
+of all its jobs and print a summary:
+
+    python scan_metrics.py jobs_100_test_... [--output merged.json]
+"""
+
+
+import os
+import re
+import sys
+import json
+import argparse
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# name of the sidecar written by each job
+SIDECAR_NAME = re.compile(r'^metrics\d+\.json$')
+
+# stages of running a point, in order
+STAGES = ['card', 'NMSSMTools', 'check', 'HiggsBounds', 'HiggsSignals', 'parse', 'io']
+
+# edges of the time histogram bins, in seconds: 4 per decade from 0.1 ms to
+# 1000 s. Times outside go in the first/last bin.
+BINS_PER_DECADE = 4
+MIN_EXP, MAX_EXP = -4, 3
+BIN_EDGES = [10 ** (MIN_EXP + float(i) / BINS_PER_DECADE)
+             for i in xrange((MAX_EXP - MIN_EXP) * BINS_PER_DECADE + 1)]
+
+
+class TimeHistogram(object):
+    """Histogram of times per point, in log-spaced bins (see BIN_EDGES)"""
+    def __init__(self):
+        self.counts = [0] * (len(BIN_EDGES) - 1)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds, n=1):
+        """Add n points that each took seconds"""
+        i = 0
+        while i < len(self.counts) - 1 and seconds >= BIN_EDGES[i + 1]:
+            i += 1
+        self.counts[i] += n
+        self.n += n
+        self.total += seconds * n
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Approximate quantile q of the times, as the upper edge of the bin
+        it falls in (or the max time, if less)"""
+        target = q * self.n
+        n = 0
+        for i, count in enumerate(self.counts):
+            n += count
+            if count and n >= target:
+                return min(BIN_EDGES[i + 1], self.max)
+        return 0.
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else 0.
+
+    def to_json(self):
+        return {'counts': self.counts, 'n': self.n, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_json(cls, data):
+        hist = cls()
+        hist.counts = data['counts']
+        hist.n = data['n']
+        hist.total = data['total']
+        hist.max = data['max']
+        return hist
+
+
+class ScanMetrics(object):
+    """Collect per-stage timings, point counts & SPINFO failures for a scan.
+
+    Safe to use from several threads. Worker processes should each use their
+    own, to be merged at the end.
+    """
+    def __init__(self):
+        self.stages = OrderedDict((s, TimeHistogram()) for s in STAGES)
+        self.failures = {}  # SPINFO message: number of points
+        self.n_points = 0
+        self.n_physical = 0
+        self.wall = 0.  # of previous runs, e.g. before resuming
+        self.n_jobs = 1
+        self._start = timer()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, stage, n_points=1):
+        """Context manager to time a stage, run over n_points points at once.
+        The time is shared out equally between the points."""
+        start = timer()
+        try:
+            yield
+        finally:
+            self.add_time(stage, timer() - start, n_points)
+
+    def add_time(self, stage, seconds, n_points=1):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = TimeHistogram()
+            self.stages[stage].add(seconds / n_points, n_points)
+
+    def add_point(self, physical):
+        """Count a finished point"""
+        with self._lock:
+            self.n_points += 1
+            self.n_physical += int(physical)
+
+    def add_failures(self, messages):
+        """Count the SPINFO failures for a point (see slha_parser.ParsePlan.parse)"""
+        with self._lock:
+            for m in messages:
+                self.failures[m] = self.failures.get(m, 0) + 1
+
+    @property
+    def wall_time(self):
+        """Wall time of the scan so far, in seconds"""
+        if self._start is None:
+            return self.wall
+        return self.wall + timer() - self._start
+
+    def stop(self):
+        """Stop the wall time clock"""
+        self.wall = self.wall_time
+        self._start = None
+
+    def merge(self, other):
+        """Add in another ScanMetrics, e.g. from a worker process. Its wall
+        time isn't added, as it ran at the same time."""
+        with self._lock:
+            for stage, hist in other.stages.iteritems():
+                self.stages.setdefault(stage, TimeHistogram()).merge(hist)
+            for m, n in other.failures.iteritems():
+                self.failures[m] = self.failures.get(m, 0) + n
+            self.n_points += other.n_points
+            self.n_physical += other.n_physical
+
+    def to_json(self):
+        wall = self.wall_time
+        with self._lock:
+            # failures copied, as they may be saved whilst the scan carries on
+            return {'n_jobs': self.n_jobs,
+                    'n_points': self.n_points,
+                    'n_physical': self.n_physical,
+                    'wall': wall,
+                    'points_per_second': self.n_points / wall if wall else 0.,  # per job
+                    'bin_edges': BIN_EDGES,
+                    'stages': OrderedDict((s, h.to_json()) for s, h in self.stages.iteritems()),
+                    'failures': dict(self.failures)}
+
+    @classmethod
+    def from_json(cls, data):
+        """Make a ScanMetrics from to_json(). Its wall time carries on from
+        the saved one."""
+        metrics = cls()
+        metrics.n_jobs = data.get('n_jobs', 1)
+        metrics.n_points = data['n_points']
+        metrics.n_physical = data['n_physical']
+        metrics.wall = data['wall']
+        for s, h in data['stages'].iteritems():
+            metrics.stages[s] = TimeHistogram.from_json(h)
+        metrics.failures = data['failures']
+        return metrics
+
+    def write(self, filename):
+        """Write the metrics to a JSON file"""
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_json(json.load(f, object_pairs_hook=OrderedDict))
+
+    def print_summary(self):
+        """Print a table of time per stage, then the SPINFO failures"""
+        wall = self.wall_time
+        print '* Points: %d, physical: %d, %.3g points/s per job (%.0f s wall over %d job(s))' % (
+            self.n_points, self.n_physical, self.n_points / wall if wall else 0., wall, self.n_jobs)
+        print '* %-12s %8s %10s %6s %10s %10s %10s' % ('Stage', 'Points', 'Total [s]', 'Frac',
+                                                       'Mean [s]', 'p90 [s]', 'Max [s]')
+        total = sum(h.total for h in self.stages.itervalues()) or 1.
+        for stage, h in self.stages.iteritems():
+            if not h.n:
+                continue
+            print '* %-12s %8d %10.1f %6.3f %10.3g %10.3g %10.3g' % (
+                stage, h.n, h.total, h.total / total, h.mean, h.quantile(0.9), h.max)
+        for m, n in sorted(self.failures.iteritems(), key=lambda x: (-x[1], x[0])):
+            print '* %7d  %s' % (n, m)
+
+
+def find_sidecars(directory):
+    """Find all metrics sidecars (metrics<batch>.json) under directory. Other
+    JSON files, e.g. a merged --output file, are left out."""
+    found = []
+    for root, _, files in os.walk(directory):
+        found.extend(os.path.join(root, f) for f in files if SIDECAR_NAME.match(f))
+    return sorted(found)
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('jobDir',
+                        help='Directory to look for metrics<batch>.json sidecars in, '
+                        'e.g. a jobs_* directory')
+    parser.add_argument('--output',
+                        help='Write the merged metrics to this JSON file')
+    args = parser.parse_args(in_args)
+
+    sidecars = find_sidecars(args.jobDir)
+    if not sidecars:
+        log.error('No metrics<batch>.json files in %s', args.jobDir)
+        return
+    log.info('Merging %d sidecars', len(sidecars))
+
+    merged = ScanMetrics()
+    merged.stop()
+    merged.n_jobs = 0
+    for filename in sidecars:
+        metrics = ScanMetrics.load(filename)
+        merged.merge(metrics)
+        merged.wall += metrics.wall
+        merged.n_jobs += metrics.n_jobs
+
+    print '*' * 40
+    merged.print_summary()
+    print '*' * 40
+    if args.output:
+        merged.write(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Simple threaded pipeline, to overlap different stages of processing a point.
+
+Each stage has its own pool of threads, and stages are connected by bounded
+queues, so e.g. NMSSMTools can be running on point i+1 whilst HiggsBounds is
+running on point i. Since the heavy lifting is done by external programs,
+threads are fine here (the GIL is released whilst waiting on them).
+
+The depth of each queue is sampled periodically: the stage with the fullest
+input queue is the bottleneck.
+"""
+
+
+import logging
+import threading
+from Queue import Queue
+from collections import namedtuple
+from timeit import default_timer as timer
+
+
+log = logging.getLogger(__name__)
+
+
+# A stage in the pipeline:
+# - name: for reporting
+# - func: called as func(item, thread_id) for each item. Should return the
+#   item to pass onto the next stage, or None to drop it.
+# - n_threads: number of threads to run func in
+Stage = namedtuple('Stage', ['name', 'func', 'n_threads'])
+
+
+# put on a queue to tell a thread there are no more items
+_STOP = object()
+
+
+class StageStats(object):
+    """Counters for one stage of the pipeline."""
+    def __init__(self):
+        self.n_in = 0
+        self.n_out = 0
+        self.busy = 0.
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.n_samples = 0
+
+    @property
+    def depth_mean(self):
+        return self.depth_sum / float(max(self.n_samples, 1))
+
+
+class Pipeline(object):
+    """Run items through a series of stages.
+
+    stages : list[Stage]
+        Stages to run, in order.
+    maxsize : int
+        Maximum number of items waiting in the queue before each stage.
+    sample_interval : float
+        How often to sample the queue depths, in seconds.
+    """
+    def __init__(self, stages, maxsize=4, sample_interval=1.):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.sample_interval = sample_interval
+        self.stats = [StageStats() for _ in stages]
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        """Pass each item in items through all the stages.
+
+        Returns once all items have been through the pipeline.
+        If iterating over items raises, the items already queued are
+        finished & the threads stopped before the exception is passed on.
+        """
+        queues = [Queue(maxsize=self.maxsize) for _ in self.stages]
+        n_running = [s.n_threads for s in self.stages]
+
+        threads = []
+        for ind, stage in enumerate(self.stages):
+            for thread_id in xrange(stage.n_threads):
+                t = threading.Thread(target=self._work, args=(ind, thread_id, queues, n_running),
+                                     name='%s_%d' % (stage.name, thread_id))
+                t.start()
+                threads.append(t)
+
+        finished = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(queues, finished))
+        monitor.daemon = True
+        monitor.start()
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # stop the threads even if items raised, otherwise they wait
+            # for more items forever
+            for _ in xrange(self.stages[0].n_threads):
+                queues[0].put(_STOP)
+
+            for t in threads:
+                t.join()
+            finished.set()
+            monitor.join()
+
+    def _work(self, ind, thread_id, queues, n_running):
+        """Thread for one stage: process items until told to stop"""
+        stage, stats = self.stages[ind], self.stats[ind]
+        out_queue = queues[ind + 1] if ind + 1 < len(queues) else None
+        for item in iter(queues[ind].get, _STOP):
+            start = timer()
+            try:
+                result = stage.func(item, thread_id)
+            except Exception:
+                log.exception('Error in stage %s', stage.name)
+                result = None
+            with self._lock:
+                stats.n_in += 1
+                stats.busy += timer() - start
+                if result is not None:
+                    stats.n_out += 1
+            if result is not None and out_queue:
+                out_queue.put(result)
+
+        # last thread in this stage to finish tells the next stage to stop
+        with self._lock:
+            n_running[ind] -= 1
+            last = n_running[ind] == 0
+        if last and out_queue:
+            for _ in xrange(self.stages[ind + 1].n_threads):
+                out_queue.put(_STOP)
+
+    def _monitor(self, queues, finished):
+        """Periodically sample the depth of each queue"""
+        while not finished.wait(self.sample_interval):
+            depths = [q.qsize() for q in queues]
+            log.debug('Queue depths: %s', ', '.join('%s: %d' % (stage.name, d)
+                                                    for stage, d in zip(self.stages, depths)))
+            for depth, stats in zip(depths, self.stats):
+                stats.depth_sum += depth
+                stats.depth_max = max(stats.depth_max, depth)
+                stats.n_samples += 1
+
+    def print_summary(self):
+        """Print a table of items, busy time and input queue depth per stage."""
+        print '* %-12s %7s %7s %7s %10s %10s %9s' % ('Stage', 'Threads', 'In', 'Out',
+                                                   'Busy [s]', 'Mean queue', 'Max queue')
+        for stage, s in zip(self.stages, self.stats):
+            print '* %-12s %7d %7d %7d %10.1f %10.2f %9d' % (stage.name, stage.n_threads,
+                                                            s.n_in, s.n_out, s.busy,
+                                                            s.depth_mean, s.depth_max)
@@ -0,0 +1,132 @@
+"""
+Targets for when to stop a scan, so a job can finish as soon as it has
+delivered the points needed, instead of always running a fixed number.
+
+Targets are counts of finished points, updated online from each point's
+parsed results:
+
+- physical points
+- "good" points, passing the relaxed constraints (as in
+  analyse_scans.pass_constraints)
+- points passing a custom filter, a python expression of the result fields
+  (as in analyse_scans.parse_spectrum), plus `physical` and `good`,
+  e.g. "good and ma1 < 11"
+
+plus budgets for the wall-clock time and CPU time used. The scan stops once
+all the count targets are reached, or any budget is used up.
+"""
+
+
+import os
+import logging
+import threading
+from timeit import default_timer as timer
+from analyse_scans import pass_constraints
+
+
+log = logging.getLogger(__name__)
+
+
+class ScanTargets(object):
+    """Count points towards targets, and decide when to stop.
+
+    physical : int
+        Target number of physical points.
+    good : int
+        Target number of points passing the relaxed constraints.
+    filters : list[(str, int)]
+        (expression, target number) of points passing custom filters.
+    max_time : float
+        Wall-clock budget in seconds, from when this object is made.
+    max_cpu : float
+        CPU budget in seconds, including all the programs run.
+    """
+    def __init__(self, physical=None, good=None, filters=None, max_time=None, max_cpu=None):
+        self.counts = []  # [name, target, number so far]
+        if physical:
+            self.counts.append(['physical', physical, 0])
+        if good:
+            self.counts.append(['good', good, 0])
+        self.filters = []
+        for expr, target in filters or []:
+            self.filters.append((expr, compile(expr, '<targetFilter>', 'eval')))
+            self.counts.append([expr, target, 0])
+        self.max_time = max_time
+        self.max_cpu = max_cpu
+        self.n_points = 0
+        self.stop_reason = None
+        self._start = timer()
+        self._lock = threading.Lock()  # for adding from several threads
+
+    def __nonzero__(self):
+        return bool(self.counts or self.max_time or self.max_cpu)
+
+    @property
+    def needs_results(self):
+        """Whether the parsed results are needed to count points"""
+        return any(name != 'physical' for name, _, _ in self.counts)
+
+    def add(self, physical, results=None):
+        """Count a finished point.
+
+        results : dict
+            Parsed results for a physical point, if needs_results.
+        """
+        passed = {'physical': physical}
+        if physical and results is not None:
+            namespace = dict(results, physical=physical, good=pass_constraints(results))
+            passed['good'] = namespace['good']
+            for expr, code in self.filters:
+                try:
+                    passed[expr] = bool(eval(code, {'__builtins__': {}}, namespace))
+                except Exception as e:
+                    log.warning('Error evaluating target filter "%s": %s', expr, e)
+        with self._lock:
+            self.n_points += 1
+            for count in self.counts:
+                count[2] += int(passed.get(count[0], False))
+
+    def cpu_time(self, other_cpu=0.):
+        """CPU time used so far in seconds: by this process and any finished
+        child processes (i.e. the programs run), plus other_cpu, e.g. used by
+        worker processes."""
+        return sum(os.times()[:4]) + other_cpu
+
+    def reached(self, other_cpu=0.):
+        """Return the reason to stop the scan, or None to carry on.
+
+        other_cpu : float
+            CPU time used by other processes not yet finished, e.g. workers.
+        """
+        if self.stop_reason:
+            return self.stop_reason
+        if self.counts and all(n >= target for _, target, n in self.counts):
+            self.stop_reason = 'targets reached'
+        elif self.max_time and timer() - self._start >= self.max_time:
+            self.stop_reason = 'time budget of %g s used' % self.max_time
+        elif self.max_cpu and self.cpu_time(other_cpu) >= self.max_cpu:
+            self.stop_reason = 'CPU budget of %g s used' % self.max_cpu
+        if self.stop_reason:
+            log.info('Stopping scan after %d points: %s', self.n_points, self.stop_reason)
+        return self.stop_reason
+
+    def print_summary(self):
+        for name, target, n in self.counts:
+            print '* Target %s: %d / %d' % (name, n, target)
+        if self.stop_reason:
+            print '* Stopped after %d points: %s' % (self.n_points, self.stop_reason)
+
+
+def until_targets(points, targets, other_cpu=lambda: 0.):
+    """Generator to pass on points until the targets are reached.
+
+    points : iterable
+        Points to run
+    targets : ScanTargets
+    other_cpu : callable
+        Returns the CPU time used by other processes, see ScanTargets.reached
+    """
+    for point in points:
+        if targets.reached(other_cpu()):
+            return
+        yield point
@@ -0,0 +1,375 @@
+"""
+Parse SLHA files (e.g. NMSSMTools spectrum files) by looking up each line of
+a block by its indices, instead of trying every field's regex on it.
+
+Each data line is split once into tokens (the part before the first #), and
+its comment (the part after). Each Field becomes a FieldPattern: the tokens
+it expects at the end of the data part - literal indices, the value, or any
+token of a character class - plus the text its comment starts with. The
+patterns of a block are stored in dicts keyed by their literal tokens, one
+dict per layout (number of tokens & which are literal), so each line only
+needs a dict lookup per layout, typically one.
+
+Fields can be declared by block & index, e.g.
+
+    Field(block='EXTPAR', name='lambda', type=float, index=(61,), comment='LAMBDA')
+
+for a line "61 <value> # LAMBDA". Fields declared with a regex of the form
+
+    r' +61 +([E\d\.\-\+]+) +\# LAMBDA'
+
+i.e. whitespace-separated tokens, then # and the comment, are converted
+automatically. Any other regex (e.g. to pick a value out of a comment line)
+is tried on each line of its block, as before.
+
+As before, each field takes its value from the first line in the file that
+matches it, and fields are tried in the order given.
+
+All this is worked out once for a list of fields, in a ParsePlan, which is
+then reused for every file:
+
+    plan = ParsePlan(NMSSMToolsFields.nmssmtools_fields)
+    for filename in filenames:
+        results = plan.parse(filename)
+
+For NMSSMTools spectrum files, the plan can also read the failed constraints
+in BLOCK SPINFO in the same pass (see ParsePlan).
+"""
+
+
+import re
+import string
+import logging
+from operator import itemgetter
+from itertools import izip
+from collections import defaultdict
+from NMSSMToolsFields import Field
+
+
+log = logging.getLogger(__name__)
+
+
+# separator between tokens in a field regex, ' +' or ' '
+_SEPARATOR = re.compile(r' +\+?')
+# character class token in a field regex, e.g. ([E\d\.\-\+]+), [01\-], \d
+_CLASS_TOKEN = re.compile(r'^(\(?)(\[[^\]]+\]|\\d)(\+?)(\)?)$')
+_METACHARS = set('.^$*+?{}[]()|\\')
+
+# converted field regexes: {pattern: (tokens, value position, comment) or None}
+_converted = {}
+
+
+# put these outside to get compiled once, then used lots of times
+p_id = re.compile(r' *3 *# *')  # needed to remove identifier
+p_space = re.compile(r'\s{2,}')  # needed to remove surplus spaces
+
+
+def constraint_message(line):
+    """Get the message from a SPINFO line for a failed constraint (code 3),
+    e.g. '3  # Muon magn. mom. more than 2 sigma away'"""
+    line = p_id.sub('', line)
+    line = line.replace(',', '')  # important as CSV file
+    return p_space.sub(' ', line)
+
+
+def is_block_line(line):
+    return line.startswith(('BLOCK', 'Block'))
+
+
+def block_name(line):
+    """Get the name of the block from a BLOCK line, e.g. 'MASS'"""
+    return line.split('#')[0].replace('BLOCK ', '').replace("Block ", '').strip().split(' ')[0]
+
+
+def _unescape(text, allowed=''):
+    """Turn literal regex text into the text it matches, e.g. 'BR\(H_1\)' ->
+    'BR(H_1)'. Returns None if it has any (unescaped) metacharacters except
+    those in allowed."""
+    if set(re.sub(r'\\.', '', text)) & (_METACHARS - set(allowed)):
+        return None
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def _char_class(spec):
+    """Get the set of characters matched by a regex character class, e.g.
+    '[E\d\.]' or '\d'. Returns None for classes that aren't just a list of
+    characters (e.g. ranges or negation)."""
+    if spec == r'\d':
+        return frozenset(string.digits)
+    spec = spec[1:-1]
+    if spec.startswith('^') or re.search(r'[^\\]-', spec):
+        return None
+    chars = set()
+    for escaped, char in re.findall(r'(\\)?(.)', spec):
+        chars.update(string.digits if escaped and char == 'd' else char)
+    return frozenset(chars)
+
+
+def key_getter(positions):
+    """Make a function to get the key of a list of tokens, from the tokens
+    at positions"""
+    if not positions:
+        return lambda tokens: ()
+    return itemgetter(*positions)
+
+
+class FieldPattern(object):
+    """What a Field expects of a line: the last tokens of its data part (see
+    layout), and the start of its comment.
+
+    field : Field
+    order : int
+        Position of the field in the list of fields, lower takes priority.
+    slot : int
+        Position of the field's value in the parsed values (see ParsePlan).
+    tokens : list
+        The tokens expected, each either a literal str, or a tuple of
+        (set of allowed characters, whether it can be longer than 1 char).
+    value_pos : int
+        Position of the value in tokens.
+    comment : str
+        Text the comment must start with (ignoring leading spaces), or None.
+    """
+    def __init__(self, field, order, slot, tokens, value_pos, comment):
+        self.field = field
+        self.order = order
+        self.slot = slot
+        self.tokens = tokens
+        self.value_pos = value_pos
+        self.comment = comment
+        self.literal_pos = tuple(i for i, t in enumerate(tokens) if isinstance(t, str))
+        self.classes = [(i, t[0], t[1]) for i, t in enumerate(tokens) if not isinstance(t, str)]
+
+    @property
+    def layout(self):
+        """Number of tokens & positions of the literal ones"""
+        return len(self.tokens), self.literal_pos
+
+    def matches(self, tokens, comment):
+        """Check the last tokens of a line (with the same layout & key) and
+        its comment"""
+        if self.comment is not None and not comment.startswith(self.comment):
+            return False
+        for i, chars, multiple in self.classes:
+            token = tokens[i]
+            if (len(token) > 1 and not multiple) or not set(token) <= chars:
+                return False
+        return True
+
+    @classmethod
+    def from_index(cls, field, order, slot):
+        """Make a pattern for a Field declared with index: a line of the
+        index entries then the value"""
+        value_class = (frozenset(string.digits + 'eE.-+'), True)
+        tokens = [str(i) for i in field.index] + [value_class]
+        comment = getattr(field, 'comment', None) or None
+        return cls(field, order, slot, tokens, len(tokens) - 1, comment)
+
+    @classmethod
+    def from_regex(cls, field, order, slot):
+        """Convert a Field regex to a pattern, or return None if it doesn't
+        have the form <tokens> # <comment>"""
+        pattern = getattr(field.regex, 'pattern', field.regex)
+        if pattern not in _converted:
+            _converted[pattern] = cls.convert_regex(pattern)
+        if _converted[pattern] is None:
+            return None
+        return cls(field, order, slot, *_converted[pattern])
+
+    @staticmethod
+    def convert_regex(pattern):
+        """Get the tokens, value position & comment from a regex pattern"""
+        if '#' not in pattern:
+            return None
+        head, comment = pattern.split('#', 1)
+        if head.endswith('\\'):
+            head = head[:-1]
+        comment = _unescape(comment, allowed='.')
+        if comment is None or not (head.endswith(' ') or head.endswith(' +')):
+            return None
+
+        tokens, value_pos = [], None
+        for token in _SEPARATOR.split(head):
+            if not token:
+                continue
+            m = _CLASS_TOKEN.match(token)
+            if m:
+                chars = _char_class(m.group(2))
+                if chars is None or bool(m.group(1)) != bool(m.group(4)):
+                    return None
+                if m.group(1):
+                    if value_pos is not None:
+                        return None
+                    value_pos = len(tokens)
+                tokens.append((chars, bool(m.group(3))))
+            else:
+                literal = _unescape(token)
+                if literal is None:
+                    return None
+                tokens.append(literal)
+        if value_pos is None:
+            return None
+        return tokens, value_pos, comment.lstrip()
+
+
+class BlockPatterns(object):
+    """The FieldPatterns of a block, keyed by their literal tokens, plus the
+    fields that are matched by regex."""
+    def __init__(self):
+        # (n tokens, literal positions): (key getter, {key: [FieldPattern]})
+        self.layouts = {}
+        self.regex_fields = []  # (order, slot, Field)
+
+    def add(self, pattern):
+        if pattern.layout not in self.layouts:
+            self.layouts[pattern.layout] = (key_getter(pattern.literal_pos), defaultdict(list))
+        get_key, patterns = self.layouts[pattern.layout]
+        patterns[get_key(pattern.tokens)].append(pattern)
+
+    def match(self, line, found):
+        """Find the first field (in order) that matches line, skipping
+        fields already found (found[slot] set).
+
+        Returns (slot, field, value as str), or None.
+        """
+        best, best_value = None, None
+        data, sep, comment = line.partition('#')
+        if sep and self.layouts:
+            tokens = data.split()
+            for (n, _), (get_key, patterns) in self.layouts.iteritems():
+                if len(tokens) < n:
+                    continue
+                last = tokens[-n:]
+                for pattern in patterns.get(get_key(last), ()):
+                    if best and pattern.order > best.order:
+                        break
+                    if not found[pattern.slot] and pattern.matches(last, comment.lstrip()):
+                        best, best_value = pattern, last[pattern.value_pos]
+                        break
+
+        for order, slot, field in self.regex_fields:
+            if best and order > best.order:
+                break
+            if found[slot] or field.comment not in line:
+                continue
+            result = field.regex.search(line)
+            if result:
+                return slot, field, result.group(1)
+
+        return (best.slot, best.field, best_value) if best else None
+
+
+class ParsePlan(object):
+    """Everything needed to get a set of fields from SLHA files, worked out
+    once and reused for every file: the lookup of fields by block & indices,
+    and the (empty) values of the fields.
+
+    fields : list of Field
+        As in NMSSMToolsFields.py. Each is declared with an index, or a
+        regex (converted to an index where possible, see module docstring).
+    spinfo : bool
+        If True, also read BLOCK SPINFO of NMSSMTools spectrum files: the
+        failed constraints (code 3) are stored under 'constraints', joined
+        by '|', and files with errors (code 4, i.e. un-physical points) or
+        no SPINFO block give None, without reading the rest of the file.
+        With no fields, only the file up to the end of SPINFO is read.
+    """
+    def __init__(self, fields, spinfo=False):
+        self.fields = fields
+        self.spinfo = spinfo
+        # one value per field name, in order
+        self.names = []
+        slots = {}
+        for f in fields:
+            if f.name not in slots:
+                slots[f.name] = len(self.names)
+                self.names.append(f.name)
+        self.empty = [''] * len(self.names)
+
+        self.blocks = defaultdict(BlockPatterns)
+        for order, field in enumerate(fields):
+            slot = slots[field.name]
+            if getattr(field, 'index', None) is not None:
+                pattern = FieldPattern.from_index(field, order, slot)
+            else:
+                pattern = FieldPattern.from_regex(field, order, slot)
+            if pattern:
+                self.blocks[field.block].add(pattern)
+            else:
+                if not isinstance(field, Field) or isinstance(field.regex, basestring):
+                    field = Field(block=field.block, name=field.name, type=field.type,
+                                  regex=re.compile(field.regex),
+                                  comment=getattr(field, 'comment', None))
+                self.blocks[field.block].regex_fields.append((order, slot, field))
+        self.blocks = dict(self.blocks)
+
+    def parse(self, filename, lines=None, failures=None):
+        """Get the fields from an SLHA file, as a dict of field name: value.
+
+        Fields not in the file have value ''. The filename is stored under
+        'file'. Returns None for un-physical points if reading SPINFO.
+
+        lines : iterable of str
+            Lines of the file if already read, e.g. from an archive,
+            otherwise the file is opened.
+        failures : list
+            If reading SPINFO, the messages for problems (code 3) and errors
+            (code 4) are added to this, e.g. 'M_H1^2<1', also for
+            un-physical points.
+        """
+        if lines is None:
+            with open(filename) as f:
+                return self._parse(filename, f, failures)
+        return self._parse(filename, lines, failures)
+
+    def _parse(self, filename, lines, failures=None):
+        values = self.empty[:]
+        found = bytearray(len(values))
+        block = None
+        # SPINFO: 0 = not reached yet, 1 = in block, 2 = done/not wanted
+        spinfo = 0 if self.spinfo else 2
+        constraints = []
+        for line in lines:
+            if spinfo == 0:
+                if line.lstrip().upper().startswith('BLOCK SPINFO'):
+                    spinfo = 1
+            elif spinfo == 1:
+                line_stripped = line.strip()
+                if 'BLOCK' in line_stripped.upper():
+                    spinfo = 2
+                    if not self.blocks:
+                        break  # nothing else to read
+                else:
+                    if failures is not None and line_stripped[:1] in ('3', '4'):
+                        code, sep, message = line_stripped.partition('#')
+                        if sep and code.strip() in ('3', '4'):
+                            failures.append(' '.join(message.split()))
+                    if line_stripped.startswith('3'):
+                        # store failed experimental/theory constraints
+                        line_stripped = constraint_message(line_stripped)
+                        constraints.append(line_stripped)
+                    if line_stripped.startswith('4'):
+                        # show-stopper, no need to read any further
+                        return None
+
+            if is_block_line(line):
+                block = self.blocks.get(block_name(line))
+                continue
+            if block is None:
+                continue
+            match = block.match(line, found)
+            if match:
+                slot, field, value = match
+                values[slot] = field.type(value)
+                found[slot] = 1
+                log.debug('%s: %s', field.name, value)
+
+        if spinfo == 0:
+            return None
+
+        results = defaultdict(str, izip(self.names, values))
+        results['file'] = filename
+        if self.spinfo:
+            # need joiner as CSV file
+            results['constraints'] = '|'.join(constraints)
+        return results
@@ -16,6 +16,7 @@ where <jobs_X_Y_Z> are local dir names that have a corresponding dir on /hdfs
 
 
 import os
+import re
 import sys
 from glob import iglob
 import htcondenser as ht
@@ -30,17 +31,22 @@ ODIR = '/hdfs/user/%s/NMSSM-Scan/' % os.environ['LOGNAME']
 
 STORAGE_DIR = "/storage/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 
+# results<batch>[_<worker>]_<N>.npz, from NMSSMScan.py --shards
+SHARD_NAME = re.compile(r'^results(\d+)_.*\.npz$')
+
 
 def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
     """Submit all CSV-making jobs, with a DAG for each entry in job_dirs.
-    Each job within a DAG is for 1 spectr*.tgz
+    Each job within a DAG is for 1 spectr*.tgz, or for the results*.npz
+    shards of 1 scan job if the scan was run with shards.
 
     Probably could be designed better. Paths rely on many assumptions.
     """
 
     common_input_files = ['analyse_scans.py', 'NMSSMToolsFields.py',
                           'HiggsBoundsSignalsFields.py',
-                          'SuperIsoFields.py', 'NMSSMCalcFields.py']
+                          'SuperIsoFields.py', 'NMSSMCalcFields.py',
+                          'slha_parser.py', 'result_shards.py', 'scan_log.py']
 
     log_stem = 'analysis.$(cluster).$(process)'
 
@@ -82,6 +88,16 @@ def submit_all_analyses(job_dirs, storage_dir, hdfs_dir):
                          hdfs_mirror_dir=os.path.join(hdfs_dir, jdir))
             analysis_jobset.add_job(job)
             analysis_dag.add_job(job)
+
+        # and one for the shards from each scan job
+        shard_files = (os.path.basename(f) for f in iglob(os.path.join(hdfs_dir, jdir, 'results*.npz')))
+        batches = sorted(set(m.group(1) for m in map(SHARD_NAME.match, shard_files) if m), key=int)
+        for pid in batches:
+            job = ht.Job(name='%s_%s_shard_analysis' % (pid, jdir.strip('/')),
+                         args=[jdir, pid, 'shards'],
+                         hdfs_mirror_dir=os.path.join(hdfs_dir, jdir))
+            analysis_jobset.add_job(job)
+            analysis_dag.add_job(job)
         analysis_dag.submit(submit_per_interval=25)
         status_files.append(analysis_dag.status_file)
 
@@ -13,6 +13,7 @@ Requires htcondenser: https://github.com/raggleton/htcondenser
 
 import os
 import sys
+import math
 from time import strftime
 import htcondenser as ht
 import logging
@@ -47,6 +48,19 @@ PARAM_RANGE = "paramRange_smallMa1.json"
 # PARAM_RANGE = "paramRange_highTanBeta.json"
 # PARAM_RANGE = "paramRange_all.json"
 
+# Sample the points for all jobs up front from PARAM_RANGE, using its _sampler
+# & _seed, into a design.npy file that each job reads its own rows from. This
+# means no point is run twice, the scan can be remade from the seed, and each
+# point is identified by its design row (the point index in the output
+# filenames, point logs & shards). If False, each job samples its own points.
+CENTRAL_DESIGN = False
+
+# File of points to run instead of sampling from PARAM_RANGE (CSV or .npy, see
+# point_files.py), e.g. to re-evaluate a set of benchmark points with new
+# program versions. NUM_JOBS is then set to cover all the points, NUM_POINTS
+# per job. Set PARAM_RANGE to None unless it is needed to name the columns.
+POINTS = None
+
 # Output directory for results - will create a subdiretory for this set of jobs
 ODIR = "/hdfs/user/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 
@@ -54,7 +68,29 @@ ODIR = "/hdfs/user/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 STORAGE_DIR = "/storage/%s/NMSSM-Scan/" % (os.environ['LOGNAME'])
 
 
-def submit_scans(num_jobs, num_points, job_description, card, param_range, storage_dir, hdfs_dir):
+def make_design(param_range, num_points, filename):
+    """Sample num_points points from the params in param_range, and save them
+    to a .npy file (see point_files.py)."""
+    # only needed to make a design, so only imported then
+    import numpy as np
+    from point_files import sample_design, save_points
+    from param_space import ParamSpace, load_param_file
+    from samplers import get_sampler
+
+    param_dict, constraints, options = load_param_file(param_range)
+    param_space = ParamSpace(param_dict, constraints)
+    sampler_name = options.get('_sampler', 'random')
+    seed = options.get('_seed')
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    sampler = get_sampler(sampler_name, param_space.n_dims, seed=seed)
+    save_points(filename, sample_design(param_space, sampler, num_points), param_space.names)
+    log.info('Saved %d points from %s sampler with seed %d to %s',
+             num_points, sampler_name, seed, filename)
+
+
+def submit_scans(num_jobs, num_points, job_description, card, param_range, storage_dir, hdfs_dir,
+                 points=None, design=False):
     """Submit a set of scan jobs to HTCondor as a DAG, that run NMSSMScan.py.
 
     Parameters
@@ -73,7 +109,19 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
         Location on /storage for logs, and condor/DAG files
     hdfs_dir : str
         Location on /hdfs for storing output of scans
+    points : str
+        Location of file of points to run, instead of sampling them. Overrides
+        num_jobs.
+    design : bool
+        If True (and no points), sample the points for all jobs here, into a
+        design.npy file in the job directory.
     """
+    if points:
+        # point_files needs numpy, so only imported when running a points file
+        from point_files import count_points
+        num_jobs = int(math.ceil(count_points(points) / float(num_points)))
+        log.info('Running %s over %d jobs', points, num_jobs)
+
     # Setup some directories:
     date_str = strftime("%d_%b_%y_%H%M")
     job_dir = 'jobs_%d_%s_%s' % (num_jobs, job_description, date_str)
@@ -81,19 +129,32 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
     if not os.path.isdir(job_dir):
         os.makedirs(job_dir)  # local copy of directory for eventual output
 
+    if design and not points:
+        points = os.path.join(job_dir, 'design.npy')
+        make_design(param_range, num_jobs * num_points, points)
+
     log_dir = os.path.join(storage_dir, job_dir, 'logs')
     log_stem = 'scan.$(cluster).$(process)'
 
     hdfs_store = os.path.join(hdfs_dir, job_dir)
 
-    common_input_files = [param_range, 'NMSSMScan.py', 'common_utils.py', card,
+    common_input_files = ['NMSSMScan.py', 'common_utils.py',
+                          'card_template.py', 'tool_runner.py', 'scan_pipeline.py',
+                          'samplers.py', 'mcmc.py', 'surrogate.py', 'scan_log.py',
+                          'result_cache.py', 'result_shards.py', 'scan_targets.py',
+                          'scan_metrics.py',
+                          'param_space.py', 'tree_level.py', 'native_scan.py',
+                          'point_files.py', 'analyse_scans.py', 'slha_parser.py',
+                          'NMSSMToolsFields.py', 'HiggsBoundsSignalsFields.py',
+                          'SuperIsoFields.py', 'NMSSMCalcFields.py', card,
                           'patches/NT.patch', 'patches/NT_clean.patch',
                           'patches/HB.patch', 'patches/HS_datatables.patch',
                           'patches/HS_subroutines.patch', 'patches/HS_assignmass.patch']
+    common_input_files += [f for f in [param_range, points] if f]
 
     scan_jobset = ht.JobSet(exe='HTCondor/runScan_condor.sh',
                             copy_exe=True,
-                            setup_script=None,
+                            setup_script='HTCondor/setupPyEnv.sh',
                             filename=os.path.join(storage_dir, job_dir, 'scan.condor'),
                             out_dir=log_dir, out_file=log_stem + '.out',
                             err_dir=log_dir, err_file=log_stem + '.err',
@@ -109,7 +170,8 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
 
     for ind in xrange(num_jobs):
         scan_job = ht.Job(name='%d_scan' % ind,
-                          args=[hdfs_store, str(ind), str(num_points)],
+                          args=[hdfs_store, str(ind), str(num_points)] +
+                               ([os.path.basename(points)] if points else []),
                           hdfs_mirror_dir=hdfs_store)
         scan_jobset.add_job(scan_job)
         scan_dag.add_job(scan_job)
@@ -123,4 +185,5 @@ def submit_scans(num_jobs, num_points, job_description, card, param_range, stora
 
 
 if __name__ == "__main__":
-    sys.exit(submit_scans(NUM_JOBS, NUM_POINTS, JOB_DESC, CARD, PARAM_RANGE, STORAGE_DIR, ODIR))
+    sys.exit(submit_scans(NUM_JOBS, NUM_POINTS, JOB_DESC, CARD, PARAM_RANGE, STORAGE_DIR, ODIR,
+                          points=POINTS, design=CENTRAL_DESIGN))
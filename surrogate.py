@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Surrogate classifier to predict whether a parameter point is worth running
+through NMSSMTools, e.g. whether it will be physical or pass the constraints.
+
+The model is a distance-weighted k-nearest-neighbours classifier in the unit
+hypercube of the param ranges, using only numpy.
+
+Train it on previous scan output, and save it to a .npz file:
+
+    python surrogate.py --param paramRange.json --label physical -o surrogate.npz points*.csv
+
+Training files can be:
+- point logs from NMSSMScan.py --pointLog, with a 'physical' column
+- CSV/HDF5 output from analyse_scans/make_hdf5. Use --label good to label
+  points passing the relaxed constraints (as in analyse_scans.pass_constraints)
+
+Then use it in NMSSMScan.py with --surrogate surrogate.npz.
+"""
+
+
+import sys
+import argparse
+import logging
+import numpy as np
+from param_space import ParamSpace, load_param_file
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+# Map param names in JSON/card to column names in the analyse_scans output,
+# if they aren't just the lowercase version
+PARAM_COLUMNS = {'TANB': 'tgbeta'}
+
+
+def param_column(name, columns):
+    """Get the column name for param name in a set of columns"""
+    if name in columns:
+        return name
+    return PARAM_COLUMNS.get(name, name.lower())
+
+
+class KNNSurrogate(object):
+    """Distance-weighted k-nearest-neighbours classifier.
+
+    param_names : list[str]
+        Names of params, in order of the feature columns.
+    mins, maxs : list[float]
+        Param ranges, used to scale features to the unit hypercube.
+    features : numpy.ndarray
+        (n, n params) array of training points (in physical units)
+    labels : numpy.ndarray
+        (n,) array of 0/1 labels
+    k : int
+        Number of neighbours
+    """
+    def __init__(self, param_names, mins, maxs, features, labels, k=10, pos_scores=None):
+        self.param_names = list(param_names)
+        self.mins = np.asarray(mins, dtype=float)
+        self.maxs = np.asarray(maxs, dtype=float)
+        self.x = self.scale(features)
+        self.y = np.asarray(labels, dtype=float)
+        self.k = min(k, len(self.y))
+        self.pos_scores = pos_scores
+        if self.pos_scores is None:
+            self.pos_scores = self.loo_scores(self.x[self.y == 1])
+
+    def scale(self, features):
+        """Scale features to the unit hypercube"""
+        return (np.asarray(features, dtype=float) - self.mins) / (self.maxs - self.mins)
+
+    def predict(self, features):
+        """Return the probability of label 1 for each row of features"""
+        return self._predict_scaled(self.scale(np.atleast_2d(features)))
+
+    def _predict_scaled(self, x, exclude_self=False):
+        scores = np.empty(len(x))
+        for i, row in enumerate(x):
+            dist = np.sqrt(np.sum((self.x - row) ** 2, axis=1))
+            if exclude_self:
+                dist[dist == 0] = np.inf
+            nearest = np.argpartition(dist, self.k - 1)[:self.k]
+            weights = 1. / (dist[nearest] + 1E-6)
+            scores[i] = np.sum(weights * self.y[nearest]) / np.sum(weights)
+        return scores
+
+    def loo_scores(self, x, max_points=2000):
+        """Leave-one-out scores for (a subset of) training points x, used to
+        set the threshold for a given false rejection rate."""
+        if len(x) > max_points:
+            x = x[np.random.RandomState(1).choice(len(x), max_points, replace=False)]
+        return self._predict_scaled(x, exclude_self=True)
+
+    def threshold(self, false_rejection_rate):
+        """Score threshold such that this fraction of label-1 training points
+        would be rejected."""
+        if len(self.pos_scores) == 0:
+            return 0.
+        return np.percentile(self.pos_scores, 100. * false_rejection_rate)
+
+    def save(self, filename):
+        """Save the model to a .npz file"""
+        np.savez_compressed(filename, param_names=np.array(self.param_names),
+                            mins=self.mins, maxs=self.maxs,
+                            features=self.x * (self.maxs - self.mins) + self.mins,
+                            labels=self.y, k=self.k, pos_scores=self.pos_scores)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a model from a .npz file made with save()"""
+        data = np.load(filename)
+        return cls(param_names=[str(p) for p in data['param_names']],
+                   mins=data['mins'], maxs=data['maxs'],
+                   features=data['features'], labels=data['labels'],
+                   k=int(data['k']), pos_scores=data['pos_scores'])
+
+
+class SurrogateFilter(object):
+    """Decide whether to run a point, using a surrogate model.
+
+    model : KNNSurrogate
+        Trained model
+    false_rejection_rate : float
+        Target fraction of good points to reject wrongly.
+    explore : float
+        Fraction of rejected points to run anyway, so future training data
+        isn't biased by the model's own rejections.
+    seed : int
+        Seed for choosing exploration points. Whether a point is explored
+        depends only on the seed and the point index, so the choice is the
+        same however the points are split between workers, or if the scan
+        is resumed.
+    """
+    def __init__(self, model, false_rejection_rate=0.05, explore=0.05, seed=None):
+        self.model = model
+        self.threshold = model.threshold(false_rejection_rate)
+        self.explore = explore
+        self.seed = seed if seed is not None else np.random.randint(2 ** 31)
+        self.n_queried = 0
+        self.n_rejected = 0
+        self.n_explored = 0
+        log.info('Surrogate threshold %.3f for false rejection rate %g',
+                 self.threshold, false_rejection_rate)
+
+    def decide(self, ind, values):
+        """Decide whether to run point ind (values is a dict of param name: value).
+
+        Returns 'accept' if the model says to run it, 'explore' if the model
+        rejected it but it should be run anyway for exploration, otherwise
+        'reject'.
+        """
+        self.n_queried += 1
+        score = self.model.predict([values[k] for k in self.model.param_names])[0]
+        if score >= self.threshold:
+            return 'accept'
+        if np.random.RandomState((self.seed * 1000003 + ind) % 2 ** 32).uniform() < self.explore:
+            self.n_explored += 1
+            return 'explore'
+        self.n_rejected += 1
+        return 'reject'
+
+    def stats(self):
+        """Counters, to merge into another SurrogateFilter"""
+        return (self.n_queried, self.n_rejected, self.n_explored)
+
+    def merge(self, stats):
+        """Add in counters from stats() of another SurrogateFilter"""
+        self.n_queried += stats[0]
+        self.n_rejected += stats[1]
+        self.n_explored += stats[2]
+
+    def print_summary(self):
+        print '* Surrogate: %d queried, %d rejected, %d run for exploration' % (
+            self.n_queried, self.n_rejected, self.n_explored)
+
+
+def load_training_data(filenames, param_names, label):
+    """Load params and labels from CSV/HDF5 files.
+
+    label : str
+        Column to use as label. 'good' is special: if there is no 'good'
+        column, it is made from the 'constraints' and 'Del_a_mu' columns.
+    """
+    # only needed for training, so NMSSMScan doesn't need pandas
+    import pandas as pd
+    from analyse_scans import pass_constraints
+
+    frames = []
+    for f in filenames:
+        if f.endswith('.h5'):
+            frames.append(pd.read_hdf(f))
+        else:
+            frames.append(pd.read_csv(f))
+    df = pd.concat(frames, ignore_index=True)
+
+    if label == 'good' and 'good' not in df.columns:
+        df['constraints'] = df['constraints'].fillna('')
+        df['good'] = [pass_constraints(row, strict=False)
+                      for row in df[['constraints', 'Del_a_mu']].to_dict('records')]
+
+    features = df[[param_column(p, df.columns) for p in param_names]].values
+    labels = df[label].astype(int).values
+    return features, labels
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='+',
+                        help='CSV/HDF5 files with params and label')
+    parser.add_argument('--param', required=True,
+                        help='JSON file with parameter ranges, as for NMSSMScan.py')
+    parser.add_argument('--label', default='physical',
+                        help="Column to use as label, or 'good'")
+    parser.add_argument('-k', type=int, default=10,
+                        help='Number of nearest neighbours')
+    parser.add_argument('-o', '--output', default='surrogate.npz',
+                        help='Output file for model')
+    args = parser.parse_args(in_args)
+
+    param_dict, constraints, _ = load_param_file(args.param)
+    # only the free params, as the derived ones follow from them
+    param_space = ParamSpace(param_dict, constraints)
+    param_names = param_space.free_names
+
+    features, labels = load_training_data(args.input, param_names, args.label)
+    log.info('Training on %d points, %d with %s', len(labels), labels.sum(), args.label)
+    model = KNNSurrogate(param_names, mins=param_space.mins, maxs=param_space.maxs,
+                         features=features, labels=labels, k=args.k)
+    for frr in [0.01, 0.05, 0.1]:
+        log.info('False rejection rate %g: threshold %.3f', frr, model.threshold(frr))
+    model.save(args.output)
+    log.info('Written model to %s', args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Benchmark making input cards with the precompiled CardTemplate against
+the old method of running re.sub over every line for every parameter.
+
+Also checks that both methods give identical cards.
+
+Usage (from the top directory):
+
+    python testing/benchmark_card_template.py --card Proto_files/inp_PROTO_all.dat --param paramRange_all.json -n 10000
+"""
+
+
+import os
+import sys
+import argparse
+import json
+import random
+import re
+from timeit import default_timer as timer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from card_template import CardTemplate
+
+
+def render_regex(template_lines, param_dict):
+    """Old method from NMSSMScan - re.sub per line per parameter"""
+    new_card_text = template_lines[:]
+    for i in range(len(new_card_text)):
+        for k, v in param_dict.iteritems():
+            s_match = r'(\s+\d+\s+)[\w.]+(\s+#\s%s.*)' % k
+            s_repl = r'\g<1>' + str(v['value']) + 'D0\g<2>'
+            new_card_text[i] = re.sub(s_match, s_repl, new_card_text[i])
+    return ''.join(new_card_text)
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--card", help="Input card template",
+                        default="Proto_files/inp_PROTO_all.dat")
+    parser.add_argument("--param", help="JSON file with parameter ranges",
+                        default="paramRange_all.json")
+    parser.add_argument("-n", help="Number of points", type=int, default=10000)
+    args = parser.parse_args(in_args)
+
+    with open(args.card) as template_file:
+        template_lines = template_file.readlines()
+
+    with open(args.param) as json_file:
+        param_dict = dict((k, v) for k, v in json.load(json_file).iteritems()
+                          if not k.startswith('_'))
+
+    random.seed(1)
+    points = [dict((k, random.uniform(v['min'], v['max'])) for k, v in param_dict.iteritems())
+              for _ in xrange(args.n)]
+
+    start = timer()
+    regex_cards = []
+    for p in points:
+        for k, v in param_dict.iteritems():
+            v['value'] = p[k]
+        regex_cards.append(render_regex(template_lines, param_dict))
+    t_regex = timer() - start
+
+    start = timer()
+    template = CardTemplate(template_lines, param_dict.keys())
+    template_cards = [template.render(p) for p in points]
+    t_template = timer() - start
+
+    n_diff = sum(a != b for a, b in zip(regex_cards, template_cards))
+
+    print '*' * 40
+    print '* Card:', args.card
+    print '* Params:', args.param, '(%d params)' % len(param_dict)
+    print '* N points:', args.n
+    print '* re.sub loop: %.3f s (%.1f us/card)' % (t_regex, 1E6 * t_regex / args.n)
+    print '* CardTemplate: %.3f s (%.1f us/card)' % (t_template, 1E6 * t_template / args.n)
+    print '* Speedup: %.1fx' % (t_regex / t_template)
+    print '* N cards differing:', n_diff
+    print '*' * 40
+    return 1 if n_diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Run external programs (NMSSMTools, HiggsBounds, HiggsSignals, ...) with a
+timeout, and keep track of the resources each one uses.
+
+Each call is run in its own process group, so if it takes too long the whole
+group (e.g. the NMSSMTools run script *and* the Fortran binary it started)
+can be killed in one go.
+"""
+
+
+import os
+import signal
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+from subprocess import Popen
+from timeit import default_timer as timer
+
+
+log = logging.getLogger(__name__)
+
+
+class ToolResult(namedtuple('ToolResult', ['tool', 'n_points', 'returncode', 'timed_out',
+                                             'wall', 'cpu', 'maxrss'])):
+    """Outcome & resources used of one call to a tool"""
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """True if the program finished in time, with return code 0"""
+        return self.returncode == 0 and not self.timed_out
+
+
+def check_result(result, filename):
+    """Log a warning if a call to a tool over filename failed or timed out.
+
+    Returns result.ok, so the caller can drop the point.
+    """
+    if not result.ok:
+        reason = 'timed out' if result.timed_out else 'return code %d' % result.returncode
+        log.warning('%s failed on %s (%s) - not using this point', result.tool, filename, reason)
+    return result.ok
+
+
+class ToolStats(object):
+    """Accumulated resource usage for all calls to one tool."""
+    def __init__(self):
+        self.calls = 0
+        self.points = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.maxrss = 0
+
+    def add(self, result):
+        """Add in the ToolResult from one call."""
+        self.calls += 1
+        self.points += result.n_points
+        self.timeouts += int(result.timed_out)
+        self.failures += int(result.returncode != 0)
+        self.wall += result.wall
+        self.cpu += result.cpu
+        self.maxrss = max(self.maxrss, result.maxrss)
+
+    def merge(self, other):
+        """Add in another ToolStats, e.g. from a different worker."""
+        self.calls += other.calls
+        self.points += other.points
+        self.timeouts += other.timeouts
+        self.failures += other.failures
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.maxrss = max(self.maxrss, other.maxrss)
+
+
+class ToolRunner(object):
+    """Run external programs with per-tool timeouts and resource accounting.
+
+    timeouts : dict
+        Map of tool name to timeout in seconds. Tools not in here, or with a
+        timeout of None or 0, are allowed to run forever.
+    """
+    def __init__(self, timeouts=None):
+        self.timeouts = timeouts or {}
+        self.stats = OrderedDict()
+        self._lock = threading.Lock()  # for running from several threads
+
+    def run(self, tool, cmds, cwd, n_points=1):
+        """Run a program and wait for it to finish, or kill it on timeout.
+
+        tool : str
+            Name of tool, used to look up the timeout and for accounting.
+        cmds : list[str]
+            Command and its arguments.
+        cwd : str
+            Directory to run the command in.
+        n_points : int
+            Number of points handled by this call, for programs run over a
+            batch of points. The timeout is scaled up by this.
+
+        Returns a ToolResult. If the timeout expired, the returncode is
+        negative (the signal number used to kill it). Check result.ok (or
+        use check_result) before using anything the program made.
+        """
+        log.debug('%s: %s in %s', tool, cmds, cwd)
+        timeout = self.timeouts.get(tool)
+        if timeout:
+            timeout *= n_points
+        start = timer()
+        proc = Popen(cmds, cwd=cwd, preexec_fn=os.setsid)
+
+        timed_out = threading.Event()
+
+        def kill_group():
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass  # already finished
+
+        timeout_timer = None
+        if timeout:
+            timeout_timer = threading.Timer(timeout, kill_group)
+            timeout_timer.start()
+
+        # use wait4 rather than proc.wait() to get the rusage of this
+        # child (and any children of its own that it waited for)
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            if timeout_timer:
+                timeout_timer.cancel()
+        wall = timer() - start
+
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+        if timed_out.is_set():
+            log.warning('%s took longer than %g s - killed %s', tool, timeout, cmds)
+
+        result = ToolResult(tool=tool, n_points=n_points, returncode=proc.returncode,
+                            timed_out=timed_out.is_set(), wall=wall,
+                            cpu=usage.ru_utime + usage.ru_stime,
+                            maxrss=usage.ru_maxrss)
+        with self._lock:
+            self.stats.setdefault(tool, ToolStats()).add(result)
+        return result
+
+    def merge(self, stats):
+        """Merge in stats (a dict of tool: ToolStats) from another ToolRunner."""
+        for tool, tool_stats in stats.iteritems():
+            self.stats.setdefault(tool, ToolStats()).merge(tool_stats)
+
+    def print_summary(self):
+        """Print a table of resources used per tool."""
+        if not self.stats:
+            return
+        print '* %-14s %7s %7s %8s %7s %10s %10s %12s %12s' % (
+            'Tool', 'Calls', 'Points', 'Timeouts', 'Failed',
+            'Wall [s]', 'CPU [s]', 'Wall/pt [s]', 'Max RSS [MB]')
+        for tool, s in self.stats.iteritems():
+            print '* %-14s %7d %7d %8d %7d %10.1f %10.1f %12.3f %12.1f' % (
+                tool, s.calls, s.points, s.timeouts, s.failures,
+                s.wall, s.cpu, s.wall / max(s.points, 1), s.maxrss / 1024.)
@@ -0,0 +1,127 @@
+"""
+Tree-level NMSSM Higgs masses, to screen out points with a clearly tachyonic
+Higgs spectrum (which NMSSMTools reports as M_H1^2<1, M_A1^2<1 or
+M_HC^2<1) before running NMSSMTools.
+
+Uses the tree-level mass matrices of the Z3-invariant NMSSM, as in
+U. Ellwanger, C. Hugonie, A. M. Teixeira, Phys. Rept. 496 (2010) 1,
+section 2.2, with v = 174 GeV. Everything works on arrays of points, so a
+whole batch of candidate points is screened at once.
+
+Radiative corrections (mostly to the CP-even masses, from top/stop loops)
+can lift a slightly negative tree-level mass^2 above zero, so points are
+only rejected if a mass^2 is below -margin.
+"""
+
+
+import logging
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+
+MZ = 91.1876  # GeV
+MW = 80.385  # GeV
+V = 174.1  # GeV, sqrt(v_u^2 + v_d^2) = (2 sqrt(2) G_F)^-1/2
+G2 = MZ ** 2 / V ** 2  # g^2 = (g1^2 + g2^2) / 2
+G2_SQ = 2 * MW ** 2 / V ** 2  # SU(2) coupling g2^2
+
+# param names (as in the card & param JSON) needed for the tree-level masses
+TREE_PARAMS = ['LAMBDA', 'KAPPA', 'ALAMBDA', 'AKAPPA', 'MUEFF', 'TANB']
+
+
+def higgs_mass_matrices(lam, kappa, alam, akappa, mueff, tanb):
+    """Make the tree-level Higgs mass^2 matrices, for arrays of params.
+
+    Returns (CP-even, CP-odd) matrices as (n, 3, 3) & (n, 2, 2) arrays,
+    in the bases (H_u, H_d, S) and (A, S_I) (i.e. without the Goldstone),
+    and the charged Higgs mass^2 as an (n,) array.
+    """
+    lam, kappa, alam, akappa, mueff, tanb = [np.atleast_1d(np.asarray(x, dtype=float))
+                                            for x in [lam, kappa, alam, akappa, mueff, tanb]]
+    n = len(lam)
+    beta = np.arctan(tanb)
+    vu, vd = V * np.sin(beta), V * np.cos(beta)
+    s = mueff / lam
+    b_eff = alam + kappa * s
+
+    even = np.empty((n, 3, 3))
+    even[:, 0, 0] = G2 * vu ** 2 + mueff * b_eff / tanb
+    even[:, 1, 1] = G2 * vd ** 2 + mueff * b_eff * tanb
+    even[:, 2, 2] = lam * alam * vu * vd / s + kappa * s * (akappa + 4 * kappa * s)
+    even[:, 0, 1] = even[:, 1, 0] = (2 * lam ** 2 - G2) * vu * vd - mueff * b_eff
+    even[:, 0, 2] = even[:, 2, 0] = lam * (2 * mueff * vu - (b_eff + kappa * s) * vd)
+    even[:, 1, 2] = even[:, 2, 1] = lam * (2 * mueff * vd - (b_eff + kappa * s) * vu)
+
+    ma_sq = 2 * mueff * b_eff / np.sin(2 * beta)
+    odd = np.empty((n, 2, 2))
+    odd[:, 0, 0] = ma_sq
+    odd[:, 1, 1] = lam * (b_eff + 3 * kappa * s) * vu * vd / s - 3 * kappa * akappa * s
+    odd[:, 0, 1] = odd[:, 1, 0] = lam * (alam - 2 * kappa * s) * V
+
+    charged = ma_sq + V ** 2 * (G2_SQ / 2 - lam ** 2)
+    return even, odd, charged
+
+
+def lightest_masses_sq(columns):
+    """Get the lightest tree-level CP-even, CP-odd & charged Higgs mass^2
+    for arrays of points.
+
+    columns : dict
+        Map of param name to array of values, must include TREE_PARAMS.
+
+    Returns three (n,) arrays. Points where the masses can't be calculated
+    (e.g. LAMBDA = 0) get NaN.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        even, odd, charged = higgs_mass_matrices(*[columns[k] for k in TREE_PARAMS])
+        bad = ~(np.isfinite(even).all(axis=(1, 2)) & np.isfinite(odd).all(axis=(1, 2)))
+        even[bad] = 0.
+        odd[bad] = 0.
+        m_even = np.linalg.eigvalsh(even)[:, 0]
+        m_odd = np.linalg.eigvalsh(odd)[:, 0]
+    m_even[bad] = np.nan
+    m_odd[bad] = np.nan
+    charged = np.where(bad, np.nan, charged)
+    return m_even, m_odd, charged
+
+
+class TreeLevelScreen(object):
+    """Reject points with a clearly tachyonic tree-level Higgs spectrum.
+
+    margin : float
+        Points are rejected if the lightest CP-even, CP-odd or charged
+        Higgs tree-level mass^2 is below -margin, in GeV^2.
+    """
+    def __init__(self, margin=1E4):
+        self.margin = margin
+        self.n_checked = 0
+        self.n_rejected = {'CP-even': 0, 'CP-odd': 0, 'charged': 0}
+
+    def allowed(self, columns):
+        """Return a boolean array of which points pass the screen.
+
+        Points whose masses can't be calculated are let through.
+        """
+        masses = lightest_masses_sq(columns)
+        mask = np.ones(len(masses[0]), dtype=bool)
+        for name, m_sq in zip(['CP-even', 'CP-odd', 'charged'], masses):
+            with np.errstate(invalid='ignore'):
+                tachyonic = m_sq < -self.margin
+            # count each point once, by the first tachyonic Higgs
+            self.n_rejected[name] += np.count_nonzero(tachyonic & mask)
+            mask &= ~tachyonic
+        self.n_checked += len(mask)
+        return mask
+
+    @property
+    def n_total_rejected(self):
+        return sum(self.n_rejected.itervalues())
+
+    def print_summary(self):
+        print ('* Tree-level screen: %d checked, %d rejected (%s), '
+               'i.e. NMSSMTools calls avoided' % (
+                   self.n_checked, self.n_total_rejected,
+                   ', '.join('%d %s' % (self.n_rejected[k], k)
+                             for k in ['CP-even', 'CP-odd', 'charged'])))